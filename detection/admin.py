@@ -1,10 +1,12 @@
 from django.contrib import admin
-from .models import RetinopathyTest, DietaryRecommendation,Country
+from django.utils.html import format_html
+from .models import RetinopathyTest, DietaryRecommendation,Country, DetectionJob, TestGrade
+from .thumbnails import thumbnail_url
 
 @admin.register(RetinopathyTest)
 class RetinopathyTestAdmin(admin.ModelAdmin):
-    list_display = ('id', 'result', 'confidence_percentage', 'created_at', 'image_preview')
-    list_filter = ('result', 'created_at')
+    list_display = ('id', 'result', 'confidence_percentage', 'model_version', 'created_at', 'image_preview')
+    list_filter = ('result', 'model_version', 'created_at')
     readonly_fields = ('created_at', 'image_preview', 'confidence_percentage')
     
     def confidence_percentage(self, obj):
@@ -13,7 +15,10 @@ class RetinopathyTestAdmin(admin.ModelAdmin):
     
     def image_preview(self, obj):
         if obj.image:
-            return f'<img src="{obj.image.url}" style="max-height: 100px; max-width: 100px;" />'
+            return format_html(
+                '<img src="{}" style="max-height: 100px; max-width: 100px;" loading="lazy" />',
+                thumbnail_url(obj, 'small')
+            )
         return "No image"
     image_preview.short_description = 'Image Preview'
     image_preview.allow_tags = True
@@ -72,3 +77,18 @@ class DietaryRecommendationAdmin(admin.ModelAdmin):
         ]
         return f"{sum(len(f.split(',')) for f in foods if f)} food items"
     get_food_count.short_description = 'Food Items'
+
+
+
+@admin.register(DetectionJob)
+class DetectionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'status', 'country', 'test', 'created_at', 'finished_at')
+    list_filter = ('status', 'created_at')
+    readonly_fields = ('created_at', 'started_at', 'finished_at', 'result', 'error')
+
+
+@admin.register(TestGrade)
+class TestGradeAdmin(admin.ModelAdmin):
+    list_display = ('test', 'model_version', 'result', 'confidence', 'created_at')
+    list_filter = ('model_version', 'result')
+    raw_id_fields = ('test',)
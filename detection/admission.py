@@ -0,0 +1,205 @@
+"""
+Admission control in front of inference.
+
+At most ``ADMISSION_MAX_IN_FLIGHT`` detections run at once per process.
+Up to ``ADMISSION_MAX_QUEUE`` more wait their turn, first come first
+served, for at most ``ADMISSION_QUEUE_TIMEOUT`` seconds. Anything beyond
+that is refused straight away with ``Overloaded``. The views then either
+answer 503 with a ``Retry-After`` estimate or hand the image to the async
+job path. Shedding load this way keeps latency bounded for the requests
+that are admitted instead of letting every request slow down together.
+"""
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from .metrics import Counter, Histogram, registry
+
+admission_total = registry.register(Counter(
+    'dr_admission_total', "Inference admission decisions", ['outcome'],
+))
+admission_wait_seconds = registry.register(Histogram(
+    'dr_admission_wait_seconds', "Time admitted requests waited for an inference slot",
+))
+
+
+class Overloaded(Exception):
+    """No inference slot became free in time"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Inference is overloaded ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('event', 'loop', 'future', 'granted')
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+        self.granted = False
+
+    def grant(self):
+        self.granted = True
+        if self.loop is None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=8, max_queue=16, queue_timeout=10.0):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_queue = max(0, int(max_queue))
+        self.queue_timeout = max(0.0, float(queue_timeout))
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self._in_flight = 0
+        # Moving average of how long an admitted request holds its slot
+        self._service_time = 0.0
+
+    def _try_enter(self, loop=None):
+        """Take a free slot, or queue a waiter; raises Overloaded when the queue is full"""
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._waiters:
+                self._in_flight += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                admission_total.inc(outcome='rejected_queue_full')
+                raise Overloaded('queue full', self.retry_after())
+            waiter = _Waiter(loop)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _abandon(self, waiter, outcome='rejected_timeout'):
+        """Give up waiting; True if the slot was granted meanwhile and is now ours"""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._waiters.remove(waiter)
+        admission_total.inc(outcome=outcome)
+        return False
+
+    def _leave(self, held):
+        with self._lock:
+            self._service_time = held if not self._service_time else 0.8 * self._service_time + 0.2 * held
+            if self._waiters:
+                # Hand the slot straight to the oldest waiter
+                self._waiters.popleft().grant()
+            else:
+                self._in_flight -= 1
+
+    def _admitted(self, waited):
+        admission_total.inc(outcome='admitted')
+        admission_wait_seconds.observe(waited)
+
+    @contextmanager
+    def admit(self):
+        """Hold an inference slot for the enclosed block"""
+        started = time.monotonic()
+        waiter = self._try_enter()
+        if waiter is not None and not waiter.event.wait(self.queue_timeout) and not self._abandon(waiter):
+            raise Overloaded('queue timeout', self.retry_after())
+        entered = time.monotonic()
+        self._admitted(entered - started)
+        try:
+            yield
+        finally:
+            self._leave(time.monotonic() - entered)
+
+    @asynccontextmanager
+    async def aadmit(self):
+        """admit() for async views: waits on the event loop instead of blocking a thread"""
+        started = time.monotonic()
+        waiter = self._try_enter(asyncio.get_running_loop())
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if not self._abandon(waiter):
+                    raise Overloaded('queue timeout', self.retry_after())
+            except asyncio.CancelledError:
+                # The client went away; pass on a slot that was already handed to us
+                if self._abandon(waiter, outcome='cancelled'):
+                    self._leave(0.0)
+                raise
+        entered = time.monotonic()
+        self._admitted(entered - started)
+        try:
+            yield
+        finally:
+            self._leave(time.monotonic() - entered)
+
+    def retry_after(self):
+        """Seconds until the current queue has likely drained, at least one"""
+        service_time = self._service_time or 1.0
+        return max(1, math.ceil(service_time * (len(self._waiters) + 1) / self.max_in_flight))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_in_flight': self.max_in_flight,
+                'max_queue': self.max_queue,
+                'in_flight': self._in_flight,
+                'queue_depth': len(self._waiters),
+                'service_time_seconds': self._service_time,
+            }
+
+
+def build_admission_controller():
+    """The controller configured in settings, or None when admission control is off"""
+    max_in_flight = getattr(settings, 'ADMISSION_MAX_IN_FLIGHT', 8)
+    if not max_in_flight:
+        return None
+    return AdmissionController(
+        max_in_flight=max_in_flight,
+        max_queue=getattr(settings, 'ADMISSION_MAX_QUEUE', 16),
+        queue_timeout=getattr(settings, 'ADMISSION_QUEUE_TIMEOUT', 10.0),
+    )
+
+
+admission = build_admission_controller()
+
+
+def _admission_metrics():
+    if admission is None:
+        return []
+    stats = admission.stats()
+    lines = []
+    for key in ('in_flight', 'queue_depth', 'max_in_flight', 'max_queue'):
+        lines.append(f"# TYPE dr_admission_{key} gauge")
+        lines.append(f"dr_admission_{key} {stats[key]}")
+    return lines
+
+
+registry.add_collector(_admission_metrics)
+
+
+@contextmanager
+def admitted():
+    """admit() on the configured controller, or nothing when it is disabled"""
+    if admission is None:
+        yield
+    else:
+        with admission.admit():
+            yield
+
+
+@asynccontextmanager
+async def aadmitted():
+    if admission is None:
+        yield
+    else:
+        async with admission.aadmit():
+            yield
@@ -1,76 +1,466 @@
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.models import load_model # type: ignore
-from tensorflow.keras.preprocessing import image # type: ignore
-from PIL import Image,ImageOps
-import io
+from concurrent.futures import Future
 import os
+import queue
+import threading
+import time
 from django.conf import settings
+from .backends import CONVERTED_SUFFIXES, create_placeholder_model, load_backend
+from .inference_server import InferenceClient, configure_tf_threads, server_address
+from .model_registry import ModelIntegrityError, build_model_watcher, registry as model_registry
+from .metrics import errors_total, inference_batch_size, model_load_seconds, registry, stage
+from .prediction_cache import build_prediction_cache, model_fingerprint
+from .preprocessing import preprocess_batch
+from .tta import augment_batch, average_views, view_transforms
+from .uploads import DecodedUpload
+
+
+class BatcherClosed(RuntimeError):
+    """The micro-batcher was closed before the sample could be queued"""
+
+
+class MicroBatcher:
+    """Collect concurrent single-image predictions into one model call.
+
+    Callers block in ``submit`` while a background thread drains the queue.
+    A batch is flushed as soon as it reaches ``max_batch_size`` items or
+    ``max_wait_ms`` has passed since its first item arrived, and each caller
+    gets back its own row of the model output. Callers give up after
+    ``timeout`` seconds instead of waiting on a stuck worker forever.
+    ``collate`` turns the queued samples into the model input.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=5.0, timeout=30.0, collate=np.stack):
+        self.predict_fn = predict_fn
+        self.collate = collate
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.timeout = timeout or None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+        self._closed = False
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._items = 0
+        self._full_flushes = 0
+        self._timeout_flushes = 0
+        self._errors = 0
+        self._size_histogram = {}
+
+    def _ensure_worker(self):
+        # The worker is started lazily and restarted after a fork, so a
+        # pre-forking server gets one batching thread per worker process.
+        pid = os.getpid()
+        if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._closed:
+                return
+            if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+                return
+            if self._worker_pid != pid:
+                self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._run, name='dr-micro-batcher', daemon=True)
+            self._worker_pid = pid
+            self._worker.start()
+
+    def submit(self, sample):
+        """Queue one preprocessed sample (without batch axis) and wait for its output row"""
+        future = Future()
+        self._ensure_worker()
+        # Queued under the lock, so a sample is either ahead of close()'s
+        # sentinel or refused
+        with self._lock:
+            if self._closed:
+                raise BatcherClosed("The micro-batcher is closed")
+            self._queue.put((sample, future))
+        return future.result(timeout=self.timeout)
+
+    def close(self):
+        """Stop the worker once the samples queued so far have been answered"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._worker is not None and self._worker_pid == os.getpid():
+                self._queue.put(None)
+
+    def _fail_queued(self):
+        # Nothing should follow the sentinel, but never leave a caller waiting
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[1].set_exception(BatcherClosed("The micro-batcher is closed"))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._fail_queued()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._flush(batch)
+                    self._fail_queued()
+                    return
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch):
+        futures = [future for _, future in batch]
+        try:
+            inputs = self.collate([sample for sample, _ in batch])
+            outputs = self.predict_fn(inputs)
+        except Exception as e:
+            with self._lock:
+                self._errors += 1
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        size = len(batch)
+        with self._lock:
+            self._batches += 1
+            self._items += size
+            self._size_histogram[size] = self._size_histogram.get(size, 0) + 1
+            if size >= self.max_batch_size:
+                self._full_flushes += 1
+            else:
+                self._timeout_flushes += 1
+
+        for future, row in zip(futures, outputs):
+            future.set_result(row)
+
+    def stats(self):
+        """Return batch fill metrics collected since start-up"""
+        with self._lock:
+            mean_size = self._items / self._batches if self._batches else 0.0
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batches': self._batches,
+                'items': self._items,
+                'mean_batch_size': mean_size,
+                'fill_ratio': mean_size / self.max_batch_size,
+                'full_flushes': self._full_flushes,
+                'timeout_flushes': self._timeout_flushes,
+                'errors': self._errors,
+                'batch_size_histogram': dict(sorted(self._size_histogram.items())),
+                'queue_depth': self._queue.qsize(),
+            }
+
 
 class RetinopathyDetector:
-    def __init__(self):
+    def __init__(self, local=None, batching=None, tf_threads=None, model=None):
         self.input_size = (224, 224)
         self.model = None
         self.class_names = ['No DR', 'Mild', 'Moderate', 'Severe', 'Proliferative DR']
+        self.batcher = None
+        self.client = None
+        self.backend = None
+        self.model_version = None
+        self.cache = build_prediction_cache()
+        # Per-thread uint8 staging and float32 batch buffers for preprocessing
+        self._buffers = threading.local()
+        # The registry ModelVersion to load, else the active one; None means MODEL_PATH
+        self.registry_model = model or model_registry.active()
+        # Views averaged per image by test-time augmentation; 1 turns it off
+        self.tta_views = int(getattr(settings, 'INFERENCE_TTA_VIEWS', 1) or 1)
+        self.tta_degrees = float(getattr(settings, 'INFERENCE_TTA_DEGREES', 10.0))
+        view_transforms(self.tta_views)
+        if local is None:
+            local = not server_address()
+        if batching is None:
+            batching = getattr(settings, 'INFERENCE_BATCHING', True)
+
+        if not local:
+            # The model lives in the shared inference server process
+            self.client = InferenceClient()
+            self.model_version = self.registry_model.version if self.registry_model else model_fingerprint()
+            return
+
+        if getattr(settings, 'INFERENCE_BACKEND', 'keras') not in CONVERTED_SUFFIXES:
+            # Only Keras runs on TF; TFLite and ONNX set INFERENCE_*_OP_THREADS
+            # themselves, and importing TF for them would undo their savings
+            configure_tf_threads(*(tf_threads or ()))
         self.load_model()
+        if batching:
+            self.batcher = MicroBatcher(
+                self.predict_array,
+                max_batch_size=getattr(settings, 'INFERENCE_MAX_BATCH_SIZE', 8),
+                max_wait_ms=getattr(settings, 'INFERENCE_MAX_WAIT_MS', 5),
+                timeout=getattr(settings, 'INFERENCE_BATCH_TIMEOUT_SECONDS', 30.0),
+            )
     
     def load_model(self):
-        """Load the pre-trained model"""
-        try:
-            model_path = settings.MODEL_PATH
-            if os.path.exists(model_path):
-                self.model = load_model(model_path)
-            else:
-                # Load a placeholder model (in production, you would have a trained model)
-                self.model = self.create_placeholder_model()
-        except Exception as e:
-            print(f"Error loading model: {e}")
-            self.model = self.create_placeholder_model()
-    
+        """Load the pre-trained model with the configured inference backend"""
+        started = time.perf_counter()
+        model_path = settings.MODEL_PATH
+        backend = getattr(settings, 'INFERENCE_BACKEND', 'keras')
+        if self.registry_model is not None:
+            # The model file, and the export this backend loads instead of it
+            model_registry.verify(self.registry_model, backends=[backend])
+            model_path = self.registry_model.path
+        self.backend = load_backend(backend, model_path, self.input_size)
+        if self.registry_model is not None:
+            if self.backend.version == 'placeholder':
+                # Never serve the placeholder in place of a registered model
+                raise ModelIntegrityError(f"Model version {self.registry_model.version} could not be loaded")
+            self.backend.version = self.registry_model.version
+        self.model = getattr(self.backend, 'model', None)
+        self.model_version = self.backend.version
+        model_load_seconds.set(
+            time.perf_counter() - started, backend=self.backend.name, version=self.model_version
+        )
+
     def create_placeholder_model(self):
         """Create a simple placeholder model for demonstration"""
-        model = tf.keras.Sequential([
-            tf.keras.layers.Flatten(input_shape=(224, 224, 3)),
-            tf.keras.layers.Dense(128, activation='relu'),
-            tf.keras.layers.Dense(5, activation='softmax')
-        ])
-        return model
-    
-    def preprocess_image(self, img,enhance=True):
-        if isinstance(img, bytes):
-            img = Image.open(io.BytesIO(img))
+        return create_placeholder_model(self.input_size)
 
-        # Force RGB
-        img = img.convert('RGB')
+    def preprocess_image(self, img,enhance=True, reuse_buffers=False):
+        """Preprocess one image into a (1, 224, 224, 3) float32 batch"""
+        return self.preprocess_images([img], enhance=enhance, reuse_buffers=reuse_buffers)
 
-        img = img.resize(self.input_size)
-        if enhance:
-            img = ImageOps.autocontrast(img)
-            img = ImageOps.equalize(img)
+    def preprocess_images(self, images, enhance=True, out=None, reuse_buffers=False):
+        """Preprocess several images into one (N, 224, 224, 3) float32 batch
 
-        img_array = image.img_to_array(img)
-        img_array = np.expand_dims(img_array, axis=0)
-        img_array /= 255.0
+        With ``reuse_buffers`` the batch is written into this thread's buffers,
+        so it is only valid until the thread preprocesses again.
+        """
+        staging = None
+        if reuse_buffers and out is None:
+            staging, out = self._batch_buffers(len(images))
+        return preprocess_batch(
+            images,
+            size=self.input_size,
+            enhance=enhance,
+            out=out,
+            oversample=getattr(settings, 'PREPROCESS_DECODE_OVERSAMPLE', 2.0),
+            staging=staging,
+        )
 
-        return img_array
+    def _batch_buffers(self, n):
+        """This thread's (staging, out) buffers, grown to hold at least n images"""
+        buffers = getattr(self._buffers, 'arrays', None)
+        if buffers is None or buffers[0].shape[0] < n:
+            width, height = self.input_size
+            shape = (n, height, width, 3)
+            buffers = (np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.float32))
+            self._buffers.arrays = buffers
+        return buffers
 
+    @property
+    def prediction_version(self):
+        """Model version plus the TTA views, which both change the output"""
+        if self.tta_views > 1:
+            return f"{self.model_version}+tta{self.tta_views}"
+        return self.model_version
+
+    def predict_array(self, batch):
+        """Run the model on an already preprocessed (N, 224, 224, 3) batch
+
+        With test-time augmentation all views of all images go through one
+        model call, and each returned row is the mean over an image's views.
+        """
+        if self.tta_views > 1:
+            with stage('augment'):
+                batch = augment_batch(batch, self.tta_views, self.tta_degrees)
+        inference_batch_size.observe(len(batch))
+        outputs = self.backend.predict(batch)
+        if self.tta_views > 1:
+            outputs = average_views(outputs, self.tta_views)
+        return outputs
+
+    def decode_prediction(self, probabilities):
+        """Turn one row of softmax output into (class_name, confidence)"""
+        predicted_class = np.argmax(probabilities)
+        confidence = np.max(probabilities)
+        return self.class_names[predicted_class], float(confidence)
 
-    
     def predict(self, image_data):
-        """Make prediction on the image"""
+        """Make prediction on the image
+
+        ``image_data`` is raw bytes, or a DecodedUpload whose decoded image
+        and digest are used instead of decoding and hashing the bytes again.
+        """
         try:
-            # Preprocess the image
-            processed_image = self.preprocess_image(image_data)
-            
-            # Make prediction
-            predictions = self.model.predict(processed_image)
-            predicted_class = np.argmax(predictions[0])
-            confidence = np.max(predictions[0])
-            
-            return self.class_names[predicted_class], float(confidence)
+            upload = None
+            if isinstance(image_data, DecodedUpload):
+                upload, image_data = image_data, image_data.data
+
+            # Repeated uploads of the same bytes are answered from the cache
+            cache_key = None
+            if self.cache is not None and isinstance(image_data, (bytes, bytearray)):
+                cache_key = self.cache.make_key(
+                    image_data, self.prediction_version, digest=upload.digest if upload else None
+                )
+                with stage('cache'):
+                    cached = self.cache.get(cache_key)
+                if cached is not None:
+                    return cached
+
+            if self.client is not None:
+                with stage('inference'):
+                    result = self.client.predict(image_data)
+            else:
+                # Preprocess the image
+                processed_image = self.preprocess_image(upload.image if upload else image_data, reuse_buffers=True)
+
+                # Make prediction, sharing a model call with concurrent requests
+                with stage('inference'):
+                    probabilities = None
+                    if self.batcher is not None:
+                        try:
+                            probabilities = self.batcher.submit(processed_image[0])
+                        except BatcherClosed:
+                            # A reload swapped this detector out; finish on its model
+                            pass
+                    if probabilities is None:
+                        probabilities = self.predict_array(processed_image)[0]
+                result = self.decode_prediction(probabilities)
+
+            if cache_key is not None and result[0] != "Error":
+                self.cache.set(cache_key, result)
+            return result
         except Exception as e:
             print(f"Error during prediction: {e}")
+            errors_total.inc(where='inference')
             return "Error", 0.0
 
-# Global instance of the detector
-detector = RetinopathyDetector()
\ No newline at end of file
+    def predict_with_version(self, image_data):
+        """predict() plus the version that produced the result, to record on the test"""
+        result, confidence = self.predict(image_data)
+        return result, confidence, self.prediction_version
+
+    def predict_batch(self, images):
+        """Predict a list of images with a single model call"""
+        if not images:
+            return []
+        if self.client is not None:
+            return self.client.predict_batch(images)
+        processed = self.preprocess_images(images, reuse_buffers=True)
+        return [self.decode_prediction(row) for row in self.predict_array(processed)]
+
+    def close(self):
+        """Release the batching thread once in-flight predictions are done"""
+        if self.batcher is not None:
+            self.batcher.close()
+
+    def batch_stats(self):
+        """Batch fill metrics of the micro-batcher, or None when batching is off"""
+        return self.batcher.stats() if self.batcher is not None else None
+
+    def cache_stats(self):
+        """Prediction cache counters, or None when the cache is off"""
+        return self.cache.stats() if self.cache is not None else None
+
+    def warm_up(self, batch_sizes=None):
+        """Run dummy batches so the first real request does not pay for graph building"""
+        if self.client is not None:
+            self.client.ping()
+            return
+        if batch_sizes is None:
+            max_batch_size = self.batcher.max_batch_size if self.batcher is not None else 1
+            batch_sizes = range(1, max_batch_size + 1)
+        for size in batch_sizes:
+            self.predict_array(np.zeros((size,) + self.input_size + (3,), dtype=np.float32))
+
+
+class LazyDetector:
+    """Stand-in for the global detector that builds it on first use.
+
+    Importing this module does not import TensorFlow or load the model, so
+    management commands such as ``migrate`` or ``collectstatic`` stay fast.
+    Once loaded, a model registry watcher swaps in new model versions.
+    """
+
+    def __init__(self, factory=RetinopathyDetector, watch=True):
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._watcher = build_model_watcher(self) if watch else None
+
+    @property
+    def is_loaded(self):
+        return self._instance is not None
+
+    def get(self):
+        """Return the real detector, creating it if needed"""
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        if self._watcher is not None:
+            self._watcher.ensure_started()
+        return self._instance
+
+    def reload(self, model=None):
+        """Load a detector for ``model`` next to the current one and swap it in
+
+        Callers that already hold the old detector finish on it; the old
+        micro-batcher stops after answering what was queued.
+        """
+        with self._reload_lock:
+            new = self._factory(model=model)
+            if getattr(settings, 'INFERENCE_WARMUP', True):
+                new.warm_up(getattr(settings, 'INFERENCE_WARMUP_BATCH_SIZES', None))
+            old, self._instance = self._instance, new
+        if old is not None:
+            old.close()
+        return new
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+# Global instance of the detector, loaded on first use
+detector = LazyDetector()
+
+
+def warm_up_detector():
+    """Load the model and warm it up when INFERENCE_WARMUP is enabled"""
+    if not getattr(settings, 'INFERENCE_WARMUP', True):
+        return
+    started = time.monotonic()
+    detector.warm_up(getattr(settings, 'INFERENCE_WARMUP_BATCH_SIZES', None))
+    print(f"Detector warmed up in {time.monotonic() - started:.2f}s")
+
+
+def _detector_metrics():
+    """Micro-batcher and prediction cache counters of the loaded detector"""
+    if not detector.is_loaded:
+        return []
+    lines = []
+    for prefix, stats in (('dr_batcher', detector.batch_stats()), ('dr_prediction_cache', detector.cache_stats())):
+        for key, value in (stats or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value}")
+    lines.append("# TYPE dr_model_info gauge")
+    lines.append(f'dr_model_info{{version="{detector.prediction_version}"}} 1')
+    watcher = detector._watcher
+    if watcher is not None:
+        for key in ('reloads', 'failures'):
+            lines.append(f"# TYPE dr_model_{key} counter")
+            lines.append(f"dr_model_{key} {getattr(watcher, key)}")
+    return lines
+
+
+registry.add_collector(_detector_metrics)
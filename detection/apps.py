@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class DetectionConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'detection'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from .db import configure_sqlite
+        from .recommendations import connect_signals
+        connect_signals()
+        connection_created.connect(configure_sqlite, dispatch_uid='detection-configure-sqlite')
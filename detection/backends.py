@@ -0,0 +1,260 @@
+"""
+Inference backends for the retinopathy model.
+
+``INFERENCE_BACKEND`` selects how the model at ``MODEL_PATH`` is run:
+
+* ``keras`` - the HDF5 model itself, through a traced tf.function
+* ``tflite-float16`` / ``tflite-int8`` - post-training quantized TFLite
+  models, run by ``tflite_runtime`` when installed, else by ``tf.lite``
+* ``onnx`` - an ONNX export run by ONNX Runtime
+
+The converted files live next to the HDF5 model and are produced by
+``manage.py convert_model``. Every backend takes a preprocessed float32
+(N, 224, 224, 3) batch and returns float32 softmax scores.
+"""
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .prediction_cache import model_fingerprint
+
+CONVERTED_SUFFIXES = {
+    'tflite-float16': '.float16.tflite',
+    'tflite-int8': '.int8.tflite',
+    'onnx': '.onnx',
+}
+
+
+def converted_model_path(backend, model_path=None):
+    """Where convert_model writes the model for a non-Keras backend"""
+    model_path = model_path or settings.MODEL_PATH
+    return os.path.splitext(model_path)[0] + CONVERTED_SUFFIXES[backend]
+
+
+def create_placeholder_model(input_size=(224, 224)):
+    """Create a simple placeholder model for demonstration"""
+    import tensorflow as tf
+
+    model = tf.keras.Sequential([
+        tf.keras.layers.Flatten(input_shape=input_size + (3,)),
+        tf.keras.layers.Dense(128, activation='relu'),
+        tf.keras.layers.Dense(5, activation='softmax')
+    ])
+    return model
+
+
+class KerasBackend:
+    name = 'keras'
+
+    def __init__(self, model_path, input_size=(224, 224)):
+        self.model_path = model_path
+        self.input_size = input_size
+        self.model = None
+        self.infer_fn = None
+        self.version = None
+
+    def load(self):
+        from tensorflow.keras.models import load_model # type: ignore
+
+        try:
+            if os.path.exists(self.model_path):
+                self.model = load_model(self.model_path)
+                self.version = model_fingerprint(self.model_path)
+            else:
+                # Load a placeholder model (in production, you would have a trained model)
+                self.model = create_placeholder_model(self.input_size)
+                self.version = 'placeholder'
+        except Exception as e:
+            print(f"Error loading model: {e}")
+            self.model = create_placeholder_model(self.input_size)
+            self.version = 'placeholder'
+
+        self.model = self.apply_precision(self.model, getattr(settings, 'INFERENCE_PRECISION', 'float32'))
+        if getattr(settings, 'INFERENCE_COMPILED', True):
+            self.infer_fn = self.compile_model(self.model, jit=getattr(settings, 'INFERENCE_XLA', False))
+        else:
+            self.infer_fn = None
+        return self
+
+    def apply_precision(self, model, precision):
+        """Rebuild the model with a mixed-precision dtype policy (e.g. 'mixed_bfloat16')"""
+        if not precision or precision == 'float32':
+            return model
+        import tensorflow as tf
+
+        def clone_layer(layer):
+            config = layer.get_config()
+            config['dtype'] = precision
+            return layer.__class__.from_config(config)
+
+        try:
+            mixed = tf.keras.models.clone_model(model, clone_function=clone_layer)
+            mixed.set_weights(model.get_weights())
+            return mixed
+        except Exception as e:
+            print(f"Could not switch model to {precision}, keeping float32: {e}")
+            return model
+
+    def compile_model(self, model, jit=False):
+        """Trace the model once for (None, 224, 224, 3) float32 inputs, optionally with XLA"""
+        import tensorflow as tf
+
+        signature = [tf.TensorSpec((None,) + self.input_size + (3,), tf.float32)]
+
+        @tf.function(input_signature=signature, jit_compile=bool(jit))
+        def infer(batch):
+            return tf.cast(model(batch, training=False), tf.float32)
+
+        return infer
+
+    def predict(self, batch):
+        if self.infer_fn is not None:
+            return self.infer_fn(np.asarray(batch, dtype=np.float32)).numpy()
+        return np.asarray(self.model.predict(batch, verbose=0))
+
+
+class TFLiteBackend:
+    name = 'tflite'
+
+    def __init__(self, model_path, input_size=(224, 224)):
+        self.model_path = model_path
+        self.input_size = input_size
+        self.interpreter = None
+        self.version = None
+        self._batch_size = None
+        # A TFLite interpreter must not be invoked from two threads at once
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        threads = getattr(settings, 'INFERENCE_INTRA_OP_THREADS', 0) or None
+        self.interpreter = Interpreter(model_path=self.model_path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = int(self._input['shape'][0])
+        self.version = f"{os.path.basename(self.model_path)}:{model_fingerprint(self.model_path)}"
+        return self
+
+    def _resize(self, batch_size):
+        if batch_size != self._batch_size:
+            self.interpreter.resize_tensor_input(
+                self._input['index'], [batch_size] + list(self._input['shape'][1:])
+            )
+            self.interpreter.allocate_tensors()
+            self._input = self.interpreter.get_input_details()[0]
+            self._output = self.interpreter.get_output_details()[0]
+            self._batch_size = batch_size
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        with self._lock:
+            self._resize(len(batch))
+            scale, zero_point = self._input['quantization']
+            if self._input['dtype'] != np.float32 and scale:
+                batch = np.round(batch / scale + zero_point).astype(self._input['dtype'])
+            self.interpreter.set_tensor(self._input['index'], batch)
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self._output['index'])
+            scale, zero_point = self._output['quantization']
+        if output.dtype != np.float32:
+            output = (output.astype(np.float32) - zero_point) * (scale or 1.0)
+        return output
+
+
+class ONNXBackend:
+    name = 'onnx'
+
+    def __init__(self, model_path, input_size=(224, 224)):
+        self.model_path = model_path
+        self.input_size = input_size
+        self.session = None
+        self.version = None
+
+    def load(self):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        intra_op = getattr(settings, 'INFERENCE_INTRA_OP_THREADS', 0)
+        inter_op = getattr(settings, 'INFERENCE_INTER_OP_THREADS', 0)
+        if intra_op:
+            options.intra_op_num_threads = int(intra_op)
+        if inter_op:
+            options.inter_op_num_threads = int(inter_op)
+        self.session = onnxruntime.InferenceSession(
+            self.model_path, options, providers=['CPUExecutionProvider']
+        )
+        self._input_name = self.session.get_inputs()[0].name
+        self.version = f"{os.path.basename(self.model_path)}:{model_fingerprint(self.model_path)}"
+        return self
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        return np.asarray(self.session.run(None, {self._input_name: batch})[0], dtype=np.float32)
+
+
+def load_backend(name=None, model_path=None, input_size=(224, 224)):
+    """Load the configured backend, falling back to Keras if it is unavailable"""
+    name = name or getattr(settings, 'INFERENCE_BACKEND', 'keras')
+    model_path = model_path or settings.MODEL_PATH
+    if name == 'keras':
+        return KerasBackend(model_path, input_size).load()
+
+    if name not in CONVERTED_SUFFIXES:
+        print(f"Unknown inference backend {name!r}, using keras")
+        return KerasBackend(model_path, input_size).load()
+
+    path = converted_model_path(name, model_path)
+    backend_class = ONNXBackend if name == 'onnx' else TFLiteBackend
+    try:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found, run manage.py convert_model")
+        return backend_class(path, input_size).load()
+    except Exception as e:
+        print(f"Error loading {name} backend: {e}")
+        return KerasBackend(model_path, input_size).load()
+
+
+def export_tflite(keras_backend, output_path, quantization='float16', calibration=None):
+    """Convert a loaded KerasBackend to a post-training quantized TFLite file.
+
+    ``quantization`` is 'float16' or 'int8'; int8 needs ``calibration``, a
+    float32 (N, 224, 224, 3) array of preprocessed representative images.
+    Inputs and outputs stay float32 so the serving code does not change.
+    """
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_backend.model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if calibration is None or not len(calibration):
+            raise ValueError("int8 quantization needs calibration images")
+        converter.representative_dataset = lambda: ([sample[np.newaxis]] for sample in calibration)
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    else:
+        raise ValueError(f"Unknown TFLite quantization {quantization!r}")
+
+    flatbuffer = converter.convert()
+    with open(output_path, 'wb') as f:
+        f.write(flatbuffer)
+    return output_path
+
+
+def export_onnx(keras_backend, output_path, opset=13):
+    """Convert a loaded KerasBackend to ONNX (needs the tf2onnx package)"""
+    import tensorflow as tf
+    import tf2onnx
+
+    infer = keras_backend.compile_model(keras_backend.model)
+    signature = (tf.TensorSpec((None,) + keras_backend.input_size + (3,), tf.float32),)
+    tf2onnx.convert.from_function(infer, input_signature=signature, opset=opset, output_path=output_path)
+    return output_path
@@ -0,0 +1,480 @@
+"""
+Benchmarks for the detection pipeline.
+
+Run them with ``manage.py benchmark_detection``. Every benchmark uses
+deterministic synthetic fundus-like images so results can be compared
+between commits.
+"""
+import base64
+import io
+import os
+import statistics
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+from django.test import override_settings
+from PIL import Image
+
+from .preprocessing import PARITY_TOLERANCE, load_resized, preprocess_batch, reference_preprocess
+
+
+def synthetic_fundus(width, height, seed=0):
+    """A reproducible fundus-like RGB image: a lit disc with vessels on black"""
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[:height, :width]
+    cx, cy = width / 2, height / 2
+    radius = min(width, height) * 0.45
+    dist = np.sqrt((x - cx) ** 2 + (y - cy) ** 2) / radius
+
+    disc = np.clip(1.0 - dist ** 2, 0, 1)
+    img = np.zeros((height, width, 3), dtype=np.float32)
+    img[..., 0] = 200 * disc + 30 * disc ** 4
+    img[..., 1] = 90 * disc
+    img[..., 2] = 40 * disc
+
+    # Optic disc and a few dark vessels radiating from it
+    ox, oy = cx + radius * 0.35, cy
+    optic = np.exp(-(((x - ox) ** 2 + (y - oy) ** 2) / (2 * (radius * 0.08) ** 2)))
+    img += 55 * optic[..., None]
+    angle = np.arctan2(y - oy, x - ox)
+    for theta in rng.uniform(-np.pi, np.pi, size=8):
+        vessel = np.abs(np.sin(angle - theta)) < 0.02 + 0.01 * rng.random()
+        img[vessel & (disc > 0)] *= 0.6
+
+    img += rng.normal(0, 4, size=img.shape)
+    return Image.fromarray(np.clip(img, 0, 255).astype(np.uint8))
+
+
+def encode_image(img, fmt='JPEG'):
+    """Encode a PIL image to bytes in the given format"""
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def time_call(fn, repeat=10, warmup=1):
+    """Time fn() and return latency statistics in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000.0)
+    samples.sort()
+    return {
+        'repeat': repeat,
+        'mean_ms': statistics.fmean(samples),
+        'median_ms': statistics.median(samples),
+        'p95_ms': samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+        'min_ms': samples[0],
+    }
+
+
+def bench_preprocess(resolutions=((512, 512), (1536, 1536)), batch_size=8, fmt='JPEG', repeat=10):
+    """Compare the per-image PIL pipeline with the batched NumPy pipeline"""
+    results = []
+    for width, height in resolutions:
+        images = [encode_image(synthetic_fundus(width, height, seed=i), fmt) for i in range(batch_size)]
+        out = np.empty((batch_size, 224, 224, 3), dtype=np.float32)
+
+        reference = time_call(lambda: [reference_preprocess(img) for img in images], repeat)
+        batched = time_call(lambda: preprocess_batch(images, out=out), repeat)
+
+        # The same two pipelines on already decoded images at model size, to
+        # separate the enhancement and copy work from JPEG decoding
+        decoded = [Image.open(io.BytesIO(img)).convert('RGB').resize((224, 224)) for img in images]
+        reference_decoded = time_call(lambda: [reference_preprocess(img) for img in decoded], repeat)
+        batched_decoded = time_call(lambda: preprocess_batch(decoded, out=out), repeat)
+
+        expected = np.concatenate([reference_preprocess(img) for img in images])
+        max_error = float(np.abs(preprocess_batch(images) - expected).max())
+        results.append({
+            'resolution': f"{width}x{height}",
+            'format': fmt,
+            'batch_size': batch_size,
+            'reference': reference,
+            'batched': batched,
+            'speedup': reference['median_ms'] / batched['median_ms'],
+            'reference_decoded': reference_decoded,
+            'batched_decoded': batched_decoded,
+            'speedup_decoded': reference_decoded['median_ms'] / batched_decoded['median_ms'],
+            'max_abs_error': max_error,
+            'within_tolerance': max_error <= PARITY_TOLERANCE,
+        })
+    return results
+
+
+def bench_decode(resolutions=((1024, 1024), (3000, 3000), (4500, 3000)), formats=('JPEG', 'PNG'),
+                 oversample=2.0, repeat=5):
+    """Compare full-resolution decode + resize with the reduced-scale decode"""
+    results = []
+    for width, height in resolutions:
+        source = synthetic_fundus(width, height)
+        for fmt in formats:
+            data = encode_image(source, fmt)
+            full = time_call(lambda: load_resized(data), repeat)
+            reduced = time_call(lambda: load_resized(data, oversample=oversample), repeat)
+            expected = preprocess_batch([data])
+            actual = preprocess_batch([data], oversample=oversample)
+            results.append({
+                'resolution': f"{width}x{height}",
+                'format': fmt,
+                'oversample': oversample,
+                'full_decode': full,
+                'reduced_decode': reduced,
+                'speedup': full['median_ms'] / reduced['median_ms'],
+                'mean_abs_error': float(np.abs(actual - expected).mean()),
+            })
+    return results
+
+
+INFERENCE_MODES = {
+    'keras_predict': {'INFERENCE_COMPILED': False},
+    'compiled': {'INFERENCE_COMPILED': True, 'INFERENCE_XLA': False},
+    'compiled_xla': {'INFERENCE_COMPILED': True, 'INFERENCE_XLA': True},
+    'compiled_bfloat16': {'INFERENCE_COMPILED': True, 'INFERENCE_PRECISION': 'mixed_bfloat16'},
+}
+
+
+def bench_inference(modes=INFERENCE_MODES, batch_sizes=(1, 8), repeat=20):
+    """Per-image model latency for each inference mode, excluding preprocessing"""
+    from .ai_model import RetinopathyDetector
+
+    results = []
+    for name, overrides in modes.items():
+        options = {'INFERENCE_PRECISION': 'float32', 'INFERENCE_XLA': False, **overrides}
+        with override_settings(**options):
+            detector = RetinopathyDetector(local=True, batching=False)
+        for batch_size in batch_sizes:
+            batch = detector.preprocess_images([synthetic_fundus(512, 512, seed=i) for i in range(batch_size)])
+            timing = time_call(lambda: detector.predict_array(batch), repeat, warmup=2)
+            results.append({
+                'mode': name,
+                'batch_size': batch_size,
+                'model_version': detector.model_version,
+                'latency': timing,
+                'per_image_ms': timing['median_ms'] / batch_size,
+            })
+    return results
+
+
+def backend_parity_report(reference, candidates, batch, latency_repeat=20):
+    """Compare candidate backends with the reference (Keras) backend on a preprocessed batch"""
+    expected = np.concatenate([reference.predict(batch[i:i + 8]) for i in range(0, len(batch), 8)])
+    single = batch[:1]
+
+    def summarize(backend, outputs, path=None):
+        diff = np.abs(outputs - expected)
+        return {
+            'backend': getattr(backend, 'name', type(backend).__name__),
+            'version': backend.version,
+            'file_size_mb': os.path.getsize(path) / 1e6 if path and os.path.exists(path) else None,
+            'top1_agreement': float(np.mean(outputs.argmax(axis=1) == expected.argmax(axis=1))),
+            'max_abs_diff': float(diff.max()),
+            'mean_abs_diff': float(diff.mean()),
+            'latency_batch1': time_call(lambda: backend.predict(single), latency_repeat, warmup=2),
+        }
+
+    report = [summarize(reference, expected, getattr(reference, 'model_path', None))]
+    for backend in candidates:
+        outputs = np.concatenate([backend.predict(batch[i:i + 8]) for i in range(0, len(batch), 8)])
+        report.append(summarize(backend, outputs, backend.model_path))
+    return report
+
+
+SUITE_RESOLUTIONS = ((512, 512), (1024, 1024), (2048, 1536))
+SUITE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+
+def _suite_images(resolution, fmt, count, seed=0):
+    width, height = resolution
+    return [encode_image(synthetic_fundus(width, height, seed=seed + i), fmt) for i in range(count)]
+
+
+def _each(fn, items):
+    """A no-argument callable for time_call that passes fn the next item on every call"""
+    iterator = iter(items)
+    return lambda: fn(next(iterator))
+
+
+def placeholder_detector():
+    """A local detector running the untrained placeholder model, with no cache or batching"""
+    from .ai_model import RetinopathyDetector
+
+    with override_settings(MODEL_PATH=os.devnull + '.missing', MODEL_REGISTRY_DIR=os.devnull + '.missing',
+                           INFERENCE_BACKEND='keras', PREDICTION_CACHE=False, INFERENCE_PRECISION='float32'):
+        return RetinopathyDetector(local=True, batching=False)
+
+
+@contextmanager
+def serving_detector(detector):
+    """Temporarily make the views use the given detector"""
+    from .ai_model import detector as global_detector
+
+    previous = global_detector._instance
+    global_detector._instance = detector
+    try:
+        yield detector
+    finally:
+        global_detector._instance = previous
+
+
+@contextmanager
+def admission_disabled():
+    """Turn admission control off, so load runs measure the views instead of shedding"""
+    from . import admission
+
+    previous = admission.admission
+    try:
+        with override_settings(ADMISSION_MAX_IN_FLIGHT=0):
+            admission.admission = admission.build_admission_controller()
+        yield
+    finally:
+        admission.admission = previous
+
+
+@contextmanager
+def benchmark_country():
+    """A throwaway country; tests created while it exists are deleted afterwards"""
+    from .models import Country, RetinopathyTest
+    from .thumbnails import delete_thumbnails
+
+    country = Country.objects.create(name='Benchmark', code='ZZBEN', common_foods='-')
+    first_id = RetinopathyTest.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    try:
+        yield country
+    finally:
+        created = RetinopathyTest.objects.filter(id__gt=first_id)
+        for test in created.exclude(image=''):
+            name = test.image.name
+            test.image.delete(save=False)
+            delete_thumbnails(name)
+        created.delete()
+        country.delete()
+
+
+def bench_preprocess_image(detector, resolutions=SUITE_RESOLUTIONS, formats=SUITE_FORMATS, repeat=10):
+    """RetinopathyDetector.preprocess_image on encoded images of each size and format"""
+    results = []
+    for resolution in resolutions:
+        for fmt in formats:
+            images = _suite_images(resolution, fmt, 4)
+            timing = time_call(_each(detector.preprocess_image, images * (repeat + 1)), repeat)
+            results.append({
+                'name': f"preprocess_image/{fmt}/{resolution[0]}x{resolution[1]}",
+                'bytes': sum(map(len, images)) // len(images),
+                'latency': timing,
+            })
+    return results
+
+
+def bench_predict(detector, resolutions=SUITE_RESOLUTIONS, formats=SUITE_FORMATS, repeat=10):
+    """RetinopathyDetector.predict (decode, preprocess and model) for one image at a time"""
+    detector.warm_up()
+    results = []
+    for resolution in resolutions:
+        for fmt in formats:
+            images = _suite_images(resolution, fmt, 4)
+            timing = time_call(_each(detector.predict, images * (repeat + 1)), repeat)
+            results.append({
+                'name': f"predict/{fmt}/{resolution[0]}x{resolution[1]}",
+                'model_version': detector.model_version,
+                'latency': timing,
+            })
+    return results
+
+
+def bench_tta(detector, views=(1, 2, 4, 8), batch_sizes=(1, 8), repeat=10):
+    """Model latency with test-time augmentation against the single-view path.
+
+    ``augment_ms`` is the time spent building the views alone, and
+    ``overhead`` the slowdown relative to one view at the same batch size.
+    ``top1_agreement`` is the share of images whose class matches the
+    single-view prediction.
+    """
+    from .tta import augment_batch
+
+    previous = detector.tta_views
+    results = []
+    try:
+        for batch_size in batch_sizes:
+            batch = detector.preprocess_images([synthetic_fundus(512, 512, seed=i) for i in range(batch_size)])
+            detector.tta_views = 1
+            baseline = detector.predict_array(batch)
+            baseline_ms = None
+            for count in views:
+                detector.tta_views = count
+                timing = time_call(lambda: detector.predict_array(batch), repeat, warmup=2)
+                baseline_ms = baseline_ms or timing['median_ms']
+                outputs = detector.predict_array(batch)
+                results.append({
+                    'name': f"tta/{count}_views/batch{batch_size}",
+                    'views': count,
+                    'batch_size': batch_size,
+                    'latency': timing,
+                    'augment_ms': time_call(lambda: augment_batch(batch, count, detector.tta_degrees), repeat)['median_ms'],
+                    'overhead': timing['median_ms'] / baseline_ms,
+                    'top1_agreement': float(np.mean(outputs.argmax(axis=1) == baseline.argmax(axis=1))),
+                })
+    finally:
+        detector.tta_views = previous
+    return results
+
+
+def bench_detect_endpoint(detector, resolutions=SUITE_RESOLUTIONS, formats=SUITE_FORMATS, repeat=10):
+    """A full AJAX POST to /detect/ through the test client for every upload path.
+
+    ``upload`` is the file form field, ``capture`` the binary camera blob and
+    ``base64`` the legacy camera data URL. Every request sends a new image, so
+    the prediction cache never answers.
+    """
+    from django.test import Client
+    from django.urls import reverse
+
+    client = Client()
+    url = reverse('detect_retinopathy')
+    headers = {'X-Requested-With': 'XMLHttpRequest'}
+    mime = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+    seed = 0
+
+    def file_field(field, data, name):
+        f = io.BytesIO(data)
+        f.name = name
+        return {field: f}
+
+    payloads = {
+        'upload': lambda data, ext, fmt: file_field('image', data, f"bench.{ext}"),
+        'capture': lambda data, ext, fmt: file_field('capture', data, f"capture.{ext}"),
+        'base64': lambda data, ext, fmt: {
+            'image_data': f"data:{mime[fmt]};base64,{base64.b64encode(data).decode()}",
+        },
+    }
+
+    results = []
+    overrides = override_settings(ALLOWED_HOSTS=['testserver'], THUMBNAILS_ON_UPLOAD=False)
+    with serving_detector(detector), benchmark_country() as country, overrides:
+        detector.warm_up()
+        for resolution in resolutions:
+            for fmt in formats:
+                ext = fmt.lower().replace('jpeg', 'jpg')
+                for path, payload in payloads.items():
+                    seed += repeat + 1
+                    images = _suite_images(resolution, fmt, repeat + 1, seed=seed)
+                    statuses = []
+
+                    def post(data):
+                        response = client.post(url, {'country': country.id, **payload(data, ext, fmt)}, headers=headers)
+                        statuses.append(response.status_code)
+
+                    timing = time_call(_each(post, images), repeat)
+                    results.append({
+                        'name': f"detect/{path}/{fmt}/{resolution[0]}x{resolution[1]}",
+                        'latency': timing,
+                        'errors': sum(status != 200 for status in statuses),
+                    })
+    return results
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """Median latency changes of named benchmarks between two result files.
+
+    Returns one row per benchmark present in both, flagged as a regression
+    when it got slower by more than ``threshold`` (a fraction).
+    """
+    def named(results):
+        entries = {}
+        for section in results.values():
+            if isinstance(section, list):
+                for entry in section:
+                    if isinstance(entry, dict) and 'name' in entry and 'latency' in entry:
+                        entries[entry['name']] = entry['latency']['median_ms']
+        return entries
+
+    before, after = named(baseline), named(current)
+    rows = []
+    for name in sorted(before.keys() & after.keys()):
+        change = after[name] / before[name] - 1.0 if before[name] else 0.0
+        rows.append({
+            'name': name,
+            'baseline_ms': before[name],
+            'current_ms': after[name],
+            'change': change,
+            'regression': change > threshold,
+        })
+    return rows
+
+
+def _detect_uploads(count, size=512):
+    return [encode_image(synthetic_fundus(size, size, seed=1000 + i), 'JPEG') for i in range(count)]
+
+
+def bench_wsgi_vs_asgi(requests=64, concurrency=32):
+    """Throughput of concurrent /detect/ uploads handled by the sync view with one
+    thread per in-flight request (the WSGI model) and by the async view on one
+    event loop (the ASGI model). Views are called with request factories, so
+    middleware is skipped in both runs, and admission control is off so no
+    request is shed to a 503 or a background job. Any response but 200 fails
+    the run with RuntimeError. Rows created here are deleted afterwards.
+    """
+    import asyncio
+    from concurrent.futures import ThreadPoolExecutor
+
+    from django.test import AsyncRequestFactory, RequestFactory
+
+    from . import views
+
+    # Separate images per run so the prediction cache cannot help the second one
+    uploads = _detect_uploads(requests * 2)
+    sync_uploads, async_uploads = uploads[:requests], uploads[requests:]
+    views.detector.warm_up()
+    headers = {'X-Requested-With': 'XMLHttpRequest'}
+
+    def upload(data):
+        f = io.BytesIO(data)
+        f.name = 'bench.jpg'
+        return {'image': f, 'country': country.id}
+
+    def post_sync(data):
+        request = RequestFactory().post('/detect/', upload(data), headers=headers)
+        return views.detect_retinopathy(request).status_code
+
+    async def run_async():
+        factory = AsyncRequestFactory()
+        limit = asyncio.Semaphore(concurrency)
+
+        async def post(data):
+            async with limit:
+                request = factory.post('/detect/', upload(data), headers=headers)
+                return (await views.adetect_retinopathy(request)).status_code
+
+        return await asyncio.gather(*(post(data) for data in async_uploads))
+
+    def summarize(name, statuses, elapsed, **extra):
+        failed = Counter(status for status in statuses if status != 200)
+        if failed:
+            raise RuntimeError(f"{name} load run failed: non-200 responses {dict(failed)}")
+        return {
+            'requests': requests,
+            'concurrency': concurrency,
+            'seconds': elapsed,
+            'requests_per_second': requests / elapsed,
+            **extra,
+        }
+
+    results = {}
+    with admission_disabled(), benchmark_country() as country:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            statuses = list(pool.map(post_sync, sync_uploads))
+        results['wsgi'] = summarize('WSGI', statuses, time.perf_counter() - started, threads=concurrency)
+
+        started = time.perf_counter()
+        statuses = asyncio.run(run_async())
+        results['asgi'] = summarize(
+            'ASGI', statuses, time.perf_counter() - started,
+            threads=views.inference_executor._max_workers,
+        )
+    return results
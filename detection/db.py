@@ -0,0 +1,232 @@
+"""
+Database tuning for concurrent uploads.
+
+``configure_sqlite`` runs on every new SQLite connection and applies the
+``SQLITE_PRAGMAS`` setting: WAL journaling lets readers run alongside the
+single writer, ``synchronous=NORMAL`` only syncs at checkpoints, and the
+busy timeout makes a writer wait for the lock instead of failing with
+"database is locked".
+
+``BufferedWriter`` goes further for the one write every detection does:
+requests hand their unsaved ``RetinopathyTest`` to a background thread,
+which inserts everything that arrived within ``DB_WRITE_BUFFER_WAIT_MS``
+(up to ``DB_WRITE_BUFFER_SIZE`` rows) in one transaction and hands each
+caller back its saved row with its primary key. A caller waits at most
+``DB_WRITE_BUFFER_TIMEOUT_SECONDS`` and then gets ``BufferedWriteTimeout``.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from django.conf import settings
+from django.db import close_old_connections, connections, models, transaction
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """connection_created hook applying SQLITE_PRAGMAS to SQLite connections"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+    with connection.cursor() as cursor:
+        for name, value in (pragmas or {}).items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+class BufferedWriteTimeout(RuntimeError):
+    """The write thread did not confirm a row in time; it may still be inserted"""
+
+
+class BufferedWriter:
+    """Insert model instances submitted from many threads in shared transactions"""
+
+    def __init__(self, max_batch_size=32, max_wait_ms=20.0, using='default', timeout=10.0):
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.using = using
+        self.timeout = timeout or None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker = None
+        self._worker_pid = None
+        self._closed = False
+        self._batches = 0
+        self._rows = 0
+        self._full_flushes = 0
+        self._timeout_flushes = 0
+        self._fallbacks = 0
+        self._errors = 0
+
+    def _ensure_worker(self):
+        # Started lazily and restarted after a fork, like MicroBatcher
+        pid = os.getpid()
+        if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._closed:
+                return
+            if self._worker is not None and self._worker_pid == pid and self._worker.is_alive():
+                return
+            if self._worker_pid != pid:
+                self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._run, name='dr-buffered-writer', daemon=True)
+            self._worker_pid = pid
+            self._worker.start()
+
+    def save(self, instance):
+        """Insert an unsaved instance through the buffer and return it with its pk set
+
+        Once the writer is closed, or inside the caller's transaction, the
+        instance is saved directly.
+        """
+        if self._closed or connections[self.using].in_atomic_block:
+            # The caller's transaction must see its own row; write it directly
+            instance.save(using=self.using)
+            return instance
+
+        # Store uploaded files here, so storage work and its errors stay with the caller
+        for field in instance._meta.concrete_fields:
+            if isinstance(field, models.FileField):
+                field.pre_save(instance, add=True)
+
+        future = Future()
+        self._ensure_worker()
+        # Queued under the lock, so a row is either ahead of close()'s sentinel
+        # or written directly
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._queue.put((instance, future))
+        if closed:
+            instance.save(using=self.using)
+            return instance
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise BufferedWriteTimeout(
+                f"The buffered writer did not save the {type(instance).__name__} within {self.timeout}s"
+            )
+
+    def close(self):
+        """Stop the write thread once the rows queued so far have been written"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._worker is not None and self._worker_pid == os.getpid():
+                self._queue.put(None)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                self._flush(batch)
+            finally:
+                close_old_connections()
+
+    def _insert(self, model, instances):
+        connection = connections[self.using]
+        with transaction.atomic(using=self.using):
+            if connection.features.can_return_rows_from_bulk_insert:
+                model.objects.using(self.using).bulk_create(instances)
+            else:
+                for instance in instances:
+                    instance.save(using=self.using, force_insert=True)
+
+    def _flush(self, batch):
+        by_model = {}
+        for instance, future in batch:
+            by_model.setdefault(type(instance), []).append((instance, future))
+
+        for model, items in by_model.items():
+            instances = [instance for instance, _ in items]
+            try:
+                self._insert(model, instances)
+            except Exception:
+                # Find the failing rows: save one by one so the rest still succeed
+                with self._lock:
+                    self._fallbacks += 1
+                for instance, future in items:
+                    try:
+                        instance.pk = None
+                        instance._state.adding = True
+                        instance.save(using=self.using, force_insert=True)
+                    except Exception as e:
+                        with self._lock:
+                            self._errors += 1
+                        future.set_exception(e)
+                    else:
+                        future.set_result(instance)
+                continue
+            for instance, future in items:
+                future.set_result(instance)
+
+        size = len(batch)
+        with self._lock:
+            self._batches += 1
+            self._rows += size
+            if size >= self.max_batch_size:
+                self._full_flushes += 1
+            else:
+                self._timeout_flushes += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'batches': self._batches,
+                'rows': self._rows,
+                'mean_batch_size': self._rows / self._batches if self._batches else 0.0,
+                'full_flushes': self._full_flushes,
+                'timeout_flushes': self._timeout_flushes,
+                'fallbacks': self._fallbacks,
+                'errors': self._errors,
+            }
+
+
+def build_test_writer():
+    """The buffered writer configured in settings, or None when it is disabled"""
+    if not getattr(settings, 'DB_WRITE_BUFFER', False):
+        return None
+    return BufferedWriter(
+        max_batch_size=getattr(settings, 'DB_WRITE_BUFFER_SIZE', 32),
+        max_wait_ms=getattr(settings, 'DB_WRITE_BUFFER_WAIT_MS', 20.0),
+        timeout=getattr(settings, 'DB_WRITE_BUFFER_TIMEOUT_SECONDS', 10.0),
+    )
+
+
+test_writer = build_test_writer()
+
+
+def save_test(test):
+    """Save a new RetinopathyTest, through the write buffer when it is enabled"""
+    if test_writer is None:
+        test.save()
+        return test
+    return test_writer.save(test)
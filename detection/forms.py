@@ -1,8 +1,35 @@
 from django import forms
 from .models import Country
+from .uploads import UploadRejected, decode_upload
+
+
+class DecodedImageField(forms.FileField):
+    """ImageField that decodes the upload once and keeps the result on it as ``decoded``
+
+    Django's ImageField opens and verifies the image, after which it would
+    be read and decoded again for inference; this field does the one
+    decode everything else reuses.
+    """
+    max_bytes = 10 * 1024 * 1024
+
+    def to_python(self, data):
+        f = super().to_python(data)
+        if f is None:
+            return None
+        # Checked before reading, so oversized files are never decoded
+        if f.size > self.max_bytes:
+            raise forms.ValidationError("Image file too large ( > 10MB )", code='too_large')
+        try:
+            if getattr(f, 'decoded', None) is None:
+                f.decoded = decode_upload(f)
+        except UploadRejected as e:
+            raise forms.ValidationError(str(e), code='invalid_image')
+        f.content_type = f"image/{f.decoded.format.lower()}"
+        return f
+
 
 class RetinopathyTestForm(forms.Form):
-    image = forms.ImageField(
+    image = DecodedImageField(
         required=False,
         label="Retina Image",
         help_text="Upload an image of the retina for analysis",
@@ -25,10 +52,7 @@ class RetinopathyTestForm(forms.Form):
     def clean_image(self):
         image = self.cleaned_data.get('image')
         if image:
-            if image.size > 10 * 1024 * 1024:
-                raise forms.ValidationError("Image file too large ( > 10MB )")
-            
-            valid_extensions = ['jpg', 'jpeg', 'png', 'bmp', 'tiff']
+            valid_extensions = ['jpg', 'jpeg', 'png', 'bmp', 'tiff', 'webp']
             extension = image.name.split('.')[-1].lower()
             if extension not in valid_extensions:
                 raise forms.ValidationError("Unsupported file format. Please upload JPG, PNG, or BMP.")
@@ -0,0 +1,106 @@
+"""
+Keyset pagination for the test history.
+
+Pages are ordered newest first on ``(created_at, id)`` and addressed by a
+cursor naming the last (or first) row of the neighbouring page, so every
+page is an index seek on ``test_created_idx`` / ``test_result_created_idx``
+instead of an OFFSET scan, whatever its depth in the table.
+"""
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import RetinopathyTest
+
+HISTORY_COLUMNS = ('id', 'created_at', 'result', 'confidence', 'image')
+EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def encode_cursor(test):
+    """Opaque cursor for a test: microseconds since the epoch and its id"""
+    created_at = test.created_at
+    if timezone.is_naive(created_at):
+        created_at = created_at.replace(tzinfo=dt_timezone.utc)
+    return f"{(created_at - EPOCH) // timedelta(microseconds=1)}-{test.id}"
+
+
+def decode_cursor(value):
+    """(created_at, id) from a cursor, or None when it is missing or malformed"""
+    try:
+        micros, test_id = value.split('-')
+        created_at = EPOCH + timedelta(microseconds=int(micros))
+        test_id = int(test_id)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+    if not settings.USE_TZ:
+        created_at = created_at.replace(tzinfo=None)
+    return created_at, test_id
+
+
+def day_start(day):
+    start = datetime.combine(day, time.min)
+    return timezone.make_aware(start) if settings.USE_TZ else start
+
+
+def parse_filters(params):
+    """Valid result and date range filters from the query string"""
+    results = dict(RetinopathyTest._meta.get_field('result').choices)
+    filters = {}
+    if params.get('result') in results:
+        filters['result'] = params['result']
+    for name in ('date_from', 'date_to'):
+        try:
+            day = parse_date(params.get(name) or '')
+        except ValueError:
+            day = None
+        if day:
+            filters[name] = day
+    return filters
+
+
+def filtered_tests(filters):
+    queryset = RetinopathyTest.objects.only(*HISTORY_COLUMNS)
+    if 'result' in filters:
+        queryset = queryset.filter(result=filters['result'])
+    if 'date_from' in filters:
+        queryset = queryset.filter(created_at__gte=day_start(filters['date_from']))
+    if 'date_to' in filters:
+        queryset = queryset.filter(created_at__lt=day_start(filters['date_to'] + timedelta(days=1)))
+    return queryset
+
+
+def history_page(filters, after=None, before=None, page_size=20):
+    """One page of tests, newest first, with cursors for the pages around it.
+
+    ``after`` continues past the last row of a page towards older tests and
+    ``before`` goes back from its first row towards newer ones.
+    """
+    queryset = filtered_tests(filters)
+    after, before = decode_cursor(after), decode_cursor(before)
+
+    if before is not None:
+        created_at, test_id = before
+        rows = list(
+            queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=test_id))
+            .order_by('created_at', 'id')[:page_size + 1]
+        )
+        has_newer = len(rows) > page_size
+        tests = rows[:page_size][::-1]
+        has_older = True
+    else:
+        if after is not None:
+            created_at, test_id = after
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=test_id))
+        rows = list(queryset.order_by('-created_at', '-id')[:page_size + 1])
+        has_older = len(rows) > page_size
+        tests = rows[:page_size]
+        has_newer = after is not None
+
+    return {
+        'tests': tests,
+        'next_cursor': encode_cursor(tests[-1]) if tests and has_older else None,
+        'previous_cursor': encode_cursor(tests[0]) if tests and has_newer else None,
+    }
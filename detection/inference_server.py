@@ -0,0 +1,226 @@
+"""
+Out-of-process inference server.
+
+One ``run_inference_server`` process owns a small pool of model processes
+and listens on a Unix socket. Web workers talk to it through
+``InferenceClient`` instead of loading their own copy of TensorFlow, so
+memory no longer grows with the number of WSGI workers and the cores are
+split between the model processes on purpose.
+
+Single-image requests from all web workers are micro-batched in the server
+(``INFERENCE_BATCHING``), one batcher per model process so every process
+can run a batch at once. Each batch is decoded and preprocessed serially
+inside its model process; with few concurrent requests, batches stay small
+and only the ``INFERENCE_MAX_WAIT_MS`` wait is added.
+"""
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import Client, Listener
+
+from django.conf import settings
+
+
+def server_address():
+    """Unix socket path of the inference server, or None when it is disabled"""
+    return getattr(settings, 'INFERENCE_SERVER_SOCKET', None)
+
+
+def server_authkey():
+    """Shared secret used to authenticate clients of the inference server"""
+    authkey = getattr(settings, 'INFERENCE_SERVER_AUTHKEY', None)
+    if authkey is None:
+        authkey = hashlib.sha256(settings.SECRET_KEY.encode()).hexdigest()
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def configure_tf_threads(intra_op=None, inter_op=None):
+    """Apply TF intra/inter-op thread counts (0 or None keeps TF's default)"""
+    import tensorflow as tf
+
+    if intra_op is None:
+        intra_op = getattr(settings, 'INFERENCE_INTRA_OP_THREADS', 0)
+    if inter_op is None:
+        inter_op = getattr(settings, 'INFERENCE_INTER_OP_THREADS', 0)
+    try:
+        if intra_op:
+            tf.config.threading.set_intra_op_parallelism_threads(int(intra_op))
+        if inter_op:
+            tf.config.threading.set_inter_op_parallelism_threads(int(inter_op))
+    except RuntimeError as e:
+        # TF refuses once its runtime has been initialized in this process
+        print(f"Could not set TF thread counts: {e}")
+
+
+class InferenceClient:
+    """Thin client with the same predict API as RetinopathyDetector"""
+
+    def __init__(self, address=None, authkey=None):
+        self.address = address or server_address()
+        self.authkey = authkey or server_authkey()
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _call(self, op, payload):
+        # Each thread keeps its own connection; reconnect once if the
+        # server was restarted since the connection was opened.
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.send((op, payload))
+                status, result = conn.recv()
+                break
+            except (EOFError, OSError):
+                self._local.conn = None
+                if attempt:
+                    raise
+        if status != 'ok':
+            raise RuntimeError(result)
+        return result
+
+    def predict(self, image_data):
+        return tuple(self._call('predict', image_data))
+
+    def predict_batch(self, images):
+        return [tuple(result) for result in self._call('predict_batch', list(images))]
+
+    def ping(self):
+        return self._call('ping', None)
+
+
+# Model owned by each pool process, created by _init_worker
+_worker_detector = None
+
+
+def _init_worker(intra_op, inter_op):
+    global _worker_detector
+
+    import django
+    django.setup()
+
+    from .ai_model import LazyDetector, RetinopathyDetector
+
+    # Lazy so that each pool process also follows the model registry
+    _worker_detector = LazyDetector(functools.partial(
+        RetinopathyDetector, local=True, batching=False, tf_threads=(intra_op, inter_op)
+    ))
+    _worker_detector.get()
+
+
+def _worker_predict_batch(images):
+    return _worker_detector.predict_batch(images)
+
+
+def _worker_predict(image_data):
+    return _worker_detector.predict(image_data)
+
+
+def _worker_predict_each(images):
+    # A micro-batch of separate requests: one bad image must not fail the rest
+    try:
+        return _worker_detector.predict_batch(images)
+    except Exception:
+        return [_worker_detector.predict(image_data) for image_data in images]
+
+
+class InferenceServer:
+    """Accept client connections and dispatch their requests to the model pool"""
+
+    def __init__(self, address=None, authkey=None, workers=None, intra_op=None, inter_op=None):
+        self.address = address or server_address()
+        self.authkey = authkey or server_authkey()
+        self.workers = workers or getattr(settings, 'INFERENCE_SERVER_WORKERS', 1)
+        self.intra_op = intra_op if intra_op is not None else getattr(settings, 'INFERENCE_INTRA_OP_THREADS', 0)
+        self.inter_op = inter_op if inter_op is not None else getattr(settings, 'INFERENCE_INTER_OP_THREADS', 0)
+        self.pool = None
+        self.listener = None
+        self.batchers = []
+        if getattr(settings, 'INFERENCE_BATCHING', True):
+            from .ai_model import MicroBatcher
+
+            self.batchers = [
+                MicroBatcher(
+                    self._predict_batch,
+                    max_batch_size=getattr(settings, 'INFERENCE_MAX_BATCH_SIZE', 8),
+                    max_wait_ms=getattr(settings, 'INFERENCE_MAX_WAIT_MS', 5),
+                    timeout=getattr(settings, 'INFERENCE_BATCH_TIMEOUT_SECONDS', 30.0),
+                    collate=list,
+                )
+                for _ in range(self.workers)
+            ]
+        self._next_batcher = itertools.count()
+
+    def _predict(self, image_data):
+        if not self.batchers:
+            return self.pool.apply(_worker_predict, (image_data,))
+        batcher = self.batchers[next(self._next_batcher) % len(self.batchers)]
+        return batcher.submit(image_data)
+
+    def _predict_batch(self, images):
+        return self.pool.apply(_worker_predict_each, (images,))
+
+    def start(self):
+        # Spawned processes start without the parent's state, so TensorFlow
+        # is only ever initialized inside the pool.
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(
+            self.workers,
+            initializer=_init_worker,
+            initargs=(self.intra_op, self.inter_op),
+        )
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        self.listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except multiprocessing.AuthenticationError:
+                continue
+            except OSError:
+                break
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, payload = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if op == 'predict':
+                        response = ('ok', self._predict(payload))
+                    elif op == 'predict_batch':
+                        response = ('ok', self.pool.apply(_worker_predict_batch, (payload,)))
+                    elif op == 'ping':
+                        response = ('ok', 'pong')
+                    else:
+                        response = ('error', f"Unknown operation: {op}")
+                except Exception as e:
+                    response = ('error', str(e))
+                try:
+                    conn.send(response)
+                except OSError:
+                    return
+
+    def close(self):
+        for batcher in self.batchers:
+            batcher.close()
+        if self.listener is not None:
+            self.listener.close()
+        if self.pool is not None:
+            self.pool.terminate()
+        if self.address and os.path.exists(self.address):
+            os.remove(self.address)
@@ -0,0 +1,181 @@
+"""
+Background detection jobs.
+
+An async upload is stored as a ``DetectionJob`` row and answered at once
+with the job ID. A small pool of worker threads in each web process claims
+pending jobs from the table, runs the same detection as the synchronous
+view and stores its JSON payload, which the status endpoint returns.
+Claiming is a conditional UPDATE, so several processes can share the table.
+The decoded upload of a job submitted in this process is handed to its
+workers in memory, so the image is not read back and decoded again; jobs
+claimed elsewhere or after a restart read the stored file.
+"""
+import os
+import queue
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import DetectionJob
+
+
+def claim_job(job_id=None):
+    """Atomically move a pending job (the given one, else the oldest) to running"""
+    if job_id is not None:
+        candidates = [job_id]
+    else:
+        candidates = list(
+            DetectionJob.objects.filter(status='pending').order_by('created_at').values_list('id', flat=True)[:5]
+        )
+    for candidate in candidates:
+        claimed = DetectionJob.objects.filter(id=candidate, status='pending').update(
+            status='running', started_at=timezone.now()
+        )
+        if claimed:
+            return DetectionJob.objects.select_related('country').get(id=candidate)
+    return None
+
+
+def requeue_stale_jobs():
+    """Return jobs left running by a worker that died to the pending state"""
+    stale_after = getattr(settings, 'DETECTION_JOB_STALE_SECONDS', 300)
+    cutoff = timezone.now() - timedelta(seconds=stale_after)
+    return DetectionJob.objects.filter(status='running', started_at__lt=cutoff).update(
+        status='pending', started_at=None
+    )
+
+
+def process_job(job):
+    """Run detection for a claimed job and store the final payload"""
+    from .views import run_detection, detection_payload
+
+    test = None
+    try:
+        # The DecodedUpload from the submitting request, if it was this process
+        image_data = job_pool.take_upload(job.id)
+        if image_data is None:
+            with job.image.open('rb') as f:
+                image_data = f.read()
+        test, stage_info = run_detection(
+            image_data, image_name=job.image.name if job.keep_image else None, admit=False
+        )
+        if not job.keep_image:
+            job.image.delete(save=False)
+        # The stored file now belongs to the test
+        job.image = ''
+        job.test = test
+        job.result = detection_payload(test, stage_info, job.country)
+        job.status = 'done'
+    except Exception as e:
+        job.error = str(e)
+        job.status = 'failed'
+        if job.image and test is None:
+            # No test took the stored file over, so drop the job's reference
+            try:
+                job.image.delete(save=False)
+            except Exception as delete_error:
+                print(f"Could not delete the image of failed job {job.id}: {delete_error}")
+            job.image = ''
+    job.finished_at = timezone.now()
+    job.save()
+    return job
+
+
+class JobWorkerPool:
+    def __init__(self, workers=2, poll_seconds=1.0, max_uploads=32):
+        self.workers = max(1, int(workers))
+        self.poll_seconds = poll_seconds
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        # Job ID -> DecodedUpload; the oldest are dropped past max_uploads
+        # and those jobs read their file instead
+        self.max_uploads = max_uploads
+        self._uploads = OrderedDict()
+        self._uploads_lock = threading.Lock()
+
+    def ensure_started(self):
+        # Threads do not survive a fork, so each worker process starts its own
+        pid = os.getpid()
+        if self._pid == pid and all(t.is_alive() for t in self._threads):
+            return
+        with self._lock:
+            if self._pid == pid and all(t.is_alive() for t in self._threads):
+                return
+            if self._pid != pid:
+                self._queue = queue.Queue()
+                self._threads = []
+            self._threads = [t for t in self._threads if t.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name=f'detection-job-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._pid = pid
+
+    def notify(self, job_id):
+        self.ensure_started()
+        self._queue.put(job_id)
+
+    def hand_off(self, job_id, upload):
+        """Keep a job's decoded upload for the worker that claims it"""
+        with self._uploads_lock:
+            self._uploads[job_id] = upload
+            while len(self._uploads) > self.max_uploads:
+                self._uploads.popitem(last=False)
+
+    def take_upload(self, job_id):
+        with self._uploads_lock:
+            return self._uploads.pop(job_id, None)
+
+    def _run(self):
+        try:
+            requeue_stale_jobs()
+        except Exception as e:
+            print(f"Could not requeue stale jobs: {e}")
+        finally:
+            close_old_connections()
+
+        while True:
+            try:
+                job_id = self._queue.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                job_id = None
+            try:
+                job = claim_job(job_id) if job_id is not None else None
+                if job is None:
+                    job = claim_job()
+                while job is not None:
+                    process_job(job)
+                    job = claim_job()
+            except Exception as e:
+                print(f"Detection job worker error: {e}")
+            finally:
+                close_old_connections()
+
+
+job_pool = JobWorkerPool(
+    workers=getattr(settings, 'DETECTION_JOB_WORKERS', 2),
+    poll_seconds=getattr(settings, 'DETECTION_JOB_POLL_SECONDS', 1.0),
+)
+
+
+def submit_job(image_file, country, keep_image=True):
+    """Store an upload as a pending job and wake a worker for it
+
+    An ``image_file`` carrying a ``decoded`` DecodedUpload (as validated
+    uploads do) is stored from it and handed to the worker as is.
+    """
+    job = DetectionJob(country=country, keep_image=keep_image)
+    job.image.save(os.path.basename(image_file.name or 'upload'), image_file, save=False)
+    decoded = getattr(image_file, 'decoded', None)
+    if decoded is not None:
+        # Before the row exists, so no worker can claim the job without it
+        job_pool.hand_off(job.id, decoded)
+    job.save()
+    job_pool.notify(job.id)
+    return job
@@ -0,0 +1,97 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from detection import benchmarks
+
+SECTIONS = ('preprocess', 'decode', 'inference', 'preprocess_image', 'predict', 'tta', 'endpoint')
+
+
+class Command(BaseCommand):
+    help = "Benchmark the detection pipeline and print the results as JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=10, help="Timed runs per measurement")
+        parser.add_argument('--batch-size', type=int, default=8, help="Images per preprocessing batch")
+        parser.add_argument('--sections', nargs='+', choices=SECTIONS, default=list(SECTIONS),
+                            help="Benchmarks to run (default: all)")
+        parser.add_argument('--resolutions', nargs='+', default=None,
+                            help="WIDTHxHEIGHT sizes for preprocess_image, predict and endpoint")
+        parser.add_argument('--formats', nargs='+', choices=benchmarks.SUITE_FORMATS, default=None,
+                            help="Image formats for preprocess_image, predict and endpoint")
+        parser.add_argument('--tta-views', nargs='+', type=int, default=[1, 2, 4, 8],
+                            help="View counts for the tta benchmark; 1 is the single-view baseline")
+        parser.add_argument('--load', action='store_true',
+                            help="Also run the WSGI vs ASGI /detect/ load benchmark (writes to the database)")
+        parser.add_argument('--concurrency', type=int, default=32, help="In-flight requests for --load")
+        parser.add_argument('--output', help="Write the JSON results to this file instead of stdout")
+        parser.add_argument('--compare', help="Earlier JSON results to compare median latencies against")
+        parser.add_argument('--threshold', type=float, default=0.1,
+                            help="Slowdown (fraction) reported as a regression by --compare")
+
+    def parse_resolutions(self, values):
+        if not values:
+            return benchmarks.SUITE_RESOLUTIONS
+        try:
+            return tuple(tuple(int(n) for n in value.lower().split('x')) for value in values)
+        except ValueError:
+            raise CommandError("Resolutions must look like 1024x768")
+
+    def handle(self, *args, **options):
+        sections = options['sections']
+        suite = {
+            'resolutions': self.parse_resolutions(options['resolutions']),
+            'formats': tuple(options['formats'] or benchmarks.SUITE_FORMATS),
+            'repeat': options['repeat'],
+        }
+
+        results = {}
+        if 'preprocess' in sections:
+            results['preprocess'] = benchmarks.bench_preprocess(
+                batch_size=options['batch_size'],
+                repeat=options['repeat'],
+            )
+        if 'decode' in sections:
+            results['decode'] = benchmarks.bench_decode(repeat=options['repeat'])
+        if 'inference' in sections:
+            results['inference'] = benchmarks.bench_inference(repeat=options['repeat'])
+
+        if {'preprocess_image', 'predict', 'tta', 'endpoint'} & set(sections):
+            detector = benchmarks.placeholder_detector()
+            if 'preprocess_image' in sections:
+                results['preprocess_image'] = benchmarks.bench_preprocess_image(detector, **suite)
+            if 'predict' in sections:
+                results['predict'] = benchmarks.bench_predict(detector, **suite)
+            if 'tta' in sections:
+                views = sorted(set([1] + options['tta_views']))
+                results['tta'] = benchmarks.bench_tta(detector, views=views, repeat=options['repeat'])
+            if 'endpoint' in sections:
+                results['endpoint'] = benchmarks.bench_detect_endpoint(detector, **suite)
+
+        if options['load']:
+            try:
+                results['load'] = benchmarks.bench_wsgi_vs_asgi(
+                    requests=max(options['concurrency'] * 2, 64),
+                    concurrency=options['concurrency'],
+                )
+            except RuntimeError as e:
+                raise CommandError(str(e))
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            results['comparison'] = benchmarks.compare_results(baseline, results, options['threshold'])
+            for row in results['comparison']:
+                line = (
+                    f"{row['name']:<40}{row['baseline_ms']:>10.2f}{row['current_ms']:>10.2f} ms"
+                    f"{row['change']:>+9.1%}"
+                )
+                self.stderr.write(self.style.ERROR(line) if row['regression'] else line)
+
+        payload = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(payload + '\n')
+            self.stdout.write(self.style.SUCCESS(f"Benchmark results written to {options['output']}"))
+        else:
+            self.stdout.write(payload)
@@ -0,0 +1,95 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from detection import benchmarks
+from detection.backends import (
+    CONVERTED_SUFFIXES, KerasBackend, ONNXBackend, TFLiteBackend, converted_model_path, export_onnx,
+    export_tflite,
+)
+from detection.preprocessing import preprocess_batch
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+class Command(BaseCommand):
+    help = "Convert the Keras model to TFLite/ONNX and report accuracy parity against Keras"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--formats', nargs='+', choices=sorted(CONVERTED_SUFFIXES), default=sorted(CONVERTED_SUFFIXES),
+            help="Backends to convert to (default: all)",
+        )
+        parser.add_argument('--calibration-dir', help="Directory of representative fundus images")
+        parser.add_argument('--calibration-size', type=int, default=100, help="Maximum calibration images")
+        parser.add_argument('--eval-dir', help="Images for the parity report (default: the calibration images)")
+        parser.add_argument('--report', help="Write the parity report as JSON to this file")
+        parser.add_argument('--no-report', action='store_true', help="Only convert, skip the parity report")
+
+    def load_images(self, directory, limit):
+        if not directory:
+            self.stderr.write(self.style.WARNING(
+                "No image directory given, using synthetic images; pass real fundus photos "
+                "for a meaningful int8 calibration and parity report"
+            ))
+            images = [benchmarks.synthetic_fundus(512, 512, seed=i) for i in range(min(limit, 32))]
+        else:
+            if not os.path.isdir(directory):
+                raise CommandError(f"{directory} is not a directory")
+            names = sorted(n for n in os.listdir(directory) if n.lower().endswith(IMAGE_EXTENSIONS))
+            images = [os.path.join(directory, n) for n in names[:limit]]
+            if not images:
+                raise CommandError(f"No images found in {directory}")
+        return preprocess_batch(images)
+
+    def handle(self, *args, **options):
+        # Convert from the plain float32 model whatever the serving settings are
+        with override_settings(INFERENCE_PRECISION='float32', INFERENCE_COMPILED=True, INFERENCE_XLA=False):
+            keras = KerasBackend(settings.MODEL_PATH).load()
+        if keras.version == 'placeholder':
+            self.stderr.write(self.style.WARNING(f"{settings.MODEL_PATH} not found, converting the placeholder model"))
+
+        calibration = self.load_images(options['calibration_dir'], options['calibration_size'])
+
+        candidates = []
+        for fmt in options['formats']:
+            path = converted_model_path(fmt)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                if fmt == 'onnx':
+                    export_onnx(keras, path)
+                    candidates.append(ONNXBackend(path).load())
+                else:
+                    export_tflite(keras, path, quantization=fmt.split('-')[1], calibration=calibration)
+                    candidates.append(TFLiteBackend(path).load())
+            except ImportError as e:
+                self.stderr.write(self.style.ERROR(f"Skipping {fmt}: {e}"))
+                continue
+            candidates[-1].name = fmt
+            self.stdout.write(self.style.SUCCESS(f"Wrote {path} ({os.path.getsize(path) / 1e6:.1f} MB)"))
+
+        if options['no_report'] or not candidates:
+            return
+
+        if options['eval_dir']:
+            evaluation = self.load_images(options['eval_dir'], options['calibration_size'])
+        else:
+            evaluation = calibration
+        report = benchmarks.backend_parity_report(keras, candidates, evaluation)
+
+        self.stdout.write(f"\nParity against Keras on {len(evaluation)} images:")
+        self.stdout.write(f"{'backend':<16}{'size MB':>9}{'top-1 agree':>13}{'max |diff|':>12}{'p50 ms':>9}")
+        for row in report:
+            size = f"{row['file_size_mb']:.1f}" if row['file_size_mb'] is not None else '-'
+            self.stdout.write(
+                f"{row['backend']:<16}{size:>9}{row['top1_agreement']:>13.3f}"
+                f"{row['max_abs_diff']:>12.4f}{row['latency_batch1']['median_ms']:>9.2f}"
+            )
+
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['report']}"))
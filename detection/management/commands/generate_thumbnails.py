@@ -0,0 +1,55 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from detection.models import RetinopathyTest
+from detection.thumbnails import generate_thumbnails, thumbnail_sizes
+
+
+class Command(BaseCommand):
+    help = "Create missing thumbnails for the images of existing tests"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', help="Thumbnail sizes to create (default: all configured)")
+        parser.add_argument('--force', action='store_true', help="Recreate thumbnails that already exist")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4, help="Images resized in parallel")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Rows fetched per query")
+
+    def handle(self, *args, **options):
+        sizes = options['sizes'] or list(thumbnail_sizes())
+        unknown = set(sizes) - set(thumbnail_sizes())
+        if unknown:
+            raise CommandError(f"Unknown thumbnail sizes: {', '.join(sorted(unknown))}")
+
+        names = (
+            RetinopathyTest.objects.exclude(image='').exclude(image__isnull=True)
+            .values_list('image', flat=True).iterator(chunk_size=options['chunk_size'])
+        )
+
+        def generate(name):
+            try:
+                generate_thumbnails(name, sizes=sizes, force=options['force'])
+                return True
+            except Exception as e:
+                self.stderr.write(f"Skipping {name}: {e}")
+                return False
+
+        started = time.monotonic()
+        done = failed = 0
+        chunk_size = max(1, options['chunk_size'])
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            # pool.map submits everything at once, so feed it a chunk at a time
+            for chunk in iter(lambda: list(islice(names, chunk_size)), []):
+                results = list(pool.map(generate, chunk))
+                done += sum(results)
+                failed += len(results) - sum(results)
+                self.stdout.write(f"{done + failed} images, {failed} failed")
+
+        elapsed = time.monotonic() - started
+        rate = (done + failed) / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f"Thumbnails ready for {done} images ({failed} failed) in {elapsed:.1f}s: {rate:.1f} images/s"
+        ))
@@ -0,0 +1,106 @@
+import time
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from detection.models import DetectionJob, RetinopathyTest, StoredFile
+from detection.storage import ContentAddressedStorage
+from detection.thumbnails import delete_thumbnails
+
+FILE_FIELDS = ((RetinopathyTest, 'image'), (DetectionJob, 'image'))
+
+
+class Command(BaseCommand):
+    help = "Move images stored under upload names or other roots into content-addressed, deduplicated storage"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Rows updated per bulk_update")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the files that would move")
+
+    def handle(self, *args, **options):
+        chunk_size = max(1, options['chunk_size'])
+        started = time.monotonic()
+        totals = {'moved': 0, 'deduplicated': 0, 'missing': 0, 'bytes_before': 0, 'bytes_after': 0}
+        # Old name -> new name, for rows that share a file
+        moved = {}
+
+        for model, field_name in FILE_FIELDS:
+            storage = model._meta.get_field(field_name).storage
+            if not isinstance(storage, ContentAddressedStorage):
+                raise CommandError(
+                    f"{model.__name__}.{field_name} does not use ContentAddressedStorage; "
+                    "set it as the default backend in STORAGES first"
+                )
+            rows = (
+                model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+                .only('pk', field_name).iterator(chunk_size=chunk_size)
+            )
+            pending, old_names = [], []
+            for row in rows:
+                old_name = getattr(row, field_name).name
+                # Also moves hashed files left under another root (job uploads)
+                if storage.in_root(old_name):
+                    continue
+                if options['dry_run']:
+                    if storage.exists(old_name):
+                        totals['moved'] += 1
+                        totals['bytes_before'] += storage.size(old_name)
+                    else:
+                        totals['missing'] += 1
+                    continue
+
+                if old_name in moved:
+                    new_name = moved[old_name]
+                    StoredFile.objects.filter(name=new_name).update(references=F('references') + 1)
+                    # A hashed old name holds one reference per row
+                    old_names.append(old_name)
+                elif storage.exists(old_name):
+                    with storage.open(old_name, 'rb') as f:
+                        data = f.read()
+                    new_name = storage.save(old_name, ContentFile(data))
+                    moved[old_name] = new_name
+                    old_names.append(old_name)
+                    totals['bytes_before'] += len(data)
+                    if storage.references(new_name) > 1:
+                        totals['deduplicated'] += 1
+                    else:
+                        totals['bytes_after'] += storage.size(new_name)
+                else:
+                    totals['missing'] += 1
+                    self.stderr.write(f"Missing file for {model.__name__} {row.pk}: {old_name}")
+                    continue
+
+                setattr(row, field_name, new_name)
+                pending.append(row)
+                totals['moved'] += 1
+                if len(pending) >= chunk_size:
+                    self.flush(model, field_name, pending)
+                    pending = []
+                    self.stdout.write(f"{totals['moved']} files moved")
+
+            if pending:
+                self.flush(model, field_name, pending)
+            # Only drop the old files once no row points at them any more
+            for name in old_names:
+                storage.delete(name)
+            for name in set(old_names):
+                delete_thumbnails(name)
+
+        elapsed = time.monotonic() - started
+        verb = "Would move" if options['dry_run'] else "Moved"
+        summary = (
+            f"{verb} {totals['moved']} files ({totals['bytes_before'] / 1e6:.1f} MB) in {elapsed:.1f}s, "
+            f"{totals['missing']} missing"
+        )
+        if not options['dry_run']:
+            summary += (
+                f", {totals['deduplicated']} duplicates merged, "
+                f"{totals['bytes_after'] / 1e6:.1f} MB stored"
+            )
+        self.stdout.write(self.style.SUCCESS(summary))
+
+    def flush(self, model, field_name, rows):
+        with transaction.atomic():
+            model.objects.bulk_update(rows, [field_name])
@@ -0,0 +1,78 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from detection.model_registry import ModelIntegrityError, registry
+
+
+class Command(BaseCommand):
+    help = "Register, activate, list and verify versions in the model registry"
+
+    def add_arguments(self, parser):
+        actions = parser.add_subparsers(dest='action', required=True)
+
+        register = actions.add_parser('register', help="Copy a model file into the registry as a new version")
+        register.add_argument('path', nargs='?', help="Model file (default: MODEL_PATH)")
+        register.add_argument('--version', help="Version name (default: v<N>)")
+        register.add_argument('--notes', default='', help="Free text stored with the version")
+        register.add_argument('--activate', action='store_true', help="Make it the active version right away")
+
+        activate = actions.add_parser('activate', help="Switch every worker to a registered version")
+        activate.add_argument('version')
+
+        actions.add_parser('list', help="Show the registered versions")
+
+        verify = actions.add_parser('verify', help="Check model files against their checksums")
+        verify.add_argument('versions', nargs='*', help="Versions to check (default: all)")
+
+    def handle(self, *args, **options):
+        getattr(self, f"handle_{options['action']}")(options)
+
+    def handle_register(self, options):
+        path = options['path'] or settings.MODEL_PATH
+        try:
+            model = registry.register(path, version=options['version'], activate=options['activate'],
+                                      notes=options['notes'])
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not register {path}: {e}")
+        self.stdout.write(self.style.SUCCESS(f"Registered {model.version} ({model.sha256[:12]}) at {model.path}"))
+        if options['activate']:
+            self.stdout.write(f"Activated {model.version}; workers load it within "
+                              f"{getattr(settings, 'MODEL_REGISTRY_POLL_SECONDS', 10.0)}s")
+
+    def handle_activate(self, options):
+        try:
+            model = registry.get(options['version'])
+            registry.verify(model)
+            registry.activate(model.version)
+        except (KeyError, ModelIntegrityError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"Activated {model.version}; workers load it within "
+            f"{getattr(settings, 'MODEL_REGISTRY_POLL_SECONDS', 10.0)}s"
+        ))
+
+    def handle_list(self, options):
+        versions = registry.versions()
+        if not versions:
+            self.stdout.write(f"No versions registered in {registry.root}")
+            return
+        for info in versions:
+            marker = '*' if info['active'] else ' '
+            self.stdout.write(
+                f"{marker} {info['version']:<12}{info['sha256'][:12]:<14}{info['size'] / 1e6:>8.1f} MB  "
+                f"{info['registered_at'][:19]}  {info['notes']}"
+            )
+
+    def handle_verify(self, options):
+        names = options['versions'] or [info['version'] for info in registry.versions()]
+        failed = 0
+        for name in names:
+            try:
+                registry.verify(registry.get(name))
+            except (KeyError, ModelIntegrityError) as e:
+                failed += 1
+                self.stderr.write(self.style.ERROR(str(e)))
+            else:
+                self.stdout.write(f"{name}: ok")
+        if failed:
+            raise CommandError(f"{failed} of {len(names)} versions failed verification")
@@ -0,0 +1,159 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from detection.history import day_start
+from detection.models import DetectionJob, RetinopathyTest
+from detection.storage import ContentAddressedStorage
+from detection.thumbnails import delete_thumbnails
+
+
+class Command(BaseCommand):
+    help = "Delete old screenings, finished detection jobs and their images according to a retention policy"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than-days', type=int, help="Delete tests created more than N days ago")
+        parser.add_argument('--before', help="Delete tests created before this date (YYYY-MM-DD)")
+        parser.add_argument('--result', nargs='+', choices=[key for key, _ in RetinopathyTest._meta.get_field('result').choices],
+                            help="Only delete tests with these results")
+        parser.add_argument('--all', action='store_true', help="Allow deleting every test when no other filter is given")
+        parser.add_argument('--jobs-older-than-days', type=int,
+                            help="Also delete detection jobs that finished more than N days ago")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Rows deleted per transaction")
+        parser.add_argument('--workers', type=int, default=8, help="Threads deleting files")
+        parser.add_argument('--sleep', type=float, default=0.0,
+                            help="Seconds to pause between chunks so other writers get the database")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted")
+
+    def build_queryset(self, options):
+        queryset = RetinopathyTest.objects.all()
+        filtered = False
+        if options['older_than_days'] is not None:
+            queryset = queryset.filter(created_at__lt=timezone.now() - timedelta(days=options['older_than_days']))
+            filtered = True
+        if options['before']:
+            day = parse_date(options['before'])
+            if day is None:
+                raise CommandError(f"Invalid date {options['before']!r}, use YYYY-MM-DD")
+            queryset = queryset.filter(created_at__lt=day_start(day))
+            filtered = True
+        if options['result']:
+            queryset = queryset.filter(result__in=options['result'])
+            filtered = True
+        if not filtered and not options['all']:
+            if options['jobs_older_than_days'] is not None:
+                # Only finished jobs are purged
+                return None
+            raise CommandError(
+                "Give --older-than-days, --before, --result or --jobs-older-than-days (or --all to delete every test)"
+            )
+        return queryset
+
+    def build_job_queryset(self, options):
+        if options['jobs_older_than_days'] is None:
+            return None
+        cutoff = timezone.now() - timedelta(days=options['jobs_older_than_days'])
+        return DetectionJob.objects.filter(status__in=['done', 'failed'], finished_at__lt=cutoff)
+
+    def delete_files(self, pool, names):
+        """Remove the image files no remaining test refers to, concurrently"""
+        if not names:
+            return 0
+        if isinstance(default_storage, ContentAddressedStorage):
+            names = default_storage.release(names)
+            remove = default_storage.delete_file
+        else:
+            remove = default_storage.delete
+
+        def delete(name):
+            try:
+                remove(name)
+                delete_thumbnails(name)
+                return True
+            except Exception as e:
+                self.stderr.write(f"Could not delete {name}: {e}")
+                return False
+
+        return sum(pool.map(delete, names))
+
+    def purge_jobs(self, pool, jobs, chunk_size):
+        """Delete finished jobs and release the images failed or old jobs still hold"""
+        rows = files = 0
+        while True:
+            # Deleted rows drop out of the queryset, so each chunk is the next one
+            chunk = list(jobs.order_by('finished_at').values_list('id', 'image')[:chunk_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                _, per_model = DetectionJob.objects.filter(id__in=[job_id for job_id, _ in chunk]).delete()
+            rows += per_model.get(DetectionJob._meta.label, 0)
+            files += self.delete_files(pool, [name for _, name in chunk if name])
+        return rows, files
+
+    def handle(self, *args, **options):
+        queryset = self.build_queryset(options)
+        jobs = self.build_job_queryset(options)
+
+        if options['dry_run']:
+            if jobs is not None:
+                self.stdout.write(f"Would delete {jobs.count()} finished detection jobs")
+            if queryset is None:
+                return
+            by_result = dict(queryset.values_list('result').annotate(n=Count('id')).order_by())
+            with_images = queryset.exclude(image='').exclude(image__isnull=True).count()
+            self.stdout.write(f"Would delete {sum(by_result.values())} tests ({with_images} with images):")
+            for result, count in sorted(by_result.items()):
+                self.stdout.write(f"  {result:<14}{count:>10}")
+            return
+
+        chunk_size = max(1, options['chunk_size'])
+        started = time.monotonic()
+        rows = files = 0
+        longest_lock = 0.0
+        last_id = 0
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            if jobs is not None:
+                job_rows, job_files = self.purge_jobs(pool, jobs, chunk_size)
+                self.stdout.write(f"Deleted {job_rows} finished detection jobs and {job_files} files")
+            while queryset is not None:
+                # Seek on the primary key instead of holding one cursor open
+                # over a table we are deleting from
+                chunk = list(
+                    queryset.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', 'image')[:chunk_size].iterator()
+                )
+                if not chunk:
+                    break
+                last_id = chunk[-1][0]
+                ids = [test_id for test_id, _ in chunk]
+                names = [name for _, name in chunk if name]
+
+                locked = time.monotonic()
+                with transaction.atomic():
+                    # The total would also count cascaded rows such as TestGrade
+                    _, per_model = RetinopathyTest.objects.filter(id__in=ids).delete()
+                longest_lock = max(longest_lock, time.monotonic() - locked)
+                rows += per_model.get(RetinopathyTest._meta.label, 0)
+                # Files go after the rows: a crash leaves orphan files, never rows without images
+                files += self.delete_files(pool, names)
+
+                elapsed = time.monotonic() - started
+                self.stdout.write(f"{rows} tests, {files} files deleted, {rows / elapsed:.0f} tests/s")
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+        if queryset is None:
+            return
+        elapsed = time.monotonic() - started
+        rate = rows / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {rows} tests and {files} files in {elapsed:.1f}s: {rate:.0f} tests/s, "
+            f"longest transaction {longest_lock * 1000:.0f} ms"
+        ))
@@ -0,0 +1,211 @@
+import os
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from detection.ai_model import RetinopathyDetector, detector
+from detection.model_registry import registry
+from detection.models import RetinopathyTest, TestGrade
+from detection.views import get_dr_stage_info
+
+# Side table version for grades of tests saved before versions were recorded
+UNVERSIONED = 'unversioned'
+
+
+class Command(BaseCommand):
+    help = "Grade stored screenings again with a model version, keeping every version's grades"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model-version', help="Registry version to grade with (default: the serving model)")
+        parser.add_argument('--result', nargs='+', choices=[key for key, _ in RetinopathyTest._meta.get_field('result').choices],
+                            help="Only rescore tests with these results")
+        parser.add_argument('--limit', type=int, help="Grade at most this many tests in this run")
+        parser.add_argument('--batch-size', type=int, default=32, help="Images per inference batch")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                            help="Threads loading and preprocessing images")
+        parser.add_argument('--prefetch', type=int, default=2,
+                            help="Batches loaded ahead of the one being inferred")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Grades written per transaction")
+        parser.add_argument('--apply', action='store_true',
+                            help="Make this version's grades the tests' results; their previous grades stay "
+                                 "in the side table")
+
+    def load_detector(self, version):
+        if not version:
+            return detector.get()
+        try:
+            model = registry.get(version)
+        except KeyError as e:
+            raise CommandError(str(e))
+        return RetinopathyDetector(local=True, batching=False, model=model)
+
+    def stream_rows(self, queryset, page_size=2000):
+        """Yield (id, image, result) of the tests to grade, in id order.
+
+        Each keyset page is read completely before grades are written, as
+        SQLite does not isolate an open cursor from writes on the same
+        connection.
+        """
+        last_id = 0
+        while True:
+            page = list(
+                queryset.filter(id__gt=last_id).order_by('id')
+                .values_list('id', 'image', 'result')[:page_size].iterator()
+            )
+            if not page:
+                return
+            last_id = page[-1][0]
+            yield from page
+
+    def prepare(self, model, rows):
+        """Load and preprocess one batch in a worker thread; unreadable images are left out"""
+        ok, images = [], []
+        for row in rows:
+            try:
+                with default_storage.open(row[1], 'rb') as f:
+                    images.append(f.read())
+                ok.append(row)
+            except Exception as e:
+                self.stderr.write(f"Skipping test {row[0]}: {e}")
+        if model.client is not None or not images:
+            # The shared inference server preprocesses; only send the bytes
+            return ok, images
+
+        try:
+            return ok, model.preprocess_images(images)
+        except Exception:
+            pass
+        kept, arrays = [], []
+        for row, data in zip(ok, images):
+            try:
+                arrays.append(model.preprocess_image(data))
+                kept.append(row)
+            except Exception as e:
+                self.stderr.write(f"Skipping test {row[0]}: {e}")
+        batch = np.concatenate(arrays) if arrays else np.empty((0, 224, 224, 3), dtype=np.float32)
+        return kept, batch
+
+    def infer(self, model, batch):
+        if not len(batch):
+            return []
+        if model.client is not None:
+            return model.predict_batch(batch)
+        return [model.decode_prediction(row) for row in model.predict_array(batch)]
+
+    def flush(self, grades):
+        # ignore_conflicts lets two runs for the same version overlap safely
+        with transaction.atomic():
+            TestGrade.objects.bulk_create(grades, ignore_conflicts=True)
+
+    def apply(self, version, chunk_size):
+        """Copy a version's grades onto the tests, keeping each test's previous grade as a TestGrade"""
+        updated = 0
+        last_id = 0
+        fields = ['result', 'confidence', 'model_version']
+        while True:
+            grades = list(
+                TestGrade.objects.filter(model_version=version, test_id__gt=last_id)
+                .select_related('test').order_by('test_id')[:chunk_size]
+            )
+            if not grades:
+                return updated
+            last_id = grades[-1].test_id
+            previous, tests = [], []
+            for grade in grades:
+                test = grade.test
+                if test.model_version == version:
+                    continue
+                previous.append(TestGrade(
+                    test=test, model_version=test.model_version or UNVERSIONED,
+                    result=test.result, confidence=test.confidence,
+                ))
+                test.result, test.confidence, test.model_version = grade.result, grade.confidence, version
+                tests.append(test)
+            with transaction.atomic():
+                TestGrade.objects.bulk_create(previous, ignore_conflicts=True)
+                RetinopathyTest.objects.bulk_update(tests, fields)
+            updated += len(tests)
+
+    def handle(self, *args, **options):
+        model = self.load_detector(options['model_version'])
+        version = model.prediction_version
+        queryset = RetinopathyTest.objects.exclude(image='').exclude(image__isnull=True)
+        if options['result']:
+            queryset = queryset.filter(result__in=options['result'])
+        # Tests graded by this version in an earlier run are skipped, which makes the command resumable
+        queryset = queryset.exclude(grades__model_version=version)
+
+        total = queryset.count()
+        if options['limit'] is not None:
+            total = min(total, options['limit'])
+        self.stdout.write(f"Grading {total} tests with model {version}")
+
+        batch_size = max(1, options['batch_size'])
+        chunk_size = max(batch_size, options['chunk_size'])
+        rows = islice(self.stream_rows(queryset), total)
+        batches = iter(lambda: list(islice(rows, batch_size)), [])
+
+        started = time.monotonic()
+        waited = inferred = written = 0.0
+        graded = failed = 0
+        changes = Counter()
+        pending = []
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            # Keep a few batches loading while the current one is inferred
+            window = deque(
+                (len(b), pool.submit(self.prepare, model, b)) for b in islice(batches, max(1, options['prefetch']) + 1)
+            )
+            while window:
+                size, future = window.popleft()
+                mark = time.monotonic()
+                ok_rows, batch = future.result()
+                waited += time.monotonic() - mark
+                failed += size - len(ok_rows)
+                following = next(batches, None)
+                if following:
+                    window.append((len(following), pool.submit(self.prepare, model, following)))
+
+                mark = time.monotonic()
+                predictions = self.infer(model, batch)
+                inferred += time.monotonic() - mark
+                for (test_id, _, old_result), (result, confidence) in zip(ok_rows, predictions):
+                    if result == "Error":
+                        failed += 1
+                        continue
+                    new_result = get_dr_stage_info(result)['key']
+                    changes[old_result, new_result] += 1
+                    pending.append(TestGrade(
+                        test_id=test_id, model_version=version, result=new_result, confidence=confidence,
+                    ))
+
+                if len(pending) >= chunk_size or not window:
+                    mark = time.monotonic()
+                    self.flush(pending)
+                    written += time.monotonic() - mark
+                    graded += len(pending)
+                    pending = []
+                    elapsed = time.monotonic() - started
+                    self.stdout.write(f"{graded}/{total} tests graded, {failed} failed, {graded / elapsed:.1f} tests/s")
+
+        elapsed = time.monotonic() - started
+        rate = graded / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f"Graded {graded} tests ({failed} failed) in {elapsed:.1f}s: {rate:.1f} tests/s "
+            f"(waiting for images {waited:.1f}s, inference {inferred:.1f}s, writes {written:.1f}s)"
+        ))
+        changed = sum(count for (old, new), count in changes.items() if old != new)
+        if graded:
+            self.stdout.write(f"{changed} of {graded} grades differ from the stored result:")
+            for (old, new), count in sorted(changes.items()):
+                if old != new:
+                    self.stdout.write(f"  {old:<14} -> {new:<14}{count:>8}")
+
+        if options['apply']:
+            updated = self.apply(version, chunk_size)
+            self.stdout.write(self.style.SUCCESS(f"Updated {updated} tests to the grades of {version}"))
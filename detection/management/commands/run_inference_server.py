@@ -0,0 +1,38 @@
+import signal
+
+from django.core.management.base import BaseCommand, CommandError
+
+from detection.inference_server import InferenceServer, server_address
+
+
+class Command(BaseCommand):
+    help = "Run the shared inference server that owns the retinopathy model"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', help="Unix socket path (default: INFERENCE_SERVER_SOCKET)")
+        parser.add_argument('--workers', type=int, help="Number of model processes (default: INFERENCE_SERVER_WORKERS)")
+        parser.add_argument('--intra-op-threads', type=int, help="TF intra-op threads per model process")
+        parser.add_argument('--inter-op-threads', type=int, help="TF inter-op threads per model process")
+
+    def handle(self, *args, **options):
+        address = options['socket'] or server_address()
+        if not address:
+            raise CommandError("Set INFERENCE_SERVER_SOCKET or pass --socket")
+
+        server = InferenceServer(
+            address=address,
+            workers=options['workers'],
+            intra_op=options['intra_op_threads'],
+            inter_op=options['inter_op_threads'],
+        )
+        server.start()
+        signal.signal(signal.SIGTERM, lambda *_: server.close())
+        self.stdout.write(self.style.SUCCESS(
+            f"Inference server listening on {address} with {server.workers} model process(es)"
+        ))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
@@ -0,0 +1,180 @@
+import csv
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from detection.ai_model import detector
+from detection.models import RetinopathyTest
+from detection.views import get_dr_stage_info
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+class Command(BaseCommand):
+    help = "Screen a directory or CSV manifest of retina images and save the results"
+
+    def add_arguments(self, parser):
+        parser.add_argument('source', help="Image directory, or CSV manifest with a 'path' column")
+        parser.add_argument('--batch-size', type=int, default=32, help="Images per inference batch")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 4,
+                            help="Threads decoding and preprocessing images")
+        parser.add_argument('--prefetch', type=int, default=2,
+                            help="Batches preprocessed ahead of the one being inferred")
+        parser.add_argument('--chunk-size', type=int, default=500, help="Rows per bulk_create")
+        parser.add_argument('--store-images', action='store_true',
+                            help="Copy each image into media storage and link it to its test")
+        parser.add_argument('--checkpoint', help="Checkpoint file (default: <source>.screening.json)")
+        parser.add_argument('--restart', action='store_true', help="Ignore an existing checkpoint")
+
+    def collect_paths(self, source):
+        if os.path.isdir(source):
+            paths = []
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXTENSIONS))
+            return paths
+
+        if os.path.isfile(source) and source.lower().endswith('.csv'):
+            base = os.path.dirname(os.path.abspath(source))
+            with open(source, newline='') as f:
+                reader = csv.DictReader(f)
+                column = next((c for c in ('path', 'image', 'file') if c in (reader.fieldnames or [])), None)
+                if column is None:
+                    raise CommandError("The manifest needs a 'path', 'image' or 'file' column")
+                return [os.path.join(base, row[column].strip()) for row in reader if row[column].strip()]
+
+        raise CommandError(f"{source} is neither a directory nor a CSV manifest")
+
+    def load_checkpoint(self, path, fingerprint, restart):
+        if restart or not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            state = json.load(f)
+        if state.get('fingerprint') != fingerprint:
+            raise CommandError(f"{path} belongs to a different image list; use --restart to start over")
+        return state['done']
+
+    def save_checkpoint(self, path, fingerprint, done, total):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'done': done, 'total': total}, f)
+        os.replace(tmp, path)
+
+    def prepare(self, paths):
+        """Preprocess one batch in a worker thread, skipping images that fail to decode"""
+        if detector.client is not None:
+            # The shared inference server preprocesses; only read the bytes
+            images, ok = [], []
+            for path in paths:
+                try:
+                    with open(path, 'rb') as f:
+                        images.append(f.read())
+                    ok.append(path)
+                except OSError as e:
+                    self.stderr.write(f"Skipping {path}: {e}")
+            return ok, images
+
+        try:
+            return paths, detector.preprocess_images(paths)
+        except Exception:
+            pass
+        ok, arrays = [], []
+        for path in paths:
+            try:
+                arrays.append(detector.preprocess_image(path))
+                ok.append(path)
+            except Exception as e:
+                self.stderr.write(f"Skipping {path}: {e}")
+        batch = np.concatenate(arrays) if arrays else np.empty((0, 224, 224, 3), dtype=np.float32)
+        return ok, batch
+
+    def infer(self, model, batch):
+        if model.client is not None:
+            return model.predict_batch(batch)
+        if not len(batch):
+            return []
+        return [model.decode_prediction(row) for row in model.predict_array(batch)]
+
+    def build_test(self, path, result, confidence, model_version, store_images):
+        test = RetinopathyTest(
+            result=get_dr_stage_info(result)['key'], confidence=confidence, model_version=model_version
+        )
+        if store_images:
+            with open(path, 'rb') as f:
+                test.image.save(os.path.basename(path), File(f), save=False)
+        return test
+
+    def flush(self, pending):
+        with transaction.atomic():
+            RetinopathyTest.objects.bulk_create(pending)
+
+    def handle(self, *args, **options):
+        source = options['source']
+        paths = self.collect_paths(source)
+        total = len(paths)
+        if not total:
+            raise CommandError(f"No images found in {source}")
+
+        fingerprint = hashlib.sha256('\n'.join(paths).encode()).hexdigest()
+        checkpoint = options['checkpoint'] or os.path.abspath(source).rstrip(os.sep) + '.screening.json'
+        done = self.load_checkpoint(checkpoint, fingerprint, options['restart'])
+        if done:
+            self.stdout.write(f"Resuming after {done} of {total} images")
+
+        detector.get()
+        batch_size = max(1, options['batch_size'])
+        chunk_size = max(batch_size, options['chunk_size'])
+        batches = [paths[i:i + batch_size] for i in range(done, total, batch_size)]
+
+        started = time.monotonic()
+        processed = failed = 0
+        pending = []
+        pending_inputs = 0
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as pool:
+            # Keep a few batches decoding while the current one is inferred
+            window = max(1, options['prefetch']) + 1
+            futures = [pool.submit(self.prepare, b) for b in batches[:window]]
+            for index, batch_paths in enumerate(batches):
+                ok_paths, batch = futures[index].result()
+                futures[index] = None
+                if index + window < len(batches):
+                    futures.append(pool.submit(self.prepare, batches[index + window]))
+
+                # One detector per batch, so a hot reload never mislabels a grade
+                model = detector.get()
+                for path, (result, confidence) in zip(ok_paths, self.infer(model, batch)):
+                    if result == "Error":
+                        failed += 1
+                        continue
+                    pending.append(self.build_test(
+                        path, result, confidence, model.prediction_version, options['store_images']
+                    ))
+                failed += len(batch_paths) - len(ok_paths)
+                pending_inputs += len(batch_paths)
+
+                last = index == len(batches) - 1
+                if pending_inputs >= chunk_size or last:
+                    self.flush(pending)
+                    processed += len(pending)
+                    done += pending_inputs
+                    pending, pending_inputs = [], 0
+                    self.save_checkpoint(checkpoint, fingerprint, done, total)
+
+                    elapsed = time.monotonic() - started
+                    rate = (processed + failed) / elapsed if elapsed else 0.0
+                    self.stdout.write(f"{done}/{total} images, {failed} failed, {rate:.1f} images/s")
+
+        elapsed = time.monotonic() - started
+        rate = (processed + failed) / elapsed if elapsed else 0.0
+        self.stdout.write(self.style.SUCCESS(
+            f"Screened {processed} images ({failed} failed) in {elapsed:.1f}s: {rate:.1f} images/s"
+        ))
+        if done >= total and os.path.exists(checkpoint):
+            os.remove(checkpoint)
@@ -0,0 +1,233 @@
+"""
+Latency and error metrics for the detection pipeline.
+
+``stage(name)`` times one step of a request (request parsing, form
+validation, image decode, preprocessing, inference, the database write,
+template rendering). Each timing goes into the per-request list that
+``ServerTimingMiddleware`` sends back as a ``Server-Timing`` header, and
+into a process-wide histogram. ``/metrics`` renders every metric in the
+Prometheus text format. Metrics are kept per process, so each worker of
+a multi-process server is scraped on its own (or aggregated by the
+scraper).
+"""
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+# Upper bounds in seconds, from sub-millisecond decodes to slow requests
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_items(items))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0.0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_items(self, items):
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """Register a function returning extra exposition lines at scrape time"""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collect in self._collectors:
+            try:
+                lines.extend(collect())
+            except Exception as e:
+                print(f"Metrics collector failed: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    'dr_stage_seconds', "Time spent in each step of handling a detection", ['stage'],
+))
+request_seconds = registry.register(Histogram(
+    'dr_request_seconds', "Total request latency by view and method", ['view', 'method'],
+))
+requests_total = registry.register(Counter(
+    'dr_requests_total', "Requests handled, by view and status code", ['view', 'status'],
+))
+errors_total = registry.register(Counter(
+    'dr_errors_total', "Errors by where they happened", ['where'],
+))
+inference_batch_size = registry.register(Histogram(
+    'dr_inference_batch_size', "Images per model call", buckets=BATCH_SIZE_BUCKETS,
+))
+model_load_seconds = registry.register(Gauge(
+    'dr_model_load_seconds', "Time taken to load the model, by backend and version", ['backend', 'version'],
+))
+
+# Timings of the request being handled, as (stage, seconds) pairs
+_request_timings = contextvars.ContextVar('dr_request_timings', default=None)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as one stage of the current request"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def server_timing_header(timings, total=None):
+    """Server-Timing value with one entry per stage, repeated stages summed"""
+    durations = {}
+    for name, seconds in timings:
+        durations[name] = durations.get(name, 0.0) + seconds
+    if total is not None:
+        durations['total'] = total
+    return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items())
+
+
+def ServerTimingMiddleware(get_response):
+    """Collect stage timings per request and report them in a Server-Timing header"""
+
+    def start(request):
+        timings = []
+        return timings, _request_timings.set(timings), time.perf_counter()
+
+    def finish(request, response, timings, token, started):
+        _request_timings.reset(token)
+        elapsed = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'other'
+        request_seconds.observe(elapsed, view=view, method=request.method)
+        requests_total.inc(view=view, status=response.status_code)
+        if response.status_code >= 500:
+            errors_total.inc(where='request')
+        if timings:
+            response['Server-Timing'] = server_timing_header(timings, elapsed)
+        return response
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            timings, token, started = start(request)
+            try:
+                response = await get_response(request)
+            except Exception:
+                _request_timings.reset(token)
+                errors_total.inc(where='request')
+                raise
+            return finish(request, response, timings, token, started)
+
+        return markcoroutinefunction(middleware)
+
+    def middleware(request):
+        timings, token, started = start(request)
+        try:
+            response = get_response(request)
+        except Exception:
+            _request_timings.reset(token)
+            errors_total.inc(where='request')
+            raise
+        return finish(request, response, timings, token, started)
+
+    return middleware
+
+
+ServerTimingMiddleware.sync_capable = True
+ServerTimingMiddleware.async_capable = True
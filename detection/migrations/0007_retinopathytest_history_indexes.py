@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('detection', '0006_detectionjob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='retinopathytest',
+            index=models.Index(fields=['-created_at', '-id'], name='test_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='retinopathytest',
+            index=models.Index(fields=['result', '-created_at', '-id'], name='test_result_created_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('detection', '0008_storedfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='retinopathytest',
+            name='model_version',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('detection', '0009_retinopathytest_model_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TestGrade',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model_version', models.CharField(max_length=100)),
+                ('result', models.CharField(choices=[('no_dr', 'No Diabetic Retinopathy'), ('mild', 'Mild Diabetic Retinopathy'), ('moderate', 'Moderate Diabetic Retinopathy'), ('severe', 'Severe Diabetic Retinopathy'), ('proliferative', 'Proliferative Diabetic Retinopathy')], max_length=50)),
+                ('confidence', models.FloatField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('test', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='grades', to='detection.retinopathytest')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('model_version', 'test'), name='grade_version_test_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,270 @@
+"""
+Versioned model registry with hot reload.
+
+Model files are copied into ``MODEL_REGISTRY_DIR``, one directory per
+version, and described by a ``registry.json`` manifest. The manifest
+records each version's file and its TFLite/ONNX exports with their SHA-256,
+the registration time, and which version is active. Every file is checked
+against its digest before a version is activated or loaded. ``manage.py model_registry`` registers, activates,
+lists and verifies versions. Without a manifest the detector loads
+``MODEL_PATH`` as before.
+
+Every process that loads the detector starts a ``ModelWatcher``. The
+watcher checks the manifest every ``MODEL_REGISTRY_POLL_SECONDS``. When
+the active version changes, it builds and warms up the new detector in
+its own thread, then swaps it in with one assignment. Requests that
+already hold the old detector finish on it, and the old model is freed
+once they are done.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from .backends import CONVERTED_SUFFIXES
+
+MANIFEST_NAME = 'registry.json'
+
+# ``converted`` holds a (backend, path, sha256) triple per TFLite/ONNX export
+ModelVersion = namedtuple('ModelVersion', ['version', 'path', 'sha256', 'converted'], defaults=((),))
+
+
+class ModelIntegrityError(Exception):
+    """A registered model file is missing or does not match its checksum"""
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelRegistry:
+    def __init__(self, root=None):
+        self._root = root
+
+    @property
+    def root(self):
+        # Read from settings on use, so override_settings applies
+        return self._root or getattr(
+            settings, 'MODEL_REGISTRY_DIR', os.path.join(os.path.dirname(settings.MODEL_PATH), 'registry')
+        )
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, MANIFEST_NAME)
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def signature(self):
+        """Changes whenever the manifest is rewritten; cheap enough to poll"""
+        try:
+            st = os.stat(self.manifest_path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'active': None, 'versions': {}}
+
+    def save(self, manifest):
+        # Write a temporary file and rename it over the manifest, so a
+        # watcher never reads a half-written one
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix='.registry-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            # mkstemp creates the file 0600; web workers under another user read it
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.manifest_path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def _entry(self, version, info):
+        converted = tuple(
+            (backend, os.path.join(self.root, export['file']), export['sha256'])
+            for backend, export in sorted(info.get('converted', {}).items())
+        )
+        return ModelVersion(version, os.path.join(self.root, info['file']), info['sha256'], converted)
+
+    def get(self, version):
+        info = self.load()['versions'].get(version)
+        if info is None:
+            raise KeyError(f"Unknown model version {version!r}")
+        return self._entry(version, info)
+
+    def active(self):
+        """The active ModelVersion, or None when no version is active"""
+        manifest = self.load()
+        version = manifest.get('active')
+        if not version or version not in manifest['versions']:
+            return None
+        return self._entry(version, manifest['versions'][version])
+
+    def versions(self):
+        manifest = self.load()
+        return [
+            dict(info, version=version, active=version == manifest.get('active'))
+            for version, info in sorted(manifest['versions'].items(), key=lambda item: item[1]['registered_at'])
+        ]
+
+    def register(self, path, version=None, activate=False, notes=''):
+        """Copy a model file (and its converted siblings) into the registry"""
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        manifest = self.load()
+        version = version or f"v{len(manifest['versions']) + 1}"
+        if version in manifest['versions']:
+            raise ValueError(f"Model version {version!r} is already registered")
+
+        directory = os.path.join(self.root, version)
+        if os.path.exists(directory):
+            raise ValueError(f"{directory} already exists but is not in the manifest")
+        # Copy and hash in a staging directory renamed into place at the end,
+        # so a failed registration leaves nothing behind under the version name
+        staging = os.path.join(self.root, f'.{version}-{uuid.uuid4().hex}')
+        # Not mkdtemp: its 0700 mode would keep other users from the model
+        os.makedirs(staging)
+        try:
+            filename = os.path.basename(path)
+            shutil.copy2(path, os.path.join(staging, filename))
+            # TFLite/ONNX exports made by convert_model sit next to the model
+            stem = os.path.splitext(path)[0]
+            converted = {}
+            for backend, suffix in CONVERTED_SUFFIXES.items():
+                if os.path.exists(stem + suffix):
+                    export = os.path.basename(stem + suffix)
+                    shutil.copy2(stem + suffix, os.path.join(staging, export))
+                    converted[backend] = {
+                        'file': os.path.join(version, export),
+                        'sha256': file_sha256(os.path.join(staging, export)),
+                    }
+            sha256 = file_sha256(os.path.join(staging, filename))
+            os.rename(staging, directory)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        manifest['versions'][version] = {
+            'file': os.path.join(version, filename),
+            'sha256': sha256,
+            'converted': converted,
+            'size': os.path.getsize(path),
+            'registered_at': timezone.now().isoformat(),
+            'notes': notes,
+        }
+        if activate:
+            manifest['active'] = version
+        try:
+            self.save(manifest)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return self.get(version)
+
+    def activate(self, version):
+        manifest = self.load()
+        if version not in manifest['versions']:
+            raise KeyError(f"Unknown model version {version!r}")
+        manifest['active'] = version
+        self.save(manifest)
+        return self.get(version)
+
+    def verify(self, model, backends=None):
+        """Raise ModelIntegrityError unless the version's files match their registered checksums
+
+        ``backends`` limits the check of converted exports to those backends
+        (the model file itself is always checked); None checks them all.
+        """
+        files = [(model.path, model.sha256)]
+        files += [(path, sha256) for backend, path, sha256 in model.converted
+                  if backends is None or backend in backends]
+        for path, sha256 in files:
+            if not os.path.exists(path):
+                raise ModelIntegrityError(f"Model file {path} for version {model.version} is missing")
+            if file_sha256(path) != sha256:
+                raise ModelIntegrityError(f"Model file {path} does not match the checksum of version {model.version}")
+
+
+registry = ModelRegistry()
+
+
+class ModelWatcher:
+    """Swap a LazyDetector to the active registry version whenever it changes"""
+
+    def __init__(self, target, registry=registry, poll_seconds=10.0):
+        self.target = target
+        self.registry = registry
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._signature = None
+        self.reloads = 0
+        self.failures = 0
+
+    def ensure_started(self):
+        # Like JobWorkerPool: threads do not survive a fork, so each process starts its own
+        if not self.poll_seconds:
+            return
+        pid = os.getpid()
+        if self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == pid and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='dr-model-watcher', daemon=True)
+            self._pid = pid
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Model registry watcher error: {e}")
+
+    def check(self):
+        """Reload when the active version differs from the loaded one; True if it did"""
+        signature = self.registry.signature()
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        model = self.registry.active()
+        current = self.target._instance
+        if model is None or current is None or current.registry_model == model:
+            return False
+
+        started = time.monotonic()
+        try:
+            self.target.reload(model)
+        except Exception as e:
+            self.failures += 1
+            print(f"Could not load model version {model.version}, keeping {current.model_version}: {e}")
+            return False
+        self.reloads += 1
+        print(f"Loaded model version {model.version} in {time.monotonic() - started:.1f}s")
+        return True
+
+
+def build_model_watcher(target):
+    return ModelWatcher(target, poll_seconds=getattr(settings, 'MODEL_REGISTRY_POLL_SECONDS', 10.0))
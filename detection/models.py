@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 
 class RetinopathyTest(models.Model):
@@ -11,8 +13,17 @@ class RetinopathyTest(models.Model):
         ('proliferative', 'Proliferative Diabetic Retinopathy'),
     ])
     confidence = models.FloatField()
+    # Registry version (or file fingerprint) of the model that produced the result
+    model_version = models.CharField(max_length=100, blank=True, default='')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Test history pages seek on (created_at, id), optionally within one result
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='test_created_idx'),
+            models.Index(fields=['result', '-created_at', '-id'], name='test_result_created_idx'),
+        ]
+
     def __str__(self):
         return f"Test {self.id} - {self.result}"
 
@@ -81,3 +92,56 @@ class DietaryRecommendation(models.Model):
         if self.country:
             return f"Diet for {self.get_condition_display()} - {self.country.name}"
         return f"Default Diet for {self.get_condition_display()}"
+
+
+class DetectionJob(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True)
+    image = models.FileField(upload_to='detection_jobs/', blank=True)
+    keep_image = models.BooleanField(default=True, help_text="Attach the image to the resulting test")
+    country = models.ForeignKey(Country, on_delete=models.CASCADE)
+    test = models.ForeignKey(RetinopathyTest, on_delete=models.SET_NULL, null=True, blank=True)
+    result = models.JSONField(null=True, blank=True, help_text="Final JSON payload returned to the client")
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Job {self.id} - {self.status}"
+
+
+class StoredFile(models.Model):
+    """Reference count of a content-addressed media file shared by identical uploads"""
+    name = models.CharField(max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(default=0)
+    references = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.references} refs)"
+
+
+class TestGrade(models.Model):
+    """The grade one model version gave a stored test, written by rescore_tests"""
+    test = models.ForeignKey(RetinopathyTest, on_delete=models.CASCADE, related_name='grades')
+    model_version = models.CharField(max_length=100)
+    result = models.CharField(max_length=50, choices=RetinopathyTest._meta.get_field('result').choices)
+    confidence = models.FloatField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # One grade per version and test; the index also serves per-version scans
+        constraints = [
+            models.UniqueConstraint(fields=['model_version', 'test'], name='grade_version_test_uniq'),
+        ]
+
+    def __str__(self):
+        return f"Test {self.test_id} - {self.result} ({self.model_version})"
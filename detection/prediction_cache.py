@@ -0,0 +1,138 @@
+"""
+Prediction cache for repeated uploads.
+
+Results are keyed by the SHA-256 of the raw image bytes and the version of
+the model that produced them. A small in-process LRU answers repeats from
+the same worker, and the ``PREDICTION_CACHE_ALIAS`` Django cache shares
+results between workers and restarts. Without an alias only the in-process
+LRU exists.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def model_fingerprint(model_path=None):
+    """Version string for the model file, changing whenever the file does"""
+    model_path = model_path or settings.MODEL_PATH
+    try:
+        st = os.stat(model_path)
+    except OSError:
+        return 'placeholder'
+    return f"{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+class PredictionCache:
+    def __init__(self, max_entries=1024, cache_alias=None, timeout=None):
+        self.max_entries = max(0, int(max_entries))
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = None
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def make_key(self, image_data, model_version, digest=None):
+        """Cache key for raw image bytes predicted by the given model version
+
+        ``digest`` is the SHA-256 of the bytes when the caller already has it.
+        """
+        if model_version != self._version:
+            # A new model makes every in-process entry stale; persistent
+            # entries are simply never looked up again under the new key.
+            with self._lock:
+                if model_version != self._version:
+                    if self._entries:
+                        self.invalidations += 1
+                    self._entries.clear()
+                    self._version = model_version
+        digest = digest or hashlib.sha256(image_data).hexdigest()
+        return f"dr-prediction:{model_version}:{digest}"
+
+    def _backend(self):
+        if not self.cache_alias:
+            return None
+        return caches[self.cache_alias]
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+        value = None
+        backend = self._backend()
+        if backend is not None:
+            try:
+                value = backend.get(key)
+            except Exception as e:
+                print(f"Prediction cache lookup failed: {e}")
+
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        value = tuple(value)
+        with self._lock:
+            self.persistent_hits += 1
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        value = tuple(value)
+        self._remember(key, value)
+        backend = self._backend()
+        if backend is not None:
+            try:
+                backend.set(key, value, self.timeout)
+            except Exception as e:
+                print(f"Prediction cache store failed: {e}")
+
+    def _remember(self, key, value):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'persistent_hits': self.persistent_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'model_version': self._version,
+            }
+
+
+def build_prediction_cache():
+    """Create the cache configured in settings, or None when it is disabled"""
+    if not getattr(settings, 'PREDICTION_CACHE', True):
+        return None
+    return PredictionCache(
+        max_entries=getattr(settings, 'PREDICTION_CACHE_SIZE', 1024),
+        cache_alias=getattr(settings, 'PREDICTION_CACHE_ALIAS', None),
+        timeout=getattr(settings, 'PREDICTION_CACHE_TIMEOUT', None),
+    )
@@ -0,0 +1,155 @@
+"""
+NumPy preprocessing pipeline for the retinopathy model.
+
+Images are decoded and resized with Pillow, the autocontrast and histogram
+equalization lookup tables for the whole batch are computed at once as
+array operations and applied in a single pass, and the result is written
+into a uint8 staging batch that is scaled into a float32 batch with one
+vectorized divide. Callers that preprocess repeatedly can pass both
+buffers in (``staging`` and ``out``) so nothing is allocated per batch.
+
+The lookup tables reproduce ``ImageOps.autocontrast`` and
+``ImageOps.equalize`` exactly, so the output matches the original
+per-image PIL pipeline (``reference_preprocess``) to within
+``PARITY_TOLERANCE`` (in practice the arrays are identical) when images
+are decoded at full resolution (``oversample=None``).
+
+With ``oversample`` set, JPEGs are decoded by libjpeg at a reduced scale
+that is still at least ``oversample`` times the model input size, and
+other formats are shrunk with ``Image.reduce`` before the final resize.
+This changes pixel values slightly but avoids decoding 4000 px camera
+images in full.
+"""
+import io
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from .metrics import stage
+
+# Maximum absolute difference allowed against reference_preprocess
+PARITY_TOLERANCE = 1e-6
+
+_IDENTITY = np.arange(256, dtype=np.int64)
+
+
+def open_image(img):
+    """Return a PIL image for raw bytes, a file-like object or an image"""
+    if isinstance(img, (bytes, bytearray)):
+        return Image.open(io.BytesIO(img))
+    if isinstance(img, Image.Image):
+        return img
+    return Image.open(img)
+
+
+def load_resized(img, size=(224, 224), oversample=None):
+    """Decode an image to RGB at the given size, decoding large JPEGs at reduced scale"""
+    img = open_image(img)
+    if oversample:
+        width, height = size
+        # draft() only affects JPEGs that have not been loaded yet; for
+        # PNG, BMP, TIFF and in-memory images it does nothing.
+        img.draft('RGB', (int(width * oversample), int(height * oversample)))
+        return img.convert('RGB').resize(size, reducing_gap=oversample)
+    return img.convert('RGB').resize(size)
+
+
+def reference_preprocess(img, size=(224, 224), enhance=True):
+    """The original one-image PIL pipeline, kept as the parity baseline"""
+    img = open_image(img).convert('RGB').resize(size)
+    if enhance:
+        img = ImageOps.autocontrast(img)
+        img = ImageOps.equalize(img)
+    img_array = np.asarray(img, dtype=np.float32)[np.newaxis]
+    img_array /= 255.0
+    return img_array
+
+
+def _autocontrast_luts(hist):
+    """Per-channel LUTs equivalent to ImageOps.autocontrast(cutoff=0)"""
+    present = hist > 0
+    lo = np.argmax(present, axis=-1)
+    hi = 255 - np.argmax(present[..., ::-1], axis=-1)
+    flat = hi <= lo
+    span = np.where(flat, 1, hi - lo)
+    scale = 255.0 / span
+    offset = -lo * scale
+    luts = (_IDENTITY * scale[..., None] + offset[..., None]).astype(np.int64)
+    np.clip(luts, 0, 255, out=luts)
+    luts[flat] = _IDENTITY
+    return luts
+
+
+def _equalize_luts(hist):
+    """Per-channel LUTs equivalent to ImageOps.equalize()"""
+    present = hist > 0
+    last = 255 - np.argmax(present[..., ::-1], axis=-1)
+    last_count = np.take_along_axis(hist, last[..., None], axis=-1)[..., 0]
+    step = (hist.sum(axis=-1) - last_count) // 255
+    identity = (present.sum(axis=-1) <= 1) | (step == 0)
+    safe_step = np.where(identity, 1, step)
+    running = np.cumsum(hist, axis=-1) - hist
+    luts = (safe_step[..., None] // 2 + running) // safe_step[..., None]
+    np.clip(luts, 0, 255, out=luts)
+    luts[identity] = _IDENTITY
+    return luts
+
+
+def _remap_histograms(hist, luts):
+    """Histograms of the images after applying luts, computed from hist alone"""
+    bins = hist.shape[0] * hist.shape[1]
+    index = luts.reshape(bins, 256) + (np.arange(bins) * 256)[:, None]
+    remapped = np.bincount(index.ravel(), weights=hist.ravel(), minlength=bins * 256)
+    return remapped.astype(np.int64).reshape(hist.shape)
+
+
+def enhance_luts(hist):
+    """Combined autocontrast + equalize LUTs for an (N, 3, 256) histogram batch.
+
+    Equalization needs the histogram of the autocontrasted image, which is
+    derived from the original histogram, so both steps collapse into one
+    lookup table per channel and the pixels are only touched once.
+    """
+    hist = np.asarray(hist, dtype=np.int64).reshape(-1, 3, 256)
+    contrast = _autocontrast_luts(hist)
+    equalize = _equalize_luts(_remap_histograms(hist, contrast))
+    return np.take_along_axis(equalize, contrast, axis=-1).astype(np.uint8)
+
+
+def _batch_buffer(buffer, n, height, width, dtype, name):
+    if buffer is None:
+        return np.empty((n, height, width, 3), dtype=dtype)
+    if buffer.shape[0] < n or buffer.shape[1:] != (height, width, 3) or buffer.dtype != dtype:
+        raise ValueError(f"{name} buffer does not fit the batch")
+    return buffer[:n]
+
+
+def preprocess_batch(images, size=(224, 224), enhance=True, out=None, oversample=None, staging=None):
+    """Preprocess N images into a float32 (N, height, width, 3) batch in [0, 1].
+
+    ``out`` may be a preallocated float32 buffer and ``staging`` a uint8 one,
+    each with room for at least N images; the filled slice of ``out`` is
+    returned. ``oversample`` enables the reduced-resolution decode described
+    in the module docstring.
+    """
+    n = len(images)
+    width, height = size
+    out = _batch_buffer(out, n, height, width, np.float32, "Output")
+    staging = _batch_buffer(staging, n, height, width, np.uint8, "Staging")
+
+    with stage('decode'):
+        resized = [load_resized(img, size, oversample) for img in images]
+
+    with stage('preprocess'):
+        if enhance and n:
+            # Histograms come from Pillow's C code; the LUTs for the whole batch
+            # are computed at once and applied in a single pass per image.
+            luts = enhance_luts([img.histogram() for img in resized])
+            for i, img in enumerate(resized):
+                staging[i] = img.point(luts[i].ravel().tolist())
+        else:
+            for i, img in enumerate(resized):
+                staging[i] = img
+
+        np.divide(staging, np.float32(255.0), out=out, dtype=np.float32)
+    return out
@@ -0,0 +1,102 @@
+"""
+In-memory index of dietary recommendations.
+
+The table is small and read on every result page, so it is loaded once per
+process and answered from dictionaries: the country-specific row for a
+(condition, country) pair, else the condition's default row. Saving or
+deleting a ``DietaryRecommendation`` or ``Country`` drops the index in the
+process that made the change; other processes reload it after
+``DIETARY_RECOMMENDATION_CACHE_SECONDS``.
+"""
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from .models import Country, DietaryRecommendation
+
+
+class RecommendationResolver:
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._index = None
+        self._loaded_at = 0.0
+        self.loads = 0
+
+    def _load(self):
+        by_country, defaults, first = {}, {}, {}
+        # pk order keeps the same row .first() picked when several match
+        for rec in DietaryRecommendation.objects.select_related('country').order_by('pk'):
+            if rec.country_id is not None:
+                by_country[(rec.condition, rec.country_id)] = rec
+            if rec.is_default:
+                defaults.setdefault(rec.condition, rec)
+            first.setdefault(rec.condition, rec)
+        return by_country, defaults, first
+
+    def _fresh(self, index):
+        return index is not None and (not self.max_age or time.monotonic() - self._loaded_at < self.max_age)
+
+    def _get_index(self):
+        index = self._index
+        if self._fresh(index):
+            return index
+        with self._lock:
+            if self._index is index:
+                self._index = self._load()
+                self._loaded_at = time.monotonic()
+                self.loads += 1
+            return self._index
+
+    @property
+    def is_loaded(self):
+        """Whether lookups can be answered without a query"""
+        return self._fresh(self._index)
+
+    def resolve(self, condition, country=None):
+        """Recommendation for the condition in the country, else the condition's default"""
+        if not condition:
+            return None
+        by_country, defaults, _ = self._get_index()
+        country_id = getattr(country, 'pk', country)
+        if country_id not in (None, ''):
+            try:
+                rec = by_country.get((condition, int(country_id)))
+            except (TypeError, ValueError):
+                rec = None
+            if rec is not None:
+                return rec
+        return defaults.get(condition)
+
+    def any_for(self, condition):
+        """First recommendation for the condition regardless of country"""
+        return self._get_index()[2].get(condition)
+
+    async def aresolve(self, condition, country=None):
+        if self.is_loaded:
+            return self.resolve(condition, country)
+        return await sync_to_async(self.resolve)(condition, country)
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+
+def _invalidate_on_commit(**kwargs):
+    # Reloading before the transaction commits would read the old rows again
+    transaction.on_commit(resolver.invalidate, using=kwargs.get('using'))
+
+
+resolver = RecommendationResolver(
+    max_age=getattr(settings, 'DIETARY_RECOMMENDATION_CACHE_SECONDS', 300),
+)
+
+
+def connect_signals():
+    for model in (DietaryRecommendation, Country):
+        post_save.connect(_invalidate_on_commit, sender=model, dispatch_uid=f'recommendations-{model.__name__}-save')
+        post_delete.connect(_invalidate_on_commit, sender=model, dispatch_uid=f'recommendations-{model.__name__}-delete')
@@ -0,0 +1,187 @@
+"""
+Content-addressed media storage.
+
+Uploads are named by the SHA-256 of their bytes and sharded into nested
+directories under one root, e.g. ``retinopathy_images/3f/a9/3fa9...e1.jpg``,
+so no directory grows past a few thousand entries. The root ignores the
+field's ``upload_to``: a job upload and the test it becomes are the same
+file. Saving bytes that are already stored only adds a reference in
+``StoredFile``; deleting drops one, and the file is removed with its last
+reference. 8-bit PNG uploads (camera captures from older pages) can be
+transcoded to lossless WebP, which keeps every pixel and is usually much
+smaller; other PNGs are stored as they are.
+"""
+import hashlib
+import io
+import os
+import posixpath
+import re
+import threading
+from collections import Counter
+
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+from PIL import Image
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Image modes lossless WebP stores pixel for pixel
+WEBP_EXACT_MODES = ('RGB', 'RGBA', 'L', 'LA', 'P', '1')
+HASHED_NAME = re.compile(r'(?:^|/)(?:[0-9a-f]{2}/)+([0-9a-f]{64})(?:\.\w+)?$')
+
+
+def is_content_addressed(name):
+    return bool(HASHED_NAME.search(name or ''))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    def __init__(self, shard_depth=2, transcode_png=None, directory='retinopathy_images', **kwargs):
+        super().__init__(**kwargs)
+        self.shard_depth = shard_depth
+        self.transcode_png = transcode_png
+        self.directory = directory
+
+    def hashed_name(self, digest, extension):
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.shard_depth)]
+        return posixpath.join(self.directory, *shards, digest + extension.lower())
+
+    def in_root(self, name):
+        """Whether a stored name is content-addressed under this storage's root"""
+        return is_content_addressed(name) and name.startswith(self.directory.rstrip('/') + '/')
+
+    def get_available_name(self, name, max_length=None):
+        # _save picks the final name from the content, so never probe the disk here
+        return name
+
+    def _read(self, content):
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        if hasattr(content, 'chunks'):
+            return b''.join(content.chunks())
+        return content.read()
+
+    def _transcode(self, data, image=None):
+        """Lossless WebP bytes for a PNG, or None to keep the original"""
+        # WebP holds 8 bits per channel; Pillow would quietly drop the low
+        # byte of a 16-bit PNG (IHDR bit depth), even one it opens as RGB
+        if len(data) < 25 or data[24] > 8:
+            return None
+        try:
+            img = image or Image.open(io.BytesIO(data))
+            if img.mode not in WEBP_EXACT_MODES:
+                return None
+            img.load()
+            out = io.BytesIO()
+            # For lossless WebP quality is the encoder effort; the low-effort
+            # setting keeps most of the size saving at a fraction of the time
+            img.save(out, 'WEBP', lossless=True, quality=0, method=1, exact=True,
+                     icc_profile=img.info.get('icc_profile'))
+        except Exception as e:
+            print(f"Could not transcode PNG upload, storing it as is: {e}")
+            return None
+        return out.getvalue() if out.tell() < len(data) else None
+
+    def _save(self, name, content):
+        from .models import StoredFile
+
+        # Uploads validated by the form carry their bytes, hash and decoded
+        # image (detection.uploads), so nothing is read or hashed again
+        decoded = getattr(content, 'decoded', None)
+        if decoded is not None:
+            data, digest = decoded.data, decoded.digest
+        else:
+            data = self._read(content)
+            digest = hashlib.sha256(data).hexdigest()
+        # The upload_to directory is dropped: every file lives under one root
+        extension = os.path.splitext(posixpath.basename(name.replace('\\', '/')))[1]
+
+        if self.transcode_png and data.startswith(PNG_SIGNATURE):
+            # Identical PNGs map to the same WebP, so it is named by the PNG hash
+            name = self.hashed_name(digest, '.webp')
+            if StoredFile.objects.filter(name=name).update(references=F('references') + 1):
+                return name
+            webp = self._transcode(data, decoded.image if decoded is not None else None)
+            if webp is not None:
+                return self._save_new(name, webp)
+            # Not smaller or not decodable: keep the PNG
+
+        return self._save_new(self.hashed_name(digest, extension), data)
+
+    def _save_new(self, name, data):
+        from .models import StoredFile
+
+        if StoredFile.objects.filter(name=name).update(references=F('references') + 1):
+            return name
+        if not self.exists(name):
+            self._write(name, data)
+        try:
+            with transaction.atomic():
+                StoredFile.objects.create(name=name, size=len(data))
+        except IntegrityError:
+            # Another request stored the same bytes meanwhile
+            StoredFile.objects.filter(name=name).update(references=F('references') + 1)
+        return name
+
+    def _write(self, name, data):
+        # Writers of the same name write the same bytes, so the last rename
+        # wins harmlessly (FileSystemStorage would look for a free name instead)
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.directory_permissions_mode is not None:
+            os.chmod(os.path.dirname(path), self.directory_permissions_mode)
+        tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if self.file_permissions_mode is not None:
+            os.chmod(tmp, self.file_permissions_mode)
+        os.replace(tmp, path)
+
+    def delete(self, name):
+        from .models import StoredFile
+
+        if not name:
+            raise ValueError("The name must be given to delete().")
+        with transaction.atomic():
+            stored = StoredFile.objects.select_for_update().filter(name=name).first()
+            if stored is not None and stored.references > 1:
+                StoredFile.objects.filter(pk=stored.pk).update(references=F('references') - 1)
+                return
+            # Last reference, or a file stored before content addressing
+            super().delete(name)
+            if stored is not None:
+                stored.delete()
+
+    def release(self, names):
+        """Drop one reference per name in bulk and return the names left unreferenced.
+
+        The caller removes those files with delete_file(); names stored before
+        content addressing have no reference row and are always returned.
+        """
+        from .models import StoredFile
+
+        counts = Counter(names)
+        with transaction.atomic():
+            rows = StoredFile.objects.select_for_update().filter(name__in=counts).values_list('name', 'references')
+            drop, decrement = [], {}
+            for name, references in rows:
+                if references > counts[name]:
+                    decrement.setdefault(counts[name], []).append(name)
+                else:
+                    drop.append(name)
+            for count, group in decrement.items():
+                StoredFile.objects.filter(name__in=group).update(references=F('references') - count)
+            StoredFile.objects.filter(name__in=drop).delete()
+            tracked = set(drop) | {n for group in decrement.values() for n in group}
+            unreferenced = drop + [name for name in counts if name not in tracked]
+        return unreferenced
+
+    def delete_file(self, name):
+        """Remove the file itself, whatever its reference count"""
+        super().delete(name)
+
+    def references(self, name):
+        from .models import StoredFile
+
+        return StoredFile.objects.filter(name=name).values_list('references', flat=True).first() or 0
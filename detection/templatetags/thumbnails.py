@@ -0,0 +1,11 @@
+from django import template
+
+from detection.thumbnails import thumbnail_url as build_thumbnail_url
+
+register = template.Library()
+
+
+@register.filter
+def thumbnail_url(test, size='small'):
+    """URL of a test image thumbnail: {{ test|thumbnail_url:"medium" }}"""
+    return build_thumbnail_url(test, size)
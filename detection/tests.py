@@ -1,3 +1,779 @@
-from django.test import TestCase
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .admission import AdmissionController
+from .ai_model import BatcherClosed, MicroBatcher
+from .db import BufferedWriter, BufferedWriteTimeout
+from .forms import RetinopathyTestForm
+from .history import history_page
+from .inference_server import InferenceServer
+from .jobs import claim_job, job_pool, process_job, submit_job
+from .model_registry import ModelIntegrityError, ModelRegistry, ModelWatcher
+from .models import Country, DetectionJob, DietaryRecommendation, RetinopathyTest, TestGrade
+from .prediction_cache import PredictionCache, model_fingerprint
+from .preprocessing import PARITY_TOLERANCE, preprocess_batch, reference_preprocess
+from .recommendations import resolver
+from .storage import ContentAddressedStorage
+from .tta import augment_batch, average_views
+from .uploads import decode_upload
+
+
+def png_bytes(img):
+    out = io.BytesIO()
+    img.save(out, 'PNG')
+    return out.getvalue()
+
+
+def image_bytes(fmt='JPEG', size=(320, 240), seed=0):
+    pixels = np.random.default_rng(seed).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    out = io.BytesIO()
+    Image.fromarray(pixels).save(out, fmt)
+    return out.getvalue()
+
+
+class PreprocessingTests(TestCase):
+    def test_batch_matches_the_reference_pipeline(self):
+        rng = np.random.default_rng(5)
+        images = [
+            image_bytes('PNG', (300, 200), seed=1),
+            image_bytes('JPEG', (224, 224), seed=2),
+            # Narrow ranges and a flat channel exercise the LUT edge cases
+            png_bytes(Image.fromarray(rng.integers(90, 110, (150, 180, 3), dtype=np.uint8))),
+            png_bytes(Image.fromarray(np.dstack([
+                np.full((120, 160), 7, dtype=np.uint8),
+                rng.integers(0, 256, (120, 160), dtype=np.uint8),
+                rng.integers(200, 256, (120, 160), dtype=np.uint8),
+            ]))),
+        ]
+        batch = preprocess_batch(images)
+        reference = np.concatenate([reference_preprocess(img) for img in images])
+
+        self.assertEqual(batch.shape, (4, 224, 224, 3))
+        self.assertEqual(batch.dtype, np.float32)
+        self.assertLessEqual(float(np.abs(batch - reference).max()), PARITY_TOLERANCE)
+
+    def test_without_enhancement_only_scales(self):
+        images = [image_bytes('PNG', (224, 224), seed=3)]
+        np.testing.assert_array_equal(
+            preprocess_batch(images, enhance=False), reference_preprocess(images[0], enhance=False)
+        )
+
+    def test_batches_reuse_the_buffers_passed_in(self):
+        staging = np.empty((4, 224, 224, 3), dtype=np.uint8)
+        out = np.empty((4, 224, 224, 3), dtype=np.float32)
+        for seed in range(2):
+            images = [image_bytes('PNG', (260, 240), seed=seed + i) for i in range(3)]
+            batch = preprocess_batch(images, out=out, staging=staging)
+            self.assertTrue(np.shares_memory(batch, out))
+            np.testing.assert_array_equal(batch, preprocess_batch(images))
+
+        with self.assertRaises(ValueError):
+            preprocess_batch([image_bytes()] * 5, out=out, staging=staging)
+
+
+class PredictionCacheTests(TestCase):
+    def test_new_model_version_drops_cached_predictions(self):
+        cache = PredictionCache(max_entries=8)
+        old_key = cache.make_key(b'image', 'v1')
+        cache.set(old_key, ('mild', 0.9))
+        self.assertEqual(cache.get(old_key), ('mild', 0.9))
+
+        new_key = cache.make_key(b'image', 'v2')
+        self.assertNotEqual(new_key, old_key)
+        self.assertIsNone(cache.get(new_key))
+        self.assertEqual(cache.stats()['entries'], 0)
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+    def test_fingerprint_follows_the_model_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = f"{directory}/model.onnx"
+        with open(path, 'wb') as f:
+            f.write(b'first')
+        before = model_fingerprint(path)
+        with open(path, 'wb') as f:
+            f.write(b'second model')
+        self.assertNotEqual(model_fingerprint(path), before)
+
+    def test_shared_backend_answers_other_processes(self):
+        key = PredictionCache(cache_alias='default').make_key(b'image', 'v1')
+        PredictionCache(cache_alias='default').set(key, ('severe', 0.7))
+        # A fresh process has an empty LRU but finds the shared entry
+        other = PredictionCache(cache_alias='default')
+        self.assertEqual(other.get(key), ('severe', 0.7))
+        self.assertEqual(other.stats()['persistent_hits'], 1)
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.location, ignore_errors=True)
+        self.storage = ContentAddressedStorage(location=self.location, transcode_png=True)
+
+    def test_png_transcode_keeps_every_pixel(self):
+        y, x = np.mgrid[:96, :128]
+        pixels = np.stack([x * 2, y * 2, (x + y) % 256], axis=-1).astype(np.uint8)
+        name = self.storage.save('retinopathy_images/eye.png', ContentFile(png_bytes(Image.fromarray(pixels))))
+
+        self.assertTrue(name.endswith('.webp'))
+        with self.storage.open(name, 'rb') as f:
+            stored = np.asarray(Image.open(f).convert('RGB'))
+        np.testing.assert_array_equal(stored, pixels)
+
+    def test_16_bit_png_is_stored_unchanged(self):
+        y, x = np.mgrid[:96, :128]
+        data = png_bytes(Image.fromarray((x * 500 + y).astype(np.uint16)))
+        name = self.storage.save('retinopathy_images/eye.png', ContentFile(data))
+
+        self.assertTrue(name.endswith('.png'))
+        with self.storage.open(name, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_same_bytes_share_one_file_whatever_the_upload_directory(self):
+        data = b'not really an image'
+        job_name = self.storage.save('detection_jobs/upload.jpg', ContentFile(data))
+        test_name = self.storage.save('retinopathy_images/upload.jpg', ContentFile(data))
+
+        self.assertEqual(job_name, test_name)
+        self.assertTrue(job_name.startswith('retinopathy_images/'))
+        self.assertEqual(self.storage.references(job_name), 2)
+
+    def test_release_returns_names_without_references(self):
+        shared = self.storage.save('a.jpg', ContentFile(b'shared'))
+        self.storage.save('b.jpg', ContentFile(b'shared'))
+        single = self.storage.save('c.jpg', ContentFile(b'single'))
+
+        self.assertEqual(self.storage.release([shared, single]), [single])
+        self.assertEqual(self.storage.references(shared), 1)
+        self.assertEqual(self.storage.references(single), 0)
+        self.assertEqual(self.storage.release([shared]), [shared])
+
+
+class MicroBatcherTests(TestCase):
+    def test_concurrent_samples_share_a_model_call(self):
+        calls = []
+
+        def predict(batch):
+            calls.append(len(batch))
+            return batch * 2
+
+        batcher = MicroBatcher(predict, max_batch_size=4, max_wait_ms=200)
+        self.addCleanup(batcher.close)
+        samples = [np.full(3, i, dtype=np.float32) for i in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            rows = list(pool.map(batcher.submit, samples))
+
+        for sample, row in zip(samples, rows):
+            np.testing.assert_array_equal(row, sample * 2)
+        self.assertEqual(calls, [4])
+        self.assertEqual(batcher.stats()['full_flushes'], 1)
+
+    def test_model_errors_reach_every_caller(self):
+        def predict(batch):
+            raise ValueError("model failed")
+
+        batcher = MicroBatcher(predict, max_batch_size=2, max_wait_ms=1)
+        self.addCleanup(batcher.close)
+        with self.assertRaisesMessage(ValueError, "model failed"):
+            batcher.submit(np.zeros(3))
+
+    def test_close_answers_queued_samples_then_refuses_new_ones(self):
+        started, release = threading.Event(), threading.Event()
+
+        def predict(batch):
+            started.set()
+            release.wait(5)
+            return batch
+
+        batcher = MicroBatcher(predict, max_batch_size=1, max_wait_ms=0)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            # The first sample is in the model while the second waits in the queue
+            queued = [pool.submit(batcher.submit, np.full(3, 0))]
+            self.assertTrue(started.wait(5))
+            queued.append(pool.submit(batcher.submit, np.full(3, 1)))
+            while batcher.stats()['queue_depth'] == 0:
+                time.sleep(0.001)
+            batcher.close()
+            with self.assertRaises(BatcherClosed):
+                batcher.submit(np.zeros(3))
+            release.set()
+            for i, future in enumerate(queued):
+                np.testing.assert_array_equal(future.result(timeout=5), np.full(3, i))
+        batcher._worker.join(5)
+        self.assertFalse(batcher._worker.is_alive())
+
+    def test_submit_gives_up_after_the_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        batcher = MicroBatcher(lambda batch: release.wait(5) and batch, max_batch_size=1, timeout=0.05)
+        self.addCleanup(batcher.close)
+        with self.assertRaises(TimeoutError):
+            batcher.submit(np.zeros(3))
+
+
+class InferenceServerBatchingTests(TestCase):
+    def setUp(self):
+        self.calls = []
+        detector = mock.Mock()
+
+        def predict_batch(images):
+            self.calls.append(list(images))
+            if b'bad' in images:
+                raise ValueError("cannot identify image file")
+            return [('Mild', len(image)) for image in images]
+
+        detector.predict_batch.side_effect = predict_batch
+        detector.predict.side_effect = lambda image: ('Error', 0.0) if image == b'bad' else ('Mild', len(image))
+        patcher = mock.patch('detection.inference_server._worker_detector', detector)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def server(self, workers=1):
+        with override_settings(INFERENCE_MAX_BATCH_SIZE=4, INFERENCE_MAX_WAIT_MS=200):
+            server = InferenceServer(address='unused', authkey=b'key', workers=workers)
+        # Run the model process functions in this process
+        server.pool = mock.Mock(apply=lambda fn, args: fn(*args))
+        self.addCleanup(server.close)
+        return server
+
+    def test_concurrent_requests_share_a_model_process_call(self):
+        server = self.server()
+        images = [b'a' * n for n in range(1, 5)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(server._predict, images))
+
+        self.assertEqual(results, [('Mild', n) for n in range(1, 5)])
+        self.assertEqual(len(self.calls), 1)
+        self.assertCountEqual(self.calls[0], images)
+
+    def test_a_bad_image_only_fails_its_own_request(self):
+        server = self.server()
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(server._predict, [b'a', b'bad', b'aaa', b'aa']))
+        self.assertEqual(results, [('Mild', 1), ('Error', 0.0), ('Mild', 3), ('Mild', 2)])
+
+    def test_one_batcher_per_model_process(self):
+        self.assertEqual(len(self.server(workers=3).batchers), 3)
+        with override_settings(INFERENCE_BATCHING=False):
+            self.assertEqual(InferenceServer(address='unused', authkey=b'key', workers=3).batchers, [])
+
+
+class HistoryPageTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for i in range(7):
+            test = RetinopathyTest.objects.create(result='mild' if i % 2 else 'no_dr', confidence=0.5)
+            # Two tests per timestamp, so the id breaks ties
+            RetinopathyTest.objects.filter(id=test.id).update(created_at=now - timedelta(minutes=i // 2))
+        self.newest_first = list(RetinopathyTest.objects.order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def ids(self, page):
+        return [test.id for test in page['tests']]
+
+    def test_cursors_walk_forward_and_back(self):
+        first = history_page({}, page_size=3)
+        second = history_page({}, after=first['next_cursor'], page_size=3)
+        third = history_page({}, after=second['next_cursor'], page_size=3)
+
+        self.assertEqual(self.ids(first) + self.ids(second) + self.ids(third), self.newest_first)
+        self.assertIsNone(first['previous_cursor'])
+        self.assertIsNone(third['next_cursor'])
+
+        back = history_page({}, before=third['previous_cursor'], page_size=3)
+        self.assertEqual(self.ids(back), self.ids(second))
+        start = history_page({}, before=back['previous_cursor'], page_size=3)
+        self.assertEqual(self.ids(start), self.ids(first))
+        self.assertIsNone(start['previous_cursor'])
+
+    def test_filters_apply_to_every_page(self):
+        mild = list(RetinopathyTest.objects.filter(result='mild').order_by('-created_at', '-id')
+                    .values_list('id', flat=True))
+        first = history_page({'result': 'mild'}, page_size=2)
+        second = history_page({'result': 'mild'}, after=first['next_cursor'], page_size=2)
+        self.assertEqual(self.ids(first) + self.ids(second), mild)
+        self.assertIsNone(second['next_cursor'])
+
+    def test_malformed_cursor_starts_from_the_newest(self):
+        self.assertEqual(self.ids(history_page({}, after='garbage', page_size=3)), self.newest_first[:3])
+
+
+class RecommendationResolverTests(TestCase):
+    def setUp(self):
+        resolver.invalidate()
+        self.addCleanup(resolver.invalidate)
+        self.country = Country.objects.create(name='Testland', code='TL', common_foods='rice')
+        self.other = Country.objects.create(name='Otherland', code='OL', common_foods='bread')
+        self.default = DietaryRecommendation.objects.create(condition='mild', is_default=True)
+        self.local = DietaryRecommendation.objects.create(condition='mild', country=self.country)
+
+    def test_country_row_wins_over_the_default(self):
+        self.assertEqual(resolver.resolve('mild', self.country), self.local)
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.resolve('mild', self.other), self.default)
+            self.assertEqual(resolver.resolve('mild', str(self.country.pk)), self.local)
+            self.assertEqual(resolver.resolve('mild'), self.default)
+            self.assertIsNone(resolver.resolve('severe', self.country))
+
+    def test_saved_rows_are_seen_once_the_transaction_commits(self):
+        resolver.resolve('mild', self.country)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.local.morning_foods = 'Congee'
+            self.local.save()
+            # Still the index loaded before the change
+            self.assertTrue(resolver.is_loaded)
+        self.assertFalse(resolver.is_loaded)
+        self.assertEqual(resolver.resolve('mild', self.country).morning_foods, 'Congee')
+
+    def test_deleting_a_country_drops_its_rows(self):
+        resolver.resolve('mild', self.country)
+        with self.captureOnCommitCallbacks(execute=True):
+            country_id = self.country.pk
+            self.country.delete()
+        self.assertEqual(resolver.resolve('mild', country_id), self.default)
+
+
+class PurgeTestsCommandTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+    def screening(self, result='mild', days_ago=0, image=None):
+        test = RetinopathyTest(result=result, confidence=0.8)
+        if image is not None:
+            test.image = ContentFile(image, name='eye.png')
+        test.save()
+        RetinopathyTest.objects.filter(id=test.id).update(created_at=timezone.now() - timedelta(days=days_ago))
+        return test
+
+    def purge(self, *args):
+        out = io.StringIO()
+        call_command('purge_tests', *args, stdout=out)
+        return out.getvalue()
+
+    def test_old_tests_and_their_unshared_images_are_deleted(self):
+        shared = image_bytes('PNG', seed=1)
+        alone = self.screening(days_ago=30, image=image_bytes('PNG', seed=2))
+        old_copy = self.screening('no_dr', days_ago=30, image=shared)
+        recent = self.screening(image=shared)
+
+        output = self.purge('--older-than-days', '7', '--chunk-size', '1')
+
+        self.assertIn("Deleted 2 tests and 1 files", output)
+        self.assertEqual(list(RetinopathyTest.objects.values_list('id', flat=True)), [recent.id])
+        self.assertFalse(default_storage.exists(alone.image.name))
+        # Still referenced by the recent test
+        self.assertEqual(old_copy.image.name, recent.image.name)
+        self.assertTrue(default_storage.exists(recent.image.name))
+
+    def test_result_filter_and_dry_run(self):
+        self.screening('mild')
+        self.screening('severe')
+
+        output = self.purge('--result', 'mild', '--dry-run')
+        self.assertIn("Would delete 1 tests", output)
+        self.assertEqual(RetinopathyTest.objects.count(), 2)
+
+        self.purge('--result', 'mild')
+        self.assertEqual(list(RetinopathyTest.objects.values_list('result', flat=True)), ['severe'])
+
+    def test_a_filter_or_all_is_required(self):
+        self.screening()
+        with self.assertRaises(CommandError):
+            self.purge()
+        self.purge('--all')
+        self.assertFalse(RetinopathyTest.objects.exists())
+
+
+class RescoreTestsCommandTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+
+        # Grades every readable image 'Severe' without loading a model
+        self.model = mock.Mock(client=None, prediction_version='v2')
+        self.model.preprocess_images.side_effect = lambda images: np.zeros((len(images), 1), dtype=np.float32)
+        self.model.predict_array.side_effect = lambda batch: batch
+        self.model.decode_prediction.return_value = ('Severe', 0.9)
+        patcher = mock.patch(
+            'detection.management.commands.rescore_tests.Command.load_detector', return_value=self.model
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.graded = [
+            RetinopathyTest.objects.create(
+                result='mild', confidence=0.6, model_version='v1',
+                image=ContentFile(image_bytes('PNG', seed=i), name='eye.png'),
+            )
+            for i in range(3)
+        ]
+        self.missing = RetinopathyTest.objects.create(result='mild', confidence=0.6, image='retinopathy_images/gone.png')
+        self.no_image = RetinopathyTest.objects.create(result='mild', confidence=0.6)
+
+    def rescore(self, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('rescore_tests', '--batch-size', '2', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_grades_go_to_the_side_table_and_runs_resume(self):
+        output, errors = self.rescore()
+
+        self.assertIn("Graded 3 tests (1 failed)", output)
+        self.assertIn(f"Skipping test {self.missing.id}", errors)
+        self.assertCountEqual(
+            TestGrade.objects.filter(model_version='v2').values_list('test_id', 'result'),
+            [(test.id, 'severe') for test in self.graded],
+        )
+        # The tests themselves keep their result
+        self.assertEqual(set(RetinopathyTest.objects.values_list('result', flat=True)), {'mild'})
+
+        output, _ = self.rescore()
+        self.assertIn("Grading 1 tests", output)
+        self.assertEqual(TestGrade.objects.count(), 3)
+
+    def test_apply_keeps_the_previous_grade(self):
+        self.rescore('--apply')
+
+        for test in self.graded:
+            test.refresh_from_db()
+            self.assertEqual((test.result, test.model_version), ('severe', 'v2'))
+            previous = test.grades.get(model_version='v1')
+            self.assertEqual((previous.result, previous.confidence), ('mild', 0.6))
+        self.no_image.refresh_from_db()
+        self.assertEqual(self.no_image.result, 'mild')
+
+
+class BufferedWriterTests(TransactionTestCase):
+    # The write thread has its own connection, so rows must really be committed
+    def test_concurrent_saves_share_a_transaction(self):
+        writer = BufferedWriter(max_batch_size=4, max_wait_ms=200)
+        self.addCleanup(writer.close)
+        tests = [RetinopathyTest(result='mild', confidence=i / 10) for i in range(4)]
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            saved = list(pool.map(writer.save, tests))
+
+        self.assertTrue(all(test.pk for test in saved))
+        self.assertEqual(RetinopathyTest.objects.count(), 4)
+        self.assertEqual(writer.stats()['batches'], 1)
+
+    def test_save_gives_up_after_the_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        writer = BufferedWriter(max_batch_size=1, timeout=0.05)
+        self.addCleanup(writer.close)
+        with mock.patch.object(writer, '_flush', lambda batch: release.wait(5)):
+            with self.assertRaises(BufferedWriteTimeout):
+                writer.save(RetinopathyTest(result='mild', confidence=0.5))
+
+    def test_close_writes_queued_rows_and_stops_the_thread(self):
+        writer = BufferedWriter(max_batch_size=8, max_wait_ms=1000)
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            queued = pool.submit(writer.save, RetinopathyTest(result='mild', confidence=0.5))
+            while not writer._queue.unfinished_tasks:
+                time.sleep(0.001)
+            writer.close()
+            self.assertIsNotNone(queued.result(timeout=5).pk)
+        writer._worker.join(5)
+        self.assertFalse(writer._worker.is_alive())
+        # Later saves go straight to the database
+        self.assertIsNotNone(writer.save(RetinopathyTest(result='no_dr', confidence=0.5)).pk)
+        self.assertEqual(RetinopathyTest.objects.count(), 2)
+
+
+class DetectionJobTests(TestCase):
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        # Jobs are claimed by the tests themselves, not by worker threads
+        for name in ('notify', 'ensure_started'):
+            patcher = mock.patch.object(job_pool, name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.country = Country.objects.create(name='Testland', code='TL', common_foods='rice')
+
+    def submit(self, seed=0):
+        upload = SimpleUploadedFile('eye.png', image_bytes('PNG', seed=seed), content_type='image/png')
+        return submit_job(upload, self.country)
+
+    def status(self, job_id):
+        return self.client.get(reverse('detection_job_status', args=[job_id]))
+
+    def test_a_submitted_job_is_claimed_once(self):
+        job = self.submit()
+        self.assertEqual(job.status, 'pending')
+        job_pool.notify.assert_called_once_with(job.id)
+
+        claimed = claim_job(job.id)
+        self.assertEqual(claimed.id, job.id)
+        self.assertEqual(claimed.status, 'running')
+        self.assertIsNotNone(claimed.started_at)
+        self.assertIsNone(claim_job(job.id))
+        self.assertIsNone(claim_job())
+
+    def test_status_endpoint_follows_the_job(self):
+        job = self.submit()
+        response = self.status(job.id)
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['status'], 'pending')
+
+        DetectionJob.objects.filter(id=job.id).update(status='done', result={'success': True, 'result': 'Mild'})
+        response = self.status(job.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['result'], 'Mild')
+        self.assertEqual(response.json()['status'], 'done')
+
+        self.assertEqual(self.status(uuid.uuid4()).status_code, 404)
+
+    def test_failed_job_releases_its_image(self):
+        job = self.submit()
+        name = job.image.name
+        self.assertTrue(default_storage.exists(name))
+
+        with mock.patch('detection.views.run_detection', side_effect=RuntimeError("model failed")):
+            process_job(claim_job(job.id))
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, "model failed")
+        self.assertFalse(job.image)
+        self.assertFalse(default_storage.exists(name))
+        self.assertIn("model failed", self.status(job.id).json()['message'])
+
+    def test_purge_deletes_old_finished_jobs(self):
+        old, recent, waiting = self.submit(1), self.submit(2), self.submit(3)
+        long_ago = timezone.now() - timedelta(days=30)
+        DetectionJob.objects.filter(id=old.id).update(status='failed', finished_at=long_ago)
+        DetectionJob.objects.filter(id=recent.id).update(status='done', finished_at=timezone.now())
+        DetectionJob.objects.filter(id=waiting.id).update(created_at=long_ago)
+
+        call_command('purge_tests', jobs_older_than_days=7, stdout=io.StringIO())
+
+        self.assertCountEqual(DetectionJob.objects.values_list('id', flat=True), [recent.id, waiting.id])
+        self.assertFalse(default_storage.exists(old.image.name))
+        self.assertTrue(default_storage.exists(recent.image.name))
+
+
+@override_settings(ADMISSION_FALLBACK_TO_JOBS=False)
+class AdmissionTests(TestCase):
+    def setUp(self):
+        self.country = Country.objects.create(name='Testland', code='TL', common_foods='rice')
+
+    def post(self, controller):
+        upload = SimpleUploadedFile('eye.jpg', image_bytes(), content_type='image/jpeg')
+        with mock.patch('detection.admission.admission', controller):
+            return self.client.post(
+                reverse('detect_retinopathy'), {'image': upload, 'country': self.country.id},
+                headers={'X-Requested-With': 'XMLHttpRequest'},
+            )
+
+    def test_full_queue_answers_503_at_once(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=0, queue_timeout=10)
+        with controller.admit():
+            started = time.monotonic()
+            response = self.post(controller)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertGreaterEqual(int(response['Retry-After']), 1)
+        self.assertFalse(response.json()['success'])
+
+    def test_queue_timeout_answers_503(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.05)
+        with controller.admit():
+            response = self.post(controller)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(controller.stats()['queue_depth'], 0)
+
+    def test_waiter_gets_the_slot_when_it_frees_up(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5)
+        entered, done = threading.Event(), threading.Event()
+
+        def wait_for_slot():
+            with controller.admit():
+                entered.set()
+                done.wait(5)
+
+        waiter = threading.Thread(target=wait_for_slot)
+        with controller.admit():
+            waiter.start()
+            while controller.stats()['queue_depth'] == 0:
+                time.sleep(0.001)
+            self.assertFalse(entered.is_set())
+        self.assertTrue(entered.wait(5))
+        self.assertEqual(controller.stats()['in_flight'], 1)
+        done.set()
+        waiter.join(5)
+        self.assertEqual(controller.stats()['in_flight'], 0)
+
+
+class TestTimeAugmentationTests(TestCase):
+    def setUp(self):
+        self.batch = np.random.default_rng(0).random((2, 16, 16, 3), dtype=np.float32)
+
+    def test_views_are_stacked_view_major(self):
+        out = augment_batch(self.batch, views=4)
+
+        self.assertEqual(out.shape, (8, 16, 16, 3))
+        np.testing.assert_array_equal(out[0:2], self.batch)
+        np.testing.assert_array_equal(out[2:4], self.batch[:, :, ::-1])
+        np.testing.assert_array_equal(out[4:6], self.batch[:, ::-1])
+        np.testing.assert_array_equal(out[6:8], self.batch[:, ::-1, ::-1])
+
+    def test_rotation_views(self):
+        out = augment_batch(self.batch, views=6, degrees=90)
+        np.testing.assert_array_equal(out[8:10], np.rot90(self.batch, k=-1, axes=(1, 2)))
+        np.testing.assert_array_equal(out[10:12], np.rot90(self.batch, k=1, axes=(1, 2)))
+
+        # Corners rotated in from outside the image are black
+        corner = augment_batch(self.batch, views=5, degrees=45)[8:10]
+        np.testing.assert_array_equal(corner[:, 0, 0], 0)
+
+    def test_average_views_folds_back_to_one_row_per_image(self):
+        views, images = 3, 2
+        outputs = np.array([[view * 10 + image, 1.0] for view in range(views) for image in range(images)])
+        np.testing.assert_allclose(average_views(outputs, views), [[10.0, 1.0], [11.0, 1.0]])
+
+    def test_unsupported_view_count(self):
+        with self.assertRaises(ValueError):
+            augment_batch(self.batch, views=9)
+
+
+class ModelRegistryTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.registry = ModelRegistry(root=os.path.join(self.directory, 'registry'))
+
+    def model_file(self, name='model', content=b'weights', exports=('onnx',)):
+        path = os.path.join(self.directory, f'{name}.hdf5')
+        with open(path, 'wb') as f:
+            f.write(content)
+        for suffix in exports:
+            with open(os.path.join(self.directory, f'{name}.{suffix}'), 'wb') as f:
+                f.write(content + suffix.encode())
+        return path
+
+    def test_register_copies_and_verifies_the_model_and_its_exports(self):
+        model = self.registry.register(self.model_file(), activate=True)
+        self.assertEqual(model.version, 'v1')
+        self.assertEqual(self.registry.active(), model)
+        self.assertEqual([backend for backend, _, _ in model.converted], ['onnx'])
+        self.registry.verify(model)
+
+        with open(model.converted[0][1], 'ab') as f:
+            f.write(b'corrupted')
+        with self.assertRaises(ModelIntegrityError):
+            self.registry.verify(model)
+        # Backends that do not load the export are unaffected
+        self.registry.verify(model, backends=['keras'])
+
+    def test_failed_registration_leaves_nothing_behind(self):
+        path = self.model_file()
+        with mock.patch('detection.model_registry.file_sha256', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.registry.register(path)
+        with mock.patch.object(self.registry, 'save', side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self.registry.register(path)
+
+        self.assertEqual(os.listdir(self.registry.root), [])
+        self.assertEqual(self.registry.register(path).version, 'v1')
+
+    def test_watcher_loads_a_newly_activated_version(self):
+        first = self.registry.register(self.model_file('first', b'one'), activate=True)
+        target = mock.Mock()
+        target._instance.registry_model = first
+        watcher = ModelWatcher(target, registry=self.registry, poll_seconds=0)
+        self.assertFalse(watcher.check())
+
+        second = self.registry.register(self.model_file('second', b'two'), activate=True)
+        self.assertTrue(watcher.check())
+        target.reload.assert_called_once_with(second)
+        target._instance.registry_model = second
+        # Nothing changed since
+        self.assertFalse(watcher.check())
+
+        target.reload.side_effect = RuntimeError("bad model")
+        self.registry.activate(first.version)
+        self.assertFalse(watcher.check())
+        self.assertEqual(watcher.failures, 1)
+
+
+class DecodedUploadTests(TestCase):
+    def setUp(self):
+        self.country = Country.objects.create(name='Testland', code='TL', common_foods='rice')
+
+    def form(self, data, name='eye.jpg'):
+        upload = SimpleUploadedFile(name, data)
+        return RetinopathyTestForm({'country': self.country.id}, {'image': upload}), upload
+
+    def test_valid_upload_is_decoded_once_and_kept_on_the_file(self):
+        data = image_bytes('PNG', (400, 300))
+        with mock.patch('detection.forms.decode_upload', wraps=decode_upload) as decode:
+            form, upload = self.form(data, 'eye.png')
+            self.assertTrue(form.is_valid(), form.errors)
+            # Validating again reuses the decode
+            RetinopathyTestForm({'country': self.country.id}, {'image': upload}).is_valid()
+
+        self.assertEqual(decode.call_count, 1)
+        decoded = form.cleaned_data['image'].decoded
+        self.assertEqual((decoded.format, decoded.width, decoded.height), ('PNG', 400, 300))
+        self.assertEqual(decoded.data, data)
+        self.assertEqual(form.cleaned_data['image'].content_type, 'image/png')
+
+    def test_large_jpeg_is_decoded_at_reduced_scale(self):
+        form, _ = self.form(image_bytes('JPEG', (2000, 1600)))
+        self.assertTrue(form.is_valid(), form.errors)
+        decoded = form.cleaned_data['image'].decoded
+        self.assertEqual((decoded.width, decoded.height), (2000, 1600))
+        self.assertLess(decoded.image.size[0], 2000)
+
+    def test_rejected_uploads(self):
+        gif = image_bytes('GIF')
+        for label, data in (
+            ('not an image', b'plain text' * 50),
+            ('truncated', image_bytes()[:400]),
+            ('unsupported format', gif),
+            ('too small', image_bytes(size=(40, 40))),
+        ):
+            with self.subTest(label):
+                form, _ = self.form(data)
+                self.assertFalse(form.is_valid())
+                self.assertIn('image', form.errors)
+
+    @override_settings(UPLOAD_MAX_PIXELS=100 * 100)
+    def test_pixel_limit_is_read_from_the_header(self):
+        form, _ = self.form(image_bytes(size=(200, 200)))
+        with mock.patch.object(Image.Image, 'load') as load:
+            self.assertFalse(form.is_valid())
+        load.assert_not_called()
+        self.assertIn('too large', str(form.errors['image']))
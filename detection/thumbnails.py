@@ -0,0 +1,102 @@
+"""
+Thumbnails of uploaded retina images.
+
+Each image gets one file per size in ``THUMBNAIL_SIZES`` under
+``MEDIA_ROOT/thumbnails/<size>/``, encoded as WebP (JPEG when Pillow has
+no WebP support). They are written when a test is saved, or on first
+request by the thumbnail view, and ``manage.py generate_thumbnails``
+backfills existing tests. Thumbnails are named after the source image, so
+their URLs never change content and can be cached indefinitely.
+"""
+import hashlib
+import io
+import os
+import threading
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, features
+
+from .preprocessing import open_image
+
+THUMBNAIL_DIR = 'thumbnails'
+
+
+def thumbnail_sizes():
+    """Configured sizes as {name: longest side in pixels}"""
+    return getattr(settings, 'THUMBNAIL_SIZES', {'small': 100, 'medium': 300})
+
+
+def thumbnail_format():
+    fmt = getattr(settings, 'THUMBNAIL_FORMAT', 'WEBP').upper()
+    if fmt == 'WEBP' and not features.check('webp'):
+        return 'JPEG'
+    return fmt
+
+
+def thumbnail_path(image_name, size):
+    """Path under MEDIA_ROOT of an image's thumbnail at the given size"""
+    fmt = thumbnail_format()
+    extension = '.webp' if fmt == 'WEBP' else '.jpg'
+    return os.path.join(settings.MEDIA_ROOT, THUMBNAIL_DIR, size, os.path.splitext(image_name)[0] + extension)
+
+
+def thumbnail_version(image_name):
+    """Short token that changes whenever a test points at a different image"""
+    return hashlib.sha1(image_name.encode()).hexdigest()[:12]
+
+
+def thumbnail_url(test, size='small'):
+    if not test.image:
+        return ''
+    url = reverse('test_thumbnail', args=[test.id, size])
+    return f"{url}?v={thumbnail_version(test.image.name)}"
+
+
+def render_thumbnail(img, max_side):
+    """Encoded thumbnail bytes for an open PIL image"""
+    fmt = thumbnail_format()
+    # Lets JPEG decode straight at a reduced scale
+    img.draft('RGB', (max_side, max_side))
+    img = img.convert('RGB')
+    img.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+    out = io.BytesIO()
+    img.save(out, fmt, quality=getattr(settings, 'THUMBNAIL_QUALITY', 80))
+    return out.getvalue()
+
+
+def generate_thumbnails(image_name, source=None, sizes=None, force=False):
+    """Write the missing thumbnails of a stored image and return their paths.
+
+    ``source`` may be the raw image bytes when they are already in memory;
+    otherwise the image is read back from media storage.
+    """
+    sizes = sizes or list(thumbnail_sizes())
+    paths = {size: thumbnail_path(image_name, size) for size in sizes}
+    todo = [size for size, path in paths.items() if force or not os.path.exists(path)]
+    if not todo:
+        return paths
+
+    if source is None:
+        with default_storage.open(image_name, 'rb') as f:
+            source = f.read()
+
+    max_sides = thumbnail_sizes()
+    for size in todo:
+        data = render_thumbnail(open_image(source), max_sides[size])
+        path = paths[size]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    return paths
+
+
+def delete_thumbnails(image_name):
+    for size in thumbnail_sizes():
+        try:
+            os.remove(thumbnail_path(image_name, size))
+        except FileNotFoundError:
+            pass
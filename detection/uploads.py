@@ -0,0 +1,85 @@
+"""
+Single-decode upload pipeline.
+
+``decode_upload`` reads an uploaded image once. The resulting
+``DecodedUpload`` holds what the rest of the request needs:
+
+* the original bytes and their SHA-256, used for the prediction cache key
+  and the content-addressed storage name;
+* the format and dimensions, checked during form validation from the
+  image header before any pixel is decoded;
+* the pixels, decoded once at the smallest scale that still serves every
+  consumer (the model input times ``PREPROCESS_DECODE_OVERSAMPLE``, or the
+  largest thumbnail).
+
+Inference, thumbnails and the PNG-to-WebP transcode all start from that
+image. Storage writes the bytes it already has instead of reading the
+upload again.
+"""
+import hashlib
+import io
+
+from django.conf import settings
+from PIL import Image
+
+from .metrics import stage
+from .thumbnails import thumbnail_sizes
+
+DEFAULT_UPLOAD_FORMATS = ('JPEG', 'PNG', 'BMP', 'TIFF', 'WEBP')
+
+
+class UploadRejected(ValueError):
+    """The upload is not an image this service accepts"""
+
+
+class DecodedUpload:
+    __slots__ = ('data', 'digest', 'image', 'format', 'width', 'height')
+
+    def __init__(self, data, image, width, height):
+        self.data = data
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.image = image
+        self.format = image.format
+        # Full-resolution size; the decoded image may be smaller
+        self.width = width
+        self.height = height
+
+
+def decode_image(data, size=(224, 224)):
+    """Validate and decode raw image bytes once, raising UploadRejected"""
+    formats = getattr(settings, 'UPLOAD_IMAGE_FORMATS', DEFAULT_UPLOAD_FORMATS)
+    min_side = getattr(settings, 'UPLOAD_MIN_SIDE', 64)
+    max_pixels = getattr(settings, 'UPLOAD_MAX_PIXELS', 50_000_000)
+
+    with stage('decode'):
+        try:
+            img = Image.open(io.BytesIO(data))
+        except Exception:
+            raise UploadRejected("Upload a valid image. The file is not an image or is corrupted.")
+
+        # Format and dimensions come from the header, before decoding pixels
+        if img.format not in formats:
+            raise UploadRejected(f"Unsupported image format {img.format}. Please upload JPG, PNG, or BMP.")
+        width, height = img.size
+        if min(width, height) < min_side:
+            raise UploadRejected(f"Image too small ({width}x{height}), it needs at least {min_side} pixels per side.")
+        if max_pixels and width * height > max_pixels:
+            raise UploadRejected(f"Image too large ({width}x{height}), it may have at most {max_pixels} pixels.")
+
+        oversample = getattr(settings, 'PREPROCESS_DECODE_OVERSAMPLE', 2.0)
+        if oversample:
+            # The same reduced JPEG decode as load_resized, enlarged if a
+            # thumbnail needs more; other formats decode in full
+            side = max(max(size) * oversample, max(thumbnail_sizes().values(), default=0))
+            img.draft('RGB', (int(side), int(side)))
+        try:
+            img.load()
+        except Exception:
+            raise UploadRejected("Upload a valid image. The file is not an image or is corrupted.")
+    return DecodedUpload(data, img, width, height)
+
+
+def decode_upload(uploaded_file, size=(224, 224)):
+    """decode_image for an uploaded file, read once from the start"""
+    uploaded_file.seek(0)
+    return decode_image(uploaded_file.read(), size)
@@ -1,9 +1,14 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Under ASGI, serve /detect/ from the native async view
+detect_view = views.adetect_retinopathy if getattr(settings, 'ASYNC_DETECT_VIEW', False) else views.detect_retinopathy
+
 urlpatterns = [
     path('', views.home, name='home'),
-    path('detect/', views.detect_retinopathy, name='detect_retinopathy'),
+    path('detect/', detect_view, name='detect_retinopathy'),
+    path('detect/jobs/<uuid:job_id>/', views.detection_job_status, name='detection_job_status'),
     path('history/', views.test_history, name='test_history'),
     # urls.py
     path("diet/", views.dietary_recommendations, name="dietary_recommendations"),
@@ -16,4 +21,6 @@ urlpatterns = [
     path('contact/', views.contact, name='contact'),
     path('test/delete/<int:test_id>/', views.delete_test, name='delete_test'),
     path('test/<int:test_id>/', views.test_detail, name='test_detail'),
+    path('test/<int:test_id>/thumbnail/<str:size>/', views.test_thumbnail, name='test_thumbnail'),
+    path('metrics', views.metrics, name='metrics'),
 ]
\ No newline at end of file
@@ -1,74 +1,202 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.conf import settings
+from django.core.files.base import ContentFile
+from django.urls import reverse
 import base64
 import re
 import logging
 import os
-from .forms import RetinopathyTestForm
-from .models import RetinopathyTest, DietaryRecommendation, Country
+from .forms import DecodedImageField, RetinopathyTestForm
+from .models import RetinopathyTest, Country, DetectionJob
 from .ai_model import detector
+from .admission import Overloaded, aadmitted, admission_total, admitted
+from .db import save_test
+from .metrics import errors_total, registry, stage
+from .jobs import job_pool, submit_job
+from .recommendations import resolver as recommendations
+from .history import history_page, parse_filters
+from .thumbnails import delete_thumbnails, generate_thumbnails, thumbnail_path, thumbnail_sizes
+from .uploads import DecodedUpload, UploadRejected, decode_image, decode_upload
 from django.views.decorators.csrf import ensure_csrf_cookie
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+import asyncio
+import contextvars
 
 def home(request):
     return render(request, 'home.html')
+
+
+def run_detection(image_data, image_file=None, image_name=None, admit=True):
+    """Predict the DR stage for raw image bytes or a DecodedUpload and save the test record
+
+    With ``admit`` the prediction waits for an inference slot and raises
+    ``Overloaded`` when none frees up; job workers are bounded on their own.
+    """
+    # Process image and get result
+    with admitted() if admit else nullcontext():
+        result, confidence, model_version = detector.predict_with_version(image_data)
+    return record_detection(image_data, result, confidence, model_version, image_file, image_name)
+
+
+def record_detection(image_data, result, confidence, model_version, image_file=None, image_name=None):
+    """Save the test record of a prediction and create its thumbnails
+
+    Shared by run_detection and arun_detection, so both save through
+    save_test (and DB_WRITE_BUFFER) and honour THUMBNAILS_ON_UPLOAD.
+    """
+    # Get stage info (number and description)
+    stage_info = get_dr_stage_info(result)
+
+    # Save test record
+    test = RetinopathyTest(
+        image=image_file,
+        result=stage_info['key'],
+        confidence=confidence,
+        model_version=model_version or ''
+    )
+    if image_name:
+        # The file is already in storage, only link it
+        test.image.name = image_name
+    with stage('db'):
+        test = save_test(test)
+
+    if test.image and getattr(settings, 'THUMBNAILS_ON_UPLOAD', True):
+        # The image is still in memory, so this skips reading the file back
+        source = image_data.image if isinstance(image_data, DecodedUpload) else image_data
+        try:
+            with stage('thumbnail'):
+                generate_thumbnails(test.image.name, source=source)
+        except Exception as e:
+            print(f"Could not create thumbnails for test {test.id}: {e}")
+    return test, stage_info
+
+
+def detection_payload(test, stage_info, country):
+    """JSON payload returned to the detection page for a finished test"""
+    return {
+        'success': True,
+        'result': stage_info['stage'],
+        'stage_description': stage_info['description'],
+        'stage_number': stage_info['number'],
+        'stage_key': stage_info['key'],
+        'test_id': test.id,
+        'country_id': country.id,
+        'model_version': test.model_version
+    }
+
+
+def read_camera_capture(request):
+    """Raw bytes of a camera capture from a binary upload or a base64 data URL
+
+    Raises UploadRejected for captures over the form's upload size limit.
+    """
+    max_bytes = DecodedImageField.max_bytes
+    too_large = UploadRejected("Image file too large ( > 10MB )")
+    capture = request.FILES.get('capture')
+    if capture:
+        # Checked before reading, so an oversized blob is never loaded
+        if capture.size > max_bytes:
+            raise too_large
+        # Already downscaled and JPEG/WebP encoded by the browser
+        return capture.read()
+
+    # Clean and decode base64 image
+    image_data = re.sub(r'^data:image/.+;base64,', '', request.POST['image_data'])
+    if len(image_data) * 3 // 4 > max_bytes:
+        raise too_large
+    return base64.b64decode(image_data)
+
+
+def decoded_file(upload, name):
+    """A file of a DecodedUpload's bytes that storage and jobs take the decode from"""
+    f = ContentFile(upload.data, name=name)
+    f.decoded = upload
+    return f
+
+
+def job_accepted_response(job):
+    return JsonResponse({
+        'success': True,
+        'status': job.status,
+        'job_id': str(job.id),
+        'status_url': reverse('detection_job_status', args=[job.id]),
+    }, status=202)
+
+
+def overloaded_response(request, error, is_ajax, fallback=None):
+    """Answer a request shed by admission control
+
+    AJAX clients can poll, so with ADMISSION_FALLBACK_TO_JOBS their image
+    becomes a background job; everyone else gets a 503 with Retry-After.
+    ``fallback`` is ``(upload, name, country, keep_image)`` with the
+    request's DecodedUpload.
+    """
+    if is_ajax and fallback and getattr(settings, 'ADMISSION_FALLBACK_TO_JOBS', True):
+        upload, name, country, keep_image = fallback
+        try:
+            job = submit_job(decoded_file(upload, name), country, keep_image=keep_image)
+        except Exception as e:
+            print(f"Could not queue overloaded request as a job: {e}")
+        else:
+            admission_total.inc(outcome='fallback_job')
+            return job_accepted_response(job)
+
+    message = 'The server is busy, please try again shortly.'
+    if is_ajax:
+        response = JsonResponse({
+            'success': False,
+            'message': message,
+            'retry_after': error.retry_after,
+        }, status=503)
+    else:
+        response = render(request, 'detect_retinopathy.html', {
+            'form': RetinopathyTestForm(),
+            'error_message': message,
+        }, status=503)
+    response['Retry-After'] = str(error.retry_after)
+    return response
+
 @ensure_csrf_cookie
 def detect_retinopathy(request):
     if request.method == 'POST':
         is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        with stage('parse'):
+            # Reading FILES parses the whole multipart body, so it is timed on its own
+            files = request.FILES
+            # Async clients get a job ID at once and poll detection_job_status
+            is_async = is_ajax and request.POST.get('async') == '1'
+        # What to queue as a job if the request is shed by admission control
+        fallback = None
         
         try:
             # Handle file upload from AJAX
-            if is_ajax and request.FILES.get('image'):
-                form = RetinopathyTestForm(request.POST, request.FILES)
-                if form.is_valid():
+            if is_ajax and files.get('image'):
+                form = RetinopathyTestForm(request.POST, files)
+                with stage('form'):
+                    valid = form.is_valid()
+                if valid:
                     country = form.cleaned_data['country']
                     image_file = request.FILES['image']
-                    
-                    # Process image and get result
-                    result, confidence = detector.predict(image_file.read())
-                    
-                    # Get stage info (number and description)
-                    stage_info = get_dr_stage_info(result)
-                    
-                    # Save test record
-                    test = RetinopathyTest(
-                        image=image_file,
-                        result=stage_info['key'],
-                        confidence=confidence
-                    )
-                    test.save()
-                    
-                    # Get dietary recommendation for this specific stage
-                    diet_recommendation = DietaryRecommendation.objects.filter(
-                        condition=stage_info['key'],
-                        country=country
-                    ).first()
-                    
-                    if not diet_recommendation:
-                        diet_recommendation = DietaryRecommendation.objects.filter(
-                            condition=stage_info['key'],
-                            is_default=True
-                        ).first()
-                    
-                    return JsonResponse({
-                        'success': True,
-                        'result': stage_info['stage'],
-                        'stage_description': stage_info['description'],
-                        'stage_number': stage_info['number'],
-                        'stage_key': stage_info['key'],
-                        'test_id': test.id,
-                        'country_id': country.id
-                    })
+
+                    if is_async:
+                        return job_accepted_response(submit_job(image_file, country))
+
+                    # Read and decoded once by the form; reused for inference and storage
+                    upload = image_file.decoded
+                    fallback = (upload, image_file.name, country, True)
+                    test, stage_info = run_detection(upload, image_file=image_file)
+                    return JsonResponse(detection_payload(test, stage_info, country))
                 else:
                     return JsonResponse({
                         'success': False,
                         'message': 'Invalid form data. Please check your inputs.'
                     }, status=400)
             
-            # Handle base64 image from camera
-            elif is_ajax and request.POST.get('image_data'):
-                image_data = request.POST['image_data']
+            # Handle camera capture: a binary multipart blob, or base64 from older pages
+            elif is_ajax and (files.get('capture') or request.POST.get('image_data')):
                 country_id = request.POST.get('country')
                 
                 if not country_id:
@@ -85,81 +213,53 @@ def detect_retinopathy(request):
                         'message': 'Invalid country selected'
                     }, status=400)
                 
-                # Clean and decode base64 image
-                image_data = re.sub(r'^data:image/.+;base64,', '', image_data)
-                image_data = base64.b64decode(image_data)
-                
-                # Process image and get result
-                result, confidence = detector.predict(image_data)
-                
-                # Get stage info (number and description)
-                stage_info = get_dr_stage_info(result)
-                
-                # Save test record
-                test = RetinopathyTest(
-                    result=stage_info['key'],
-                    confidence=confidence
-                )
-                test.save()
+                try:
+                    image_data = read_camera_capture(request)
+                    upload = decode_image(image_data)
+                except UploadRejected as e:
+                    return JsonResponse({'success': False, 'message': str(e)}, status=400)
                 
-                return JsonResponse({
-                    'success': True,
-                    'result': stage_info['stage'],
-                    'stage_description': stage_info['description'],
-                    'stage_number': stage_info['number'],
-                    'stage_key': stage_info['key'],
-                    'test_id': test.id,
-                    'country_id': country.id,
-                    
-                })
+                if is_async:
+                    job = submit_job(decoded_file(upload, 'camera'), country, keep_image=False)
+                    return job_accepted_response(job)
+
+                fallback = (upload, 'camera', country, False)
+                test, stage_info = run_detection(upload)
+                return JsonResponse(detection_payload(test, stage_info, country))
             
             # Handle regular form submission (non-AJAX)
             else:
-                form = RetinopathyTestForm(request.POST, request.FILES)
-                if form.is_valid():
+                form = RetinopathyTestForm(request.POST, files)
+                with stage('form'):
+                    valid = form.is_valid()
+                if valid:
                     country = form.cleaned_data['country']
                     image_file = request.FILES['image']
-                    
-                    # Process image and get result
-                    result, confidence = detector.predict(image_file.read())
-                    
-                    # Get stage info (number and description)
-                    stage_info = get_dr_stage_info(result)
-                    
-                    # Save test record
-                    test = RetinopathyTest(
-                        image=image_file,
-                        result=stage_info['key'],
-                        confidence=confidence
-                    )
-                    test.save()
+
+                    test, stage_info = run_detection(image_file.decoded, image_file=image_file)
                     
                     # Get dietary recommendation for this specific stage
-                    diet_recommendation = DietaryRecommendation.objects.filter(
-                        condition=stage_info['key'],
-                        country=country
-                    ).first()
+                    diet_recommendation = recommendations.resolve(stage_info['key'], country)
                     
-                    if not diet_recommendation:
-                        diet_recommendation = DietaryRecommendation.objects.filter(
-                            condition=stage_info['key'],
-                            is_default=True
-                        ).first()
-                    
-                    return render(request, 'detection_result.html', {
-                        'test': test,
-                        'diet_recommendation': diet_recommendation,
-                        'selected_country': country,
-                        'stage_info': stage_info
-                    })
+                    with stage('render'):
+                        return render(request, 'detection_result.html', {
+                            'test': test,
+                            'diet_recommendation': diet_recommendation,
+                            'selected_country': country,
+                            'stage_info': stage_info
+                        })
                 
-                return render(request, 'detect_retinopathy.html', {'form': form})
+                with stage('render'):
+                    return render(request, 'detect_retinopathy.html', {'form': form})
                 
+        except Overloaded as e:
+            return overloaded_response(request, e, is_ajax, fallback)
         except Exception as e:
             # Log the error for debugging
             import logging
             logger = logging.getLogger(__name__)
             logger.error(f"Error in detect_retinopathy: {str(e)}")
+            errors_total.inc(where='detect')
             
             if is_ajax:
                 return JsonResponse({
@@ -178,6 +278,175 @@ def detect_retinopathy(request):
     
     return render(request, 'detect_retinopathy.html', {'form': form})
 
+# Bounded pool running model inference for the async view, so one event
+# loop can accept many uploads while only a fixed number are inferred at once
+inference_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, 'ASYNC_INFERENCE_WORKERS', 4),
+    thread_name_prefix='dr-inference',
+)
+
+# Template rendering may touch the ORM (e.g. the country choices), which is
+# not allowed directly in async code
+arender = sync_to_async(render)
+
+
+async def adecode_upload(uploaded_file):
+    """Decode an upload off the event loop before the form validates it
+
+    Async form validation runs in Django's one shared sync thread, which
+    would serialize the decodes of concurrent requests. The form reuses
+    the result, and reports rejected or oversized files itself.
+    """
+    if uploaded_file.size > DecodedImageField.max_bytes:
+        return
+    try:
+        uploaded_file.decoded = await sync_to_async(decode_upload, thread_sensitive=False)(uploaded_file)
+    except UploadRejected:
+        pass
+
+
+async def arun_detection(image_data, image_file=None):
+    """Async run_detection: inference in the bounded executor, then record_detection in a sync thread"""
+    loop = asyncio.get_running_loop()
+    # run_in_executor does not carry context variables over, so pass them on
+    # for the stage timings of this request
+    context = contextvars.copy_context()
+    async with aadmitted():
+        result, confidence, model_version = await loop.run_in_executor(
+            inference_executor, context.run, detector.predict_with_version, image_data
+        )
+    return await sync_to_async(record_detection)(image_data, result, confidence, model_version, image_file)
+
+
+@ensure_csrf_cookie
+async def adetect_retinopathy(request):
+    """Async version of detect_retinopathy for the ASGI stack"""
+    if request.method != 'POST':
+        return await arender(request, 'detect_retinopathy.html', {'form': RetinopathyTestForm()})
+
+    is_ajax = request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+    with stage('parse'):
+        files = request.FILES
+        is_async = is_ajax and request.POST.get('async') == '1'
+    fallback = None
+
+    try:
+        # Handle file upload from AJAX
+        if is_ajax and files.get('image'):
+            await adecode_upload(files['image'])
+            form = RetinopathyTestForm(request.POST, files)
+            with stage('form'):
+                valid = await sync_to_async(form.is_valid)()
+            if not valid:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Invalid form data. Please check your inputs.'
+                }, status=400)
+            country = form.cleaned_data['country']
+            image_file = request.FILES['image']
+
+            if is_async:
+                return job_accepted_response(await sync_to_async(submit_job)(image_file, country))
+
+            upload = image_file.decoded
+            fallback = (upload, image_file.name, country, True)
+            test, stage_info = await arun_detection(upload, image_file=image_file)
+            return JsonResponse(detection_payload(test, stage_info, country))
+
+        # Handle camera capture: a binary multipart blob, or base64 from older pages
+        elif is_ajax and (files.get('capture') or request.POST.get('image_data')):
+            country_id = request.POST.get('country')
+            if not country_id:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Country selection is required'
+                }, status=400)
+            try:
+                country = await Country.objects.aget(id=country_id)
+            except Country.DoesNotExist:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Invalid country selected'
+                }, status=400)
+
+            try:
+                image_data = read_camera_capture(request)
+                upload = await sync_to_async(decode_image, thread_sensitive=False)(image_data)
+            except UploadRejected as e:
+                return JsonResponse({'success': False, 'message': str(e)}, status=400)
+
+            if is_async:
+                job = await sync_to_async(submit_job)(decoded_file(upload, 'camera'), country, keep_image=False)
+                return job_accepted_response(job)
+
+            fallback = (upload, 'camera', country, False)
+            test, stage_info = await arun_detection(upload)
+            return JsonResponse(detection_payload(test, stage_info, country))
+
+        # Handle regular form submission (non-AJAX)
+        if files.get('image'):
+            await adecode_upload(files['image'])
+        form = RetinopathyTestForm(request.POST, files)
+        with stage('form'):
+            valid = await sync_to_async(form.is_valid)()
+        if not valid:
+            with stage('render'):
+                return await arender(request, 'detect_retinopathy.html', {'form': form})
+
+        country = form.cleaned_data['country']
+        image_file = request.FILES['image']
+        test, stage_info = await arun_detection(image_file.decoded, image_file=image_file)
+
+        # Get dietary recommendation for this specific stage
+        diet_recommendation = await recommendations.aresolve(stage_info['key'], country)
+
+        with stage('render'):
+            return await arender(request, 'detection_result.html', {
+                'test': test,
+                'diet_recommendation': diet_recommendation,
+                'selected_country': country,
+                'stage_info': stage_info
+            })
+
+    except Overloaded as e:
+        return await sync_to_async(overloaded_response)(request, e, is_ajax, fallback)
+    except Exception as e:
+        logger = logging.getLogger(__name__)
+        logger.error(f"Error in adetect_retinopathy: {str(e)}")
+        errors_total.inc(where='detect')
+
+        if is_ajax:
+            return JsonResponse({
+                'success': False,
+                'message': f'Server error: {str(e)}'
+            }, status=500)
+        return await arender(request, 'detect_retinopathy.html', {
+            'form': RetinopathyTestForm(),
+            'error_message': f'An error occurred: {str(e)}'
+        })
+
+def detection_job_status(request, job_id):
+    """Poll an async detection job; returns the detection payload once it is done"""
+    try:
+        job = DetectionJob.objects.get(id=job_id)
+    except DetectionJob.DoesNotExist:
+        return JsonResponse({'success': False, 'message': 'Unknown job'}, status=404)
+
+    if job.status == 'done':
+        return JsonResponse({**job.result, 'status': job.status, 'job_id': str(job.id)})
+    if job.status == 'failed':
+        return JsonResponse({
+            'success': False,
+            'status': job.status,
+            'job_id': str(job.id),
+            'message': f'Server error: {job.error}'
+        })
+
+    # Make sure this process has workers in case the one that accepted the
+    # job has gone away
+    job_pool.ensure_started()
+    return JsonResponse({'success': True, 'status': job.status, 'job_id': str(job.id)}, status=202)
+
 def get_dr_stage_info(result):
     """Return DR stage information with number, description, and key (matching model choices)"""
     cleaned_result = result.strip().lower()
@@ -268,29 +537,40 @@ def change_language(request):
 
 
 def test_history(request):
-    tests = RetinopathyTest.objects.all().order_by('-created_at')[:10]
-    return render(request, 'test_history.html', {'tests': tests})
+    filters = parse_filters(request.GET)
+    page = history_page(
+        filters,
+        after=request.GET.get('after'),
+        before=request.GET.get('before'),
+        page_size=getattr(settings, 'HISTORY_PAGE_SIZE', 20),
+    )
+
+    # Keep the filters on the previous/next links
+    query = request.GET.copy()
+    for key in ('after', 'before'):
+        query.pop(key, None)
+    links = {}
+    for name, key, cursor in (('next_url', 'after', page['next_cursor']),
+                              ('previous_url', 'before', page['previous_cursor'])):
+        if cursor:
+            params = query.copy()
+            params[key] = cursor
+            links[name] = f"?{params.urlencode()}"
+
+    return render(request, 'test_history.html', {
+        'tests': page['tests'],
+        'filters': filters,
+        'result_choices': RetinopathyTest._meta.get_field('result').choices,
+        'filter_query': query.urlencode(),
+        **links,
+    })
 
 def dietary_recommendations(request):
     stage = request.GET.get("stage")   # e.g., "proliferative"
     country_id = request.GET.get("country")
 
-    recommendation = None
-
-    if stage:
-        if country_id:
-            # Try country-specific recommendation
-            recommendation = DietaryRecommendation.objects.filter(
-                condition=stage,
-                country_id=country_id
-            ).first()
-
-        if not recommendation:
-            # Try default recommendation
-            recommendation = DietaryRecommendation.objects.filter(
-                condition=stage,
-                is_default=True
-            ).first()
+    # Country-specific recommendation, else the default for the stage
+    recommendation = recommendations.resolve(stage, country_id)
 
     context = {
         "recommendation": recommendation,
@@ -302,7 +582,7 @@ def dietary_recommendations(request):
 def detection_result(request, test_id):
     try:
         test = RetinopathyTest.objects.get(id=test_id)
-        diet_recommendation = DietaryRecommendation.objects.filter(condition=test.result).first()
+        diet_recommendation = recommendations.any_for(test.result)
         
         return render(request, 'detection_result.html', {
             'test': test,
@@ -320,17 +600,43 @@ def contact(request):
 def delete_test(request, test_id):
     try:
         test = RetinopathyTest.objects.get(id=test_id)
-        if test.image and os.path.isfile(test.image.path):
-            os.remove(test.image.path)
+        if test.image:
+            name, storage = test.image.name, test.image.storage
+            # Identical uploads share one file; the storage only removes it
+            # with its last reference
+            test.image.delete(save=False)
+            if not storage.exists(name):
+                delete_thumbnails(name)
         test.delete()
         return redirect('test_history')
     except RetinopathyTest.DoesNotExist:
         return redirect('test_history')
 
+def test_thumbnail(request, test_id, size):
+    """Serve a test image thumbnail, creating it on first request"""
+    if size not in thumbnail_sizes():
+        raise Http404("Unknown thumbnail size")
+    test = RetinopathyTest.objects.only('image').filter(id=test_id).first()
+    if test is None or not test.image:
+        raise Http404("No image for this test")
+
+    path = thumbnail_path(test.image.name, size)
+    if not os.path.exists(path):
+        try:
+            generate_thumbnails(test.image.name, sizes=[size])
+        except Exception as e:
+            print(f"Could not create thumbnail for test {test_id}: {e}")
+            raise Http404("Image unavailable")
+
+    response = FileResponse(open(path, 'rb'))
+    # URLs carry a version of the image name, so the content never changes
+    response['Cache-Control'] = f"public, max-age={getattr(settings, 'THUMBNAIL_CACHE_SECONDS', 31536000)}, immutable"
+    return response
+
 def test_detail(request, test_id):
     try:
         test = RetinopathyTest.objects.get(id=test_id)
-        diet_recommendation = DietaryRecommendation.objects.filter(condition=test.result).first()
+        diet_recommendation = recommendations.any_for(test.result)
         
         return render(request, 'test_detail.html', {
             'test': test,
@@ -338,3 +644,11 @@ def test_detail(request, test_id):
         })
     except RetinopathyTest.DoesNotExist:
         return redirect('test_history')
+
+
+def metrics(request):
+    """Prometheus text exposition of this process's metrics"""
+    allowed = getattr(settings, 'METRICS_ALLOWED_IPS', None)
+    if allowed is not None and request.META.get('REMOTE_ADDR') not in allowed:
+        raise Http404()
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
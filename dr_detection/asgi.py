@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dr_detection.settings')
 
 application = get_asgi_application()
+
+# Load the model and build its graphs before the first request arrives.
+# Management commands do not import this module, so they stay fast.
+from detection.ai_model import warm_up_detector  # noqa: E402
+
+warm_up_detector()
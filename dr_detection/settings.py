@@ -48,6 +48,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'detection.metrics.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -175,3 +176,194 @@ CRISPY_TEMPLATE_PACK = 'bootstrap5'
 
 # TensorFlow model path
 MODEL_PATH = os.path.join(BASE_DIR, '..', 'models', 'cnn_model_best.hdf5')
+
+
+# Inference micro-batching: concurrent predict() calls are grouped into one
+# model call of up to INFERENCE_MAX_BATCH_SIZE images, waiting at most
+# INFERENCE_MAX_WAIT_MS for the batch to fill. A caller waits at most
+# INFERENCE_BATCH_TIMEOUT_SECONDS for its result. With the inference server
+# the requests of all web workers are batched in the server instead.
+INFERENCE_BATCHING = True
+INFERENCE_MAX_BATCH_SIZE = 8
+INFERENCE_MAX_WAIT_MS = 5
+INFERENCE_BATCH_TIMEOUT_SECONDS = 30
+
+# Warm up the detector when the WSGI/ASGI application is created: load the
+# model and run a dummy batch of every size the batcher can produce (or the
+# sizes listed in INFERENCE_WARMUP_BATCH_SIZES).
+INFERENCE_WARMUP = True
+INFERENCE_WARMUP_BATCH_SIZES = None
+
+# Optional shared inference server (manage.py run_inference_server). When
+# INFERENCE_SERVER_SOCKET is set, web workers send images to that Unix socket
+# instead of loading their own model. INFERENCE_SERVER_WORKERS model
+# processes are started, each using the given TF intra/inter-op thread counts
+# (0 keeps TensorFlow's default of one thread per core). Pick
+# workers * intra-op threads <= cores to avoid oversubscription.
+INFERENCE_SERVER_SOCKET = os.environ.get('INFERENCE_SERVER_SOCKET') or None
+INFERENCE_SERVER_WORKERS = 1
+INFERENCE_INTRA_OP_THREADS = 0
+INFERENCE_INTER_OP_THREADS = 0
+
+# Prediction cache for repeated uploads, keyed by SHA-256 of the image bytes
+# and the model file version. PREDICTION_CACHE_SIZE entries are kept in each
+# process; results are also stored in the PREDICTION_CACHE_ALIAS cache backend
+# (set it to None to keep the cache in-process only). The 'predictions' cache
+# lives on disk, so every worker process on the host shares it and it
+# survives restarts; point it at Redis or Memcached to share across hosts.
+PREDICTION_CACHE = True
+PREDICTION_CACHE_SIZE = 1024
+PREDICTION_CACHE_ALIAS = 'predictions'
+PREDICTION_CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'predictions': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, '..', 'cache', 'predictions'),
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+
+# Large JPEGs are decoded at a reduced scale that keeps at least this many
+# times the model input resolution before the final resize (other formats
+# are shrunk with an integer reduce first). None decodes at full resolution.
+PREPROCESS_DECODE_OVERSAMPLE = 2.0
+
+# Inference runs through a tf.function traced once for (None, 224, 224, 3)
+# float32 inputs instead of Keras model.predict. INFERENCE_XLA compiles it
+# with XLA; INFERENCE_PRECISION can be 'mixed_bfloat16' (or 'mixed_float16')
+# to run the layers in reduced precision on CPUs that support it.
+INFERENCE_COMPILED = True
+INFERENCE_XLA = False
+INFERENCE_PRECISION = 'float32'
+
+# Inference backend: 'keras' (the HDF5 model), 'tflite-float16',
+# 'tflite-int8' or 'onnx'. The converted models are written next to
+# MODEL_PATH by manage.py convert_model, which also reports their accuracy
+# parity and latency against Keras. A missing file falls back to Keras.
+INFERENCE_BACKEND = 'keras'
+
+# Async detection jobs (POST /detect/ with async=1): each web process runs
+# DETECTION_JOB_WORKERS background threads that pick jobs from the database,
+# checking for jobs from other processes every DETECTION_JOB_POLL_SECONDS.
+# Jobs stuck in "running" longer than DETECTION_JOB_STALE_SECONDS are retried.
+DETECTION_JOB_WORKERS = 2
+DETECTION_JOB_POLL_SECONDS = 1.0
+DETECTION_JOB_STALE_SECONDS = 300
+
+# Serve /detect/ from the native async view (for ASGI deployments such as
+# uvicorn/daphne). Inference then runs in a pool of ASYNC_INFERENCE_WORKERS
+# threads while the event loop keeps accepting uploads.
+ASYNC_DETECT_VIEW = os.environ.get('ASYNC_DETECT_VIEW') == '1'
+ASYNC_INFERENCE_WORKERS = 4
+
+# Dietary recommendations are answered from an in-memory index that each
+# process rebuilds when a recommendation or country is saved or deleted.
+# Processes that did not make the change reload it after this many seconds
+# (0 keeps it until the next local change).
+DIETARY_RECOMMENDATION_CACHE_SECONDS = 300
+
+# Tests per page on /history/. Pages are fetched by keyset (created_at, id)
+# cursors, so deep pages cost the same as the first one.
+HISTORY_PAGE_SIZE = 20
+
+# Thumbnails of uploaded images, written under MEDIA_ROOT/thumbnails/<size>/
+# as THUMBNAIL_FORMAT (WebP, or JPEG where Pillow lacks WebP) and served by
+# /test/<id>/thumbnail/<size>/ with a long-lived Cache-Control header. Sizes
+# map a name to the longest side in pixels. They are created when a test is
+# saved (THUMBNAILS_ON_UPLOAD) or on first request; manage.py
+# generate_thumbnails backfills existing tests.
+THUMBNAIL_SIZES = {'small': 100, 'medium': 300}
+THUMBNAIL_FORMAT = 'WEBP'
+THUMBNAIL_QUALITY = 80
+THUMBNAILS_ON_UPLOAD = True
+THUMBNAIL_CACHE_SECONDS = 365 * 24 * 60 * 60
+
+# Uploaded media is stored by content hash (e.g. retinopathy_images/3f/a9/
+# 3fa9...e1.jpg) with identical uploads sharing one reference-counted file.
+# Every file lives under 'directory', whatever the field's upload_to, so a
+# job upload and the test made from it share one file. transcode_png stores
+# 8-bit PNG uploads as lossless WebP when that is smaller. manage.py
+# migrate_image_storage moves files saved under upload names or other roots.
+STORAGES = {
+    'default': {
+        'BACKEND': 'detection.storage.ContentAddressedStorage',
+        'OPTIONS': {
+            'shard_depth': 2,
+            'transcode_png': True,
+            'directory': 'retinopathy_images',
+        },
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# PRAGMAs applied to every new SQLite connection (detection.db): WAL lets
+# reads run alongside a write, synchronous=NORMAL is safe under WAL, and
+# busy_timeout (ms) makes writers wait for the lock instead of raising
+# "database is locked". Ignored for other database backends.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+}
+
+# Buffer the RetinopathyTest insert of every detection: a background thread
+# writes the rows that arrive within DB_WRITE_BUFFER_WAIT_MS (at most
+# DB_WRITE_BUFFER_SIZE) in a single transaction, and each request gets its
+# saved row back. Useful when many uploads arrive at once on SQLite. A
+# request gives up after DB_WRITE_BUFFER_TIMEOUT_SECONDS.
+DB_WRITE_BUFFER = os.environ.get('DB_WRITE_BUFFER') == '1'
+DB_WRITE_BUFFER_SIZE = 32
+DB_WRITE_BUFFER_WAIT_MS = 20
+DB_WRITE_BUFFER_TIMEOUT_SECONDS = 10
+
+# Per-stage timings (parse, form, decode, preprocess, inference, db, render)
+# are returned in a Server-Timing header by detection.metrics
+# .ServerTimingMiddleware and exported with request latency histograms,
+# inference batch sizes, model load time and error counts at /metrics in the
+# Prometheus text format. Set METRICS_ALLOWED_IPS to a list of addresses to
+# hide /metrics from everyone else.
+METRICS_ALLOWED_IPS = None
+
+# Admission control in front of inference (detection.admission): at most
+# ADMISSION_MAX_IN_FLIGHT detections run at once per process, up to
+# ADMISSION_MAX_QUEUE more wait for at most ADMISSION_QUEUE_TIMEOUT seconds,
+# and the rest are shed straight away. Shed AJAX uploads become background
+# jobs when ADMISSION_FALLBACK_TO_JOBS is set; other requests get a 503 with
+# Retry-After. Set ADMISSION_MAX_IN_FLIGHT to 0 to turn this off.
+ADMISSION_MAX_IN_FLIGHT = 8
+ADMISSION_MAX_QUEUE = 16
+ADMISSION_QUEUE_TIMEOUT = 10.0
+ADMISSION_FALLBACK_TO_JOBS = True
+
+# Test-time augmentation: each image is scored as INFERENCE_TTA_VIEWS views
+# (original, flips, then +/- INFERENCE_TTA_DEGREES rotations; at most 8) in
+# the same model call, and the softmax outputs are averaged. 1 turns it off.
+# A micro-batch of INFERENCE_MAX_BATCH_SIZE images then runs as that many
+# times INFERENCE_TTA_VIEWS rows. manage.py benchmark_detection --sections
+# tta reports the latency overhead.
+INFERENCE_TTA_VIEWS = 1
+INFERENCE_TTA_DEGREES = 10.0
+
+# Versioned model registry (detection.model_registry). manage.py
+# model_registry register/activate copies model files into
+# MODEL_REGISTRY_DIR with a SHA-256 per version. Every process checks the
+# manifest every MODEL_REGISTRY_POLL_SECONDS (0 disables this), loads a newly
+# activated version in the background and swaps it in without a restart.
+# With no registry, MODEL_PATH is used.
+MODEL_REGISTRY_DIR = os.path.join(BASE_DIR, '..', 'models', 'registry')
+MODEL_REGISTRY_POLL_SECONDS = 10
+
+# Uploads are read and decoded once (detection.uploads): the form checks the
+# real format against UPLOAD_IMAGE_FORMATS and the dimensions against
+# UPLOAD_MIN_SIDE and UPLOAD_MAX_PIXELS from the image header, and the one
+# decoded image is reused for inference, thumbnails and storage.
+UPLOAD_IMAGE_FORMATS = ('JPEG', 'PNG', 'BMP', 'TIFF', 'WEBP')
+UPLOAD_MIN_SIDE = 64
+UPLOAD_MAX_PIXELS = 50_000_000